@@ -1,6 +1,10 @@
 import json
 import os
+import asyncio
+import heapq
+import itertools
 import logging
+from collections import OrderedDict
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Tuple
 from dataclasses import dataclass, asdict
@@ -8,9 +12,17 @@ from telegram import User, Update
 from telegram.ext import ContextTypes
 
 import config
+from database import db
 
 logger = logging.getLogger(__name__)
 
+# 自动分配：堆中允许的过期条目余量、粘性分配记住的用户数、响应耗时的平滑系数
+ROUTER_HEAP_SLACK = 64
+ROUTER_STICKY_LIMIT = 10000
+ROUTER_LATENCY_SMOOTHING = 0.3
+# 已确认没有私聊请求的用户最多记住的数量，超过后清空
+ABSENT_REQUEST_LIMIT = 100000
+
 @dataclass
 class AdminInfo:
     """管理员信息"""
@@ -21,7 +33,7 @@ class AdminInfo:
     is_super_admin: bool
     join_date: str
     last_active: str
-    private_chats: List[int]  # 当前私聊的用户ID列表
+    private_chats: List[int]  # 当前私聊的用户ID列表，由已接受的私聊请求得出，不单独保存
     max_private_chats: int
     is_online: bool
 
@@ -36,24 +48,221 @@ class PrivateChatRequest:
     status: str  # pending, accepted, rejected, expired
     chat_id: Optional[int] = None
 
+class AdminRouter:
+    """私聊请求的自动分配：把请求交给负载最低的管理员
+    
+    堆中每个管理员的键依次为：是否离线、负载（私聊数加待处理请求数占上限的比例）、
+    最近响应耗时。管理员状态变化时不去堆中查找旧条目，而是压入带新版本号的条目，
+    弹出时丢弃版本号过期的条目，因此分配和更新都是 O(log n)。
+    """
+    
+    def __init__(self, manager: 'AdminManager'):
+        self.manager = manager
+        self._heap: List[Tuple] = []
+        self._versions: Dict[int, int] = {}
+        self._counter = itertools.count()
+        # 各管理员响应耗时（秒）的指数移动平均
+        self._latency: Dict[int, float] = {}
+        # 用户最近一次私聊的管理员，按最近使用排序
+        self._last_admin: OrderedDict = OrderedDict()
+        
+        self.assignments: Dict[int, int] = {}
+        self.sticky_hits = 0
+        self._wait_seconds = 0.0
+        self._responses = 0
+    
+    def rebuild(self):
+        """按管理器的当前状态重建堆（加载数据后调用）"""
+        self._versions = {}
+        entries = []
+        for admin in self.manager.admin_sessions.values():
+            version = next(self._counter)
+            self._versions[admin.user_id] = version
+            entries.append((self._key(admin), version, admin.user_id))
+        heapq.heapify(entries)
+        self._heap = entries
+        
+        for request in self.manager._requests_by_status.get("accepted", {}).values():
+            self.remember(request.user_id, request.admin_id)
+    
+    def _key(self, admin: AdminInfo) -> Tuple:
+        """堆中的排序键，越小越优先"""
+        load = self.manager.get_admin_load(admin.user_id) / max(admin.max_private_chats, 1)
+        return (not self.manager.is_admin_online(admin), load, self._latency.get(admin.user_id, 0.0), admin.user_id)
+    
+    def touch(self, admin_id: int):
+        """管理员的负载、在线状态或响应耗时变化后调用，旧条目留在堆中等弹出时丢弃"""
+        admin = self.manager.admin_sessions.get(admin_id)
+        if admin is None:
+            self._versions.pop(admin_id, None)
+            self._latency.pop(admin_id, None)
+            return
+        
+        version = next(self._counter)
+        self._versions[admin_id] = version
+        heapq.heappush(self._heap, (self._key(admin), version, admin_id))
+        
+        # 过期条目太多时重建，堆的大小与管理员数量保持同一量级
+        if len(self._heap) > 2 * len(self._versions) + ROUTER_HEAP_SLACK:
+            self._heap = [entry for entry in self._heap if self._versions.get(entry[2]) == entry[1]]
+            heapq.heapify(self._heap)
+    
+    def assign(self, user_id: int) -> Tuple[Optional[AdminInfo], bool]:
+        """为用户选择管理员：优先上次私聊且仍在线的管理员，否则选择负载最低的
+        
+        返回 (管理员, 是否为粘性分配)。这里只做选择，请求写入数据库后再调用
+        record_assignment() 计数。
+        """
+        if config.PRIVATE_CHAT_STICKY:
+            admin = self.manager.admin_sessions.get(self._last_admin.get(user_id))
+            if admin and self.manager.is_admin_online(admin) and self.manager.has_capacity(admin):
+                return admin, True
+        
+        while self._heap:
+            _, version, admin_id = self._heap[0]
+            if self._versions.get(admin_id) != version:
+                heapq.heappop(self._heap)
+                continue
+            
+            admin = self.manager.admin_sessions[admin_id]
+            # 在线状态随时间过期而不触发 touch()，堆顶的条目按当前状态重新排序
+            if self._heap[0][0][0] != (not self.manager.is_admin_online(admin)):
+                self.touch(admin_id)
+                continue
+            if self.manager.has_capacity(admin):
+                return admin, False
+            
+            # 私聊已满的管理员移出堆，结束私聊时 touch() 会重新加入
+            heapq.heappop(self._heap)
+            del self._versions[admin_id]
+        return None, False
+    
+    def record_assignment(self, admin_id: int, sticky: bool):
+        """请求已写入数据库后记录一次分配"""
+        self.assignments[admin_id] = self.assignments.get(admin_id, 0) + 1
+        if sticky:
+            self.sticky_hits += 1
+    
+    def remember(self, user_id: int, admin_id: int):
+        """记住用户的管理员，用于粘性分配"""
+        self._last_admin[user_id] = admin_id
+        self._last_admin.move_to_end(user_id)
+        if len(self._last_admin) > ROUTER_STICKY_LIMIT:
+            self._last_admin.popitem(last=False)
+    
+    def record_response(self, request: PrivateChatRequest):
+        """记录管理员接受或拒绝请求的耗时"""
+        try:
+            waited = (datetime.now() - datetime.fromisoformat(request.request_time)).total_seconds()
+        except ValueError:
+            return
+        waited = max(waited, 0.0)
+        
+        previous = self._latency.get(request.admin_id)
+        self._latency[request.admin_id] = waited if previous is None else (
+            ROUTER_LATENCY_SMOOTHING * waited + (1 - ROUTER_LATENCY_SMOOTHING) * previous)
+        self._wait_seconds += waited
+        self._responses += 1
+    
+    def get_stats(self) -> Dict:
+        """分配统计：负载公平性为 Jain 指数，1 表示各管理员负载完全相同"""
+        loads = [self.manager.get_admin_load(admin_id) for admin_id in self.manager.admin_sessions]
+        squares = sum(load * load for load in loads)
+        return {
+            "assignments": sum(self.assignments.values()),
+            "sticky_hits": self.sticky_hits,
+            "avg_wait_seconds": self._wait_seconds / self._responses if self._responses else 0.0,
+            "load_fairness": sum(loads) ** 2 / (len(loads) * squares) if squares else 1.0,
+            "max_load": max(loads, default=0),
+            "min_load": min(loads, default=0)
+        }
+
 class AdminManager:
-    """管理员管理器"""
+    """管理员管理器
+    
+    管理员和私聊请求保存在数据库的 admins / private_chat_requests 表中，
+    多个机器人进程共享同一份数据，每个私聊是一行状态为 accepted 的请求。
+    请求、接受、拒绝和结束私聊都是数据库中的单行条件写入，由数据库判断
+    状态是否允许变化，成功后用返回的行更新内存缓存，失败时从数据库重新
+    读取该行。管理员资料等其它修改先更新字典并标记对应的键，再合并为一次
+    数据库事务写入。
+    """
     
     def __init__(self):
+        # 旧版本保存数据的文件，数据库为空时导入一次
         self.admins_file = "data/admins.json"
         self.private_chats_file = "data/private_chats.json"
         self.admin_sessions: Dict[int, AdminInfo] = {}
         self.private_chat_requests: Dict[int, PrivateChatRequest] = {}
         
-        # 确保数据目录存在
-        os.makedirs("data", exist_ok=True)
+        # 二级索引，只能通过 _store_request / _drop_request 等方法修改；
+        # 同名管理员可能有多个，按用户名分组保存
+        self._admins_by_username: Dict[str, Dict[int, AdminInfo]] = {}
+        self._requests_by_admin: Dict[Tuple[int, str], Dict[int, PrivateChatRequest]] = {}
+        self._requests_by_status: Dict[str, Dict[int, PrivateChatRequest]] = {}
+        # 查询过数据库、确认没有私聊请求的用户，重新加载时清空
+        self._absent_requests: set = set()
+        self.router = AdminRouter(self)
+        
+        # 修改过的管理员ID和私聊用户ID，在 ADMIN_SAVE_DELAY_MS 内合并写入数据库
+        self.save_delay = config.ADMIN_SAVE_DELAY_MS / 1000
+        self._dirty_admins: set = set()
+        self._dirty_requests: set = set()
+        # 本进程新建、还没写入数据库的管理员，写入时只插入不存在的行
+        self._added_admins: set = set()
+        self._save_timer: Optional[asyncio.TimerHandle] = None
+        self._save_tasks: set = set()
+        self._save_lock: Optional[asyncio.Lock] = None
+    
+    async def load(self):
+        """从数据库加载管理员和私聊请求（启动时和多进程刷新时调用）"""
+        admins = await db.get_admins()
+        requests = await db.get_private_chat_requests()
+        if admins is None or requests is None:
+            logger.error("从数据库加载管理员数据失败，仅使用配置中的管理员")
+            if not self.admin_sessions:
+                self.initialize_default_admins()
+                # 数据库中可能已有这些管理员的私聊状态，不能用默认值覆盖
+                self._dirty_admins.clear()
+                self._added_admins.clear()
+                self._rebuild_indexes()
+            return
+        
+        if not admins and not requests and self.import_legacy_files():
+            self.initialize_default_admins()
+            self._rebuild_indexes()
+            await self.flush()
+            return
         
-        # 加载管理员数据
-        self.load_admins()
-        self.load_private_chats()
+        admin_sessions = {row['user_id']: AdminInfo(**row, private_chats=[]) for row in admins}
+        private_chat_requests = {row['user_id']: PrivateChatRequest(**row) for row in requests}
+        
+        # 还没写入数据库的修改以内存中的为准
+        for admin_id in self._dirty_admins:
+            self._keep_local(admin_sessions, self.admin_sessions, admin_id)
+        for user_id in self._dirty_requests:
+            self._keep_local(private_chat_requests, self.private_chat_requests, user_id)
+        
+        self.admin_sessions = admin_sessions
+        self.private_chat_requests = private_chat_requests
+        self._absent_requests.clear()
+        logger.info(f"已加载 {len(self.admin_sessions)} 个管理员，{len(self.private_chat_requests)} 个私聊请求")
         
-        # 初始化默认管理员
         self.initialize_default_admins()
+        self._rebuild_indexes()
+    
+    @staticmethod
+    def _keep_local(loaded: Dict, local: Dict, key: int):
+        """用内存中的值覆盖刚加载的值，内存中已删除的键也删除"""
+        if key in local:
+            loaded[key] = local[key]
+        else:
+            loaded.pop(key, None)
+    
+    async def refresh(self):
+        """写入本进程的修改后重新加载，获取其他进程的修改"""
+        await self.flush()
+        await self.load()
     
     def initialize_default_admins(self):
         """初始化默认管理员"""
@@ -93,48 +302,227 @@ class AdminManager:
             
             self.save_admins()
     
-    def load_admins(self):
-        """加载管理员数据"""
+    def import_legacy_files(self) -> bool:
+        """导入旧版本的 JSON 文件，导入后文件改名为 *.imported"""
+        paths = [path for path in (self.admins_file, self.private_chats_file) if os.path.exists(path)]
+        if not paths:
+            return False
+        
         try:
             if os.path.exists(self.admins_file):
                 with open(self.admins_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for admin_data in data.values():
+                    for admin_data in json.load(f).values():
                         admin = AdminInfo(**admin_data)
                         self.admin_sessions[admin.user_id] = admin
-                logger.info(f"已加载 {len(self.admin_sessions)} 个管理员")
-        except Exception as e:
-            logger.error(f"加载管理员数据失败: {e}")
-    
-    def save_admins(self):
-        """保存管理员数据"""
-        try:
-            data = {str(admin_id): asdict(admin) for admin_id, admin in self.admin_sessions.items()}
-            with open(self.admins_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"保存管理员数据失败: {e}")
-    
-    def load_private_chats(self):
-        """加载私聊数据"""
-        try:
             if os.path.exists(self.private_chats_file):
                 with open(self.private_chats_file, 'r', encoding='utf-8') as f:
-                    data = json.load(f)
-                    for chat_data in data.values():
+                    for chat_data in json.load(f).values():
                         chat = PrivateChatRequest(**chat_data)
                         self.private_chat_requests[chat.user_id] = chat
+            
+            # 旧版本在管理员记录中保存私聊列表，没有对应请求记录的补成已接受的请求
+            for admin in self.admin_sessions.values():
+                for user_id in admin.private_chats:
+                    if user_id not in self.private_chat_requests:
+                        self.private_chat_requests[user_id] = PrivateChatRequest(
+                            user_id=user_id, username="", first_name="", admin_id=admin.user_id,
+                            request_time=datetime.now().isoformat(), status="accepted", chat_id=user_id)
         except Exception as e:
-            logger.error(f"加载私聊数据失败: {e}")
+            logger.error(f"导入旧版管理员数据失败: {e}")
+            return False
+        
+        self.save_admins()
+        self._dirty_requests.update(self.private_chat_requests)
+        try:
+            for path in paths:
+                os.replace(path, path + '.imported')
+        except OSError as e:
+            # 数据库已不为空，下次启动不会重复导入
+            logger.warning(f"重命名旧版管理员数据文件失败: {e}")
+        logger.info(f"已从旧版文件导入 {len(self.admin_sessions)} 个管理员，"
+                    f"{len(self.private_chat_requests)} 个私聊请求")
+        return True
+    
+    def _rebuild_indexes(self):
+        """按当前的字典重建二级索引（加载和导入后调用）"""
+        self._admins_by_username = {}
+        self._requests_by_admin = {}
+        self._requests_by_status = {}
+        for admin in self.admin_sessions.values():
+            admin.private_chats = []
+            self._index_admin(admin)
+        for request in self.private_chat_requests.values():
+            self._index_request(request)
+        self.router.rebuild()
+    
+    def get_admin_load(self, admin_id: int) -> int:
+        """管理员的负载：进行中的私聊数加待处理的请求数"""
+        admin = self.admin_sessions.get(admin_id)
+        if admin is None:
+            return 0
+        return len(admin.private_chats) + len(self._requests_by_admin.get((admin_id, "pending"), ()))
+    
+    @staticmethod
+    def has_capacity(admin: AdminInfo) -> bool:
+        """管理员是否还能接受新的私聊"""
+        return len(admin.private_chats) < admin.max_private_chats
+    
+    def _index_admin(self, admin: AdminInfo):
+        """把管理员加入用户名索引"""
+        self._admins_by_username.setdefault(admin.username, {})[admin.user_id] = admin
+    
+    def _unindex_admin(self, admin: AdminInfo):
+        """把管理员移出用户名索引"""
+        admins = self._admins_by_username.get(admin.username)
+        if admins is not None:
+            admins.pop(admin.user_id, None)
+            if not admins:
+                del self._admins_by_username[admin.username]
+    
+    def _index_request(self, request: PrivateChatRequest):
+        """把私聊请求加入按管理员和按状态的索引，已接受的请求加入管理员的私聊列表"""
+        self._requests_by_admin.setdefault((request.admin_id, request.status), {})[request.user_id] = request
+        self._requests_by_status.setdefault(request.status, {})[request.user_id] = request
+        if request.status == "accepted":
+            admin = self.admin_sessions.get(request.admin_id)
+            if admin is not None and request.user_id not in admin.private_chats:
+                admin.private_chats.append(request.user_id)
+    
+    def _unindex_request(self, request: PrivateChatRequest):
+        """把私聊请求移出索引，空的分组一并删除"""
+        for index, key in ((self._requests_by_admin, (request.admin_id, request.status)),
+                           (self._requests_by_status, request.status)):
+            requests = index.get(key)
+            if requests is not None:
+                requests.pop(request.user_id, None)
+                if not requests:
+                    del index[key]
+        if request.status == "accepted":
+            admin = self.admin_sessions.get(request.admin_id)
+            if admin is not None and request.user_id in admin.private_chats:
+                admin.private_chats.remove(request.user_id)
+    
+    def _store_request(self, request: PrivateChatRequest):
+        """保存私聊请求并更新索引，替换同一用户的旧请求"""
+        self._drop_request(request.user_id)
+        self.private_chat_requests[request.user_id] = request
+        self._absent_requests.discard(request.user_id)
+        self._index_request(request)
+    
+    def _drop_request(self, user_id: int):
+        """删除私聊请求并更新索引"""
+        request = self.private_chat_requests.pop(user_id, None)
+        if request is not None:
+            self._unindex_request(request)
+    
+    def _apply_request(self, row: Dict) -> PrivateChatRequest:
+        """用数据库返回的请求替换缓存中同一用户的请求"""
+        previous = self.private_chat_requests.get(row['user_id'])
+        request = PrivateChatRequest(**row)
+        if request == previous:
+            # 没有变化时保留缓存中的对象，也不需要更新分配堆
+            return previous
+        self._store_request(request)
+        if previous is not None and previous.admin_id != request.admin_id:
+            self.router.touch(previous.admin_id)
+        self.router.touch(request.admin_id)
+        return request
+    
+    def _forget_request(self, user_id: int, absent: bool = True):
+        """从缓存中删除用户的请求；absent 表示已确认数据库中该用户没有请求"""
+        request = self.private_chat_requests.get(user_id)
+        if request is not None:
+            self._drop_request(user_id)
+            self.router.touch(request.admin_id)
+        if not absent:
+            return
+        if len(self._absent_requests) >= ABSENT_REQUEST_LIMIT:
+            self._absent_requests.clear()
+        self._absent_requests.add(user_id)
     
-    def save_private_chats(self):
-        """保存私聊数据"""
+    async def _sync_request(self, user_id: int) -> Optional[PrivateChatRequest]:
+        """从数据库重新读取用户的私聊请求，条件写入失败说明缓存已过期"""
+        if user_id in self._dirty_requests:
+            # 本进程还没写入的修改以内存为准
+            return self.private_chat_requests.get(user_id)
+        rows = await db.get_private_chat_requests(user_id=user_id)
+        if rows is None:
+            return self.private_chat_requests.get(user_id)
+        if rows:
+            return self._apply_request(rows[0])
+        self._forget_request(user_id)
+        return None
+    
+    async def _sync_admin_requests(self, admin_id: int, status: str) -> List[PrivateChatRequest]:
+        """从数据库读取管理员某一状态的全部请求，使用 (admin_id, status) 索引，并同步到缓存"""
+        cached = self._requests_by_admin.get((admin_id, status), {})
+        rows = await db.get_private_chat_requests(admin_id, status)
+        if rows is None:
+            return list(cached.values())
+        
+        current = {row['user_id'] for row in rows}
+        for user_id in [user_id for user_id in cached if user_id not in current]:
+            if user_id not in self._dirty_requests:
+                # 请求可能已转给其他管理员，不能记为没有请求
+                self._forget_request(user_id, absent=False)
+        return [self._apply_request(row) for row in rows]
+    
+    def save_admins(self):
+        """标记全部管理员为新建，数据库中还没有的管理员会被插入"""
+        self._mark_dirty(admin_ids=self.admin_sessions, added=True)
+    
+    def _mark_dirty(self, admin_ids=(), user_ids=(), added: bool = False):
+        """标记修改过的管理员和私聊请求，由定时器合并为一次写入；
+        没有运行中的事件循环时只做标记，由之后的 flush() 写入"""
+        self._dirty_admins.update(admin_ids)
+        self._dirty_requests.update(user_ids)
+        if added:
+            self._added_admins.update(admin_ids)
         try:
-            data = {str(chat.user_id): asdict(chat) for chat in self.private_chat_requests.values()}
-            with open(self.private_chats_file, 'w', encoding='utf-8') as f:
-                json.dump(data, f, ensure_ascii=False, indent=2)
-        except Exception as e:
-            logger.error(f"保存私聊数据失败: {e}")
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return
+        
+        if self._save_timer is None:
+            self._save_timer = loop.call_later(self.save_delay, self._start_save)
+    
+    def _start_save(self):
+        """在后台任务中写入修改"""
+        self._save_timer = None
+        task = asyncio.create_task(self.flush())
+        self._save_tasks.add(task)
+        task.add_done_callback(self._save_tasks.discard)
+    
+    async def flush(self):
+        """把修改过的管理员和私聊请求写入数据库（机器人停止时调用）"""
+        if self._save_timer is not None:
+            self._save_timer.cancel()
+            self._save_timer = None
+        if self._save_lock is None:
+            self._save_lock = asyncio.Lock()
+        
+        # 同一键的写入必须按顺序完成，否则旧状态可能覆盖新状态
+        async with self._save_lock:
+            admin_ids, self._dirty_admins = self._dirty_admins, set()
+            user_ids, self._dirty_requests = self._dirty_requests, set()
+            added_ids, self._added_admins = self._added_admins, set()
+            if not admin_ids and not user_ids:
+                return
+            
+            # 写入时读取当前状态，字典中已不存在的键即为删除
+            added_admins = [asdict(self.admin_sessions[i]) for i in admin_ids
+                            if i in self.admin_sessions and i in added_ids]
+            admins = [asdict(self.admin_sessions[i]) for i in admin_ids
+                      if i in self.admin_sessions and i not in added_ids]
+            deleted_admins = [i for i in admin_ids if i not in self.admin_sessions]
+            requests = [asdict(self.private_chat_requests[i]) for i in user_ids if i in self.private_chat_requests]
+            deleted_requests = [i for i in user_ids if i not in self.private_chat_requests]
+            
+            if not await db.save_admin_state(added_admins, admins, deleted_admins, requests, deleted_requests):
+                # 留到下次保存时重试
+                self._dirty_admins |= admin_ids
+                self._dirty_requests |= user_ids
+                self._added_admins |= added_ids
     
     def is_admin(self, user_id: int) -> bool:
         """检查用户是否为管理员"""
@@ -168,68 +556,129 @@ class AdminManager:
         )
         
         self.admin_sessions[user.id] = admin
-        self.save_admins()
+        self._index_admin(admin)
+        self.router.touch(user.id)
+        self._mark_dirty(admin_ids=[user.id], added=True)
         logger.info(f"已添加管理员: {user.id} ({user.first_name})")
         return True
     
-    def remove_admin(self, admin_id: int) -> bool:
-        """移除管理员"""
+    async def remove_admin(self, admin_id: int) -> Tuple[bool, List[PrivateChatRequest], List[PrivateChatRequest]]:
+        """移除管理员，返回 (是否成功, 转给其他管理员的请求, 被取消的请求和私聊)
+        
+        发给该管理员的待处理请求按自动分配的规则转给其他管理员，转交与创建请求
+        一样是数据库中的条件写入；没有可用的管理员时删除请求。已接受的私聊结束。
+        """
         if admin_id not in self.admin_sessions:
-            return False
+            return False, [], []
         
         # 超级管理员不能移除自己
         if self.admin_sessions[admin_id].is_super_admin:
-            return False
+            return False, [], []
         
-        # 清理私聊
-        admin = self.admin_sessions[admin_id]
-        for chat_id in admin.private_chats:
-            if chat_id in self.private_chat_requests:
-                del self.private_chat_requests[chat_id]
+        # 以数据库为准读取该管理员的私聊和待处理请求
+        accepted = await self._sync_admin_requests(admin_id, "accepted")
+        pending = await self._sync_admin_requests(admin_id, "pending")
         
-        del self.admin_sessions[admin_id]
-        self.save_admins()
-        self.save_private_chats()
-        logger.info(f"已移除管理员: {admin_id}")
-        return True
+        admin = self.admin_sessions.pop(admin_id)
+        self._unindex_admin(admin)
+        self.router.touch(admin_id)
+        # 先删除管理员行，其他进程刷新后不再把新请求发给他
+        self._mark_dirty(admin_ids=[admin_id])
+        await self.flush()
+        
+        cancelled = []
+        for request in accepted:
+            if await db.delete_private_chat_request(request.user_id, admin_id, "accepted"):
+                self._forget_request(request.user_id)
+                cancelled.append(request)
+            else:
+                await self._sync_request(request.user_id)
+        
+        requeued = []
+        for request in pending:
+            target, sticky = self.router.assign(request.user_id)
+            if target is not None:
+                row = await db.reassign_private_chat_request(
+                    request.user_id, admin_id, target.user_id, datetime.now().isoformat(),
+                    target.max_private_chats)
+                if row is not None:
+                    requeued.append(self._apply_request(row))
+                    self.router.record_assignment(target.user_id, sticky)
+                    continue
+            
+            if await db.delete_private_chat_request(request.user_id, admin_id, "pending"):
+                self._forget_request(request.user_id)
+                cancelled.append(request)
+            else:
+                # 其他进程已经处理了这个请求
+                await self._sync_request(request.user_id)
+        
+        logger.info(f"已移除管理员: {admin_id}，转交 {len(requeued)} 个待处理请求，"
+                    f"取消 {len(cancelled)} 个请求和私聊")
+        return True, requeued, cancelled
     
     def update_admin_activity(self, admin_id: int):
         """更新管理员活动时间"""
-        if admin_id in self.admin_sessions:
-            self.admin_sessions[admin_id].last_active = datetime.now().isoformat()
-            self.admin_sessions[admin_id].is_online = True
-            self.save_admins()
+        admin = self.admin_sessions.get(admin_id)
+        if admin:
+            was_online = self.is_admin_online(admin)
+            admin.last_active = datetime.now().isoformat()
+            admin.is_online = True
+            if not was_online:
+                self.router.touch(admin_id)
+            self._mark_dirty(admin_ids=[admin_id])
+    
+    @staticmethod
+    def is_admin_online(admin: AdminInfo) -> bool:
+        """管理员在 ADMIN_ONLINE_TIMEOUT 秒内有过活动即视为在线"""
+        if not admin.is_online:
+            return False
+        try:
+            last_active = datetime.fromisoformat(admin.last_active)
+        except (TypeError, ValueError):
+            return False
+        return datetime.now() - last_active < timedelta(seconds=config.ADMIN_ONLINE_TIMEOUT)
     
     def get_available_admins(self) -> List[AdminInfo]:
         """获取可用的管理员列表"""
-        available = []
-        for admin in self.admin_sessions.values():
-            if len(admin.private_chats) < admin.max_private_chats:
-                available.append(admin)
-        return available
+        return [admin for admin in self.admin_sessions.values() if self.has_capacity(admin)]
     
-    def get_admin_by_username(self, username: str) -> Optional[AdminInfo]:
-        """根据用户名获取管理员"""
-        for admin in self.admin_sessions.values():
-            if admin.username == username:
-                return admin
-        return None
+    async def get_admin_by_username(self, username: str) -> Optional[AdminInfo]:
+        """根据用户名获取管理员，同名时返回最早加入的；先查内存中的用户名索引，
+        未命中时再查数据库，可以找到其他进程刚添加的管理员"""
+        admins = self._admins_by_username.get(username)
+        if admins:
+            return min(admins.values(), key=lambda admin: (admin.join_date, admin.user_id))
+        
+        row = await db.get_admin_by_username(username)
+        if row is None:
+            return None
+        return self.admin_sessions.get(row['user_id']) or AdminInfo(**row, private_chats=[])
+    
+    async def get_private_chat_request(self, user_id: int, refresh: bool = False) -> Optional[PrivateChatRequest]:
+        """获取用户当前的私聊请求
+        
+        每条用户消息都会调用，缓存中已接受的私聊和已确认没有请求的用户直接返回；
+        缓存未命中、请求仍待处理（状态可能已被其他进程修改）或 refresh 为 True 时
+        才读取数据库。其他进程结束的私聊在下次 refresh() 时同步。
+        """
+        if not refresh and user_id not in self._dirty_requests:
+            request = self.private_chat_requests.get(user_id)
+            if request is not None and request.status != "pending":
+                return request
+            if request is None and user_id in self._absent_requests:
+                return None
+        return await self._sync_request(user_id)
     
-    def request_private_chat(self, user: User, admin_id: int) -> Tuple[bool, str]:
-        """请求私聊"""
+    async def request_private_chat(self, user: User, admin_id: int) -> Tuple[bool, str]:
+        """请求私聊；用户是否已有请求、管理员是否已满由数据库在插入时检查"""
         if not config.ENABLE_PRIVATE_CHAT:
             return False, "私聊功能已禁用"
         
-        if user.id in self.private_chat_requests:
-            return False, "您已有待处理的私聊请求"
-        
         admin = self.admin_sessions.get(admin_id)
         if not admin:
             return False, "指定的管理员不存在"
         
-        if len(admin.private_chats) >= admin.max_private_chats:
-            return False, "该管理员当前私聊数量已达上限"
-        
         # 创建私聊请求
         request = PrivateChatRequest(
             user_id=user.id,
@@ -240,107 +689,92 @@ class AdminManager:
             status="pending"
         )
         
-        self.private_chat_requests[user.id] = request
-        self.save_private_chats()
+        if not await db.create_private_chat_request(asdict(request), admin.max_private_chats):
+            # 其他进程可能已经创建了该用户的请求或占满了该管理员的私聊，按数据库纠正缓存
+            if await self._sync_request(user.id) is not None:
+                return False, "您已有待处理的私聊请求"
+            await self._sync_admin_requests(admin_id, "accepted")
+            return False, "该管理员当前私聊数量已达上限"
         
+        self._apply_request(asdict(request))
         logger.info(f"用户 {user.id} 请求与管理员 {admin_id} 私聊")
         return True, "私聊请求已发送，请等待管理员回复"
     
-    def accept_private_chat(self, admin_id: int, user_id: int) -> bool:
-        """接受私聊请求"""
-        if user_id not in self.private_chat_requests:
-            return False
-        
-        request = self.private_chat_requests[user_id]
-        if request.admin_id != admin_id:
+    async def accept_private_chat(self, admin_id: int, user_id: int) -> bool:
+        """接受私聊请求，只有发给该管理员且仍待处理的请求可以接受"""
+        row = await db.update_private_chat_status(user_id, admin_id, "pending", "accepted")
+        if row is None:
+            await self._sync_request(user_id)
             return False
         
-        if request.status != "pending":
-            return False
-        
-        # 更新请求状态
-        request.status = "accepted"
-        request.chat_id = user_id
-        
-        # 添加到管理员的私聊列表
-        admin = self.admin_sessions.get(admin_id)
-        if admin and user_id not in admin.private_chats:
-            admin.private_chats.append(user_id)
-        
-        self.save_private_chats()
-        self.save_admins()
+        request = self._apply_request(row)
+        self.router.record_response(request)
+        self.router.remember(user_id, admin_id)
         
         logger.info(f"管理员 {admin_id} 接受了用户 {user_id} 的私聊请求")
         return True
     
-    def reject_private_chat(self, admin_id: int, user_id: int) -> bool:
-        """拒绝私聊请求"""
-        if user_id not in self.private_chat_requests:
-            return False
-        
-        request = self.private_chat_requests[user_id]
-        if request.admin_id != admin_id:
+    async def reject_private_chat(self, admin_id: int, user_id: int) -> bool:
+        """拒绝私聊请求，只有发给该管理员且仍待处理的请求可以拒绝"""
+        row = await db.update_private_chat_status(user_id, admin_id, "pending", "rejected")
+        if row is None:
+            await self._sync_request(user_id)
             return False
         
-        request.status = "rejected"
-        self.save_private_chats()
+        request = self._apply_request(row)
+        self.router.record_response(request)
         
         logger.info(f"管理员 {admin_id} 拒绝了用户 {user_id} 的私聊请求")
         return True
     
-    def end_private_chat(self, admin_id: int, user_id: int) -> bool:
+    async def end_private_chat(self, admin_id: int, user_id: int) -> bool:
         """结束私聊"""
-        admin = self.admin_sessions.get(admin_id)
-        if not admin or user_id not in admin.private_chats:
+        if not await db.delete_private_chat_request(user_id, admin_id, "accepted"):
+            await self._sync_request(user_id)
             return False
         
-        # 从管理员私聊列表中移除
-        admin.private_chats.remove(user_id)
-        
-        # 清理私聊请求
-        if user_id in self.private_chat_requests:
-            del self.private_chat_requests[user_id]
-        
-        self.save_admins()
-        self.save_private_chats()
-        
+        self._forget_request(user_id)
         logger.info(f"管理员 {admin_id} 结束了与用户 {user_id} 的私聊")
         return True
     
-    def get_pending_requests(self, admin_id: int) -> List[PrivateChatRequest]:
-        """获取待处理的私聊请求"""
-        pending = []
-        for request in self.private_chat_requests.values():
-            if request.admin_id == admin_id and request.status == "pending":
-                pending.append(request)
-        return pending
-    
-    def cleanup_expired_requests(self, expire_hours: int = 24):
-        """清理过期的私聊请求"""
-        current_time = datetime.now()
-        expired_users = []
+    async def assign_private_chat(self, user: User) -> Tuple[bool, str, Optional[int]]:
+        """自动把私聊请求分配给负载最低的管理员，返回 (是否成功, 提示, 管理员ID)"""
+        if not config.ENABLE_PRIVATE_CHAT:
+            return False, "私聊功能已禁用", None
         
-        for user_id, request in self.private_chat_requests.items():
-            if request.status == "pending":
-                request_time = datetime.fromisoformat(request.request_time)
-                if current_time - request_time > timedelta(hours=expire_hours):
-                    expired_users.append(user_id)
+        admin, sticky = self.router.assign(user.id)
+        if admin is None:
+            return False, "当前没有可用的管理员，请稍后再试", None
         
-        for user_id in expired_users:
-            del self.private_chat_requests[user_id]
+        success, message = await self.request_private_chat(user, admin.user_id)
+        if not success:
+            return False, message, None
+        self.router.record_assignment(admin.user_id, sticky)
+        return True, message, admin.user_id
+    
+    async def get_pending_requests(self, admin_id: int) -> List[PrivateChatRequest]:
+        """获取待处理的私聊请求，从数据库的 (管理员, 状态) 索引读取，数据库不可用时读缓存"""
+        return await self._sync_admin_requests(admin_id, "pending")
+    
+    async def cleanup_expired_requests(self, expire_hours: int = 24):
+        """清理过期的私聊请求（只有待处理的请求会过期）"""
+        cutoff = (datetime.now() - timedelta(hours=expire_hours)).isoformat()
+        expired = await db.expire_private_chat_requests(cutoff)
+        if not expired:
+            return
         
-        if expired_users:
-            self.save_private_chats()
-            logger.info(f"已清理 {len(expired_users)} 个过期的私聊请求")
+        for row in expired:
+            self._forget_request(row['user_id'])
+        logger.info(f"已清理 {len(expired)} 个过期的私聊请求")
     
     def get_admin_stats(self) -> Dict:
         """获取管理员统计信息"""
         stats = {
             "total_admins": len(self.admin_sessions),
             "super_admins": len([a for a in self.admin_sessions.values() if a.is_super_admin]),
-            "online_admins": len([a for a in self.admin_sessions.values() if a.is_online]),
+            "online_admins": len([a for a in self.admin_sessions.values() if self.is_admin_online(a)]),
             "total_private_chats": sum(len(a.private_chats) for a in self.admin_sessions.values()),
-            "pending_requests": len([r for r in self.private_chat_requests.values() if r.status == "pending"])
+            "pending_requests": len(self._requests_by_status.get("pending", {}))
         }
         return stats
 
@@ -13,11 +13,13 @@ from telegram.ext import (
 from telegram.constants import ParseMode
 
 import config
+from database import db
+from admin_manager import admin_manager
 from handlers import (
     handle_start, handle_help, handle_echo, handle_photo, handle_video,
     handle_audio, handle_document, handle_voice, handle_contact,
     handle_location, handle_sticker, handle_animation, handle_contact_callback,
-    handle_admin, handle_chat, handle_stats, handle_addadmin, handle_removeadmin,
+    handle_admin, handle_chat, handle_stats, handle_inbox, handle_search, handle_addadmin, handle_removeadmin,
     handle_reply_message, handle_admin_reply, handle_view_history, 
     handle_start_private, handle_user_stats, handle_update_check,
     handle_perform_update, handle_generate_install_script, handle_script_generation
@@ -32,9 +34,58 @@ logger = logging.getLogger(__name__)
 
 class TelegramBot:
     def __init__(self):
-        self.application = Application.builder().token(config.BOT_TOKEN).build()
+        self.application = (
+            Application.builder()
+            .token(config.BOT_TOKEN)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+            .build()
+        )
+        self.retention_task: Optional[asyncio.Task] = None
+        self.admin_refresh_task: Optional[asyncio.Task] = None
         self.setup_handlers()
 
+    async def on_startup(self, application: Application):
+        """启动钩子：打开数据库连接池，加载管理员数据并启动后台任务"""
+        await db.connect()
+        await admin_manager.load()
+        if config.RETENTION_INTERVAL > 0:
+            self.retention_task = asyncio.create_task(self.retention_loop())
+        if config.ADMIN_STATE_REFRESH_INTERVAL > 0:
+            self.admin_refresh_task = asyncio.create_task(self.admin_refresh_loop())
+
+    async def on_shutdown(self, application: Application):
+        """停止钩子：停止后台任务，写入管理员数据并关闭数据库连接池"""
+        for task in (self.retention_task, self.admin_refresh_task):
+            if task is not None:
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+        self.retention_task = None
+        self.admin_refresh_task = None
+        await admin_manager.flush()
+        await db.close()
+
+    async def retention_loop(self):
+        """定期删除过期数据并分步回收空闲页"""
+        while True:
+            await asyncio.sleep(config.RETENTION_INTERVAL)
+            try:
+                await db.run_retention()
+            except NotImplementedError as e:
+                logger.info(f"数据保留任务已停止: {e}")
+                return
+            except Exception as e:
+                logger.error(f"执行数据保留策略失败: {e}")
+
+    async def admin_refresh_loop(self):
+        """定期重新加载管理员数据，获取其他机器人进程的修改"""
+        while True:
+            await asyncio.sleep(config.ADMIN_STATE_REFRESH_INTERVAL)
+            try:
+                await admin_manager.refresh()
+            except Exception as e:
+                logger.error(f"刷新管理员数据失败: {e}")
+
     def setup_handlers(self):
         """设置所有消息处理器"""
         # Command handlers
@@ -47,6 +98,8 @@ class TelegramBot:
         self.application.add_handler(CommandHandler("admin", handle_admin))
         self.application.add_handler(CommandHandler("chat", handle_chat))
         self.application.add_handler(CommandHandler("stats", handle_stats))
+        self.application.add_handler(CommandHandler("inbox", handle_inbox))
+        self.application.add_handler(CommandHandler("search", handle_search))
         self.application.add_handler(CommandHandler("addadmin", handle_addadmin))
         self.application.add_handler(CommandHandler("removeadmin", handle_removeadmin))
         
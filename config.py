@@ -20,6 +20,24 @@ SUPER_ADMIN_ID = int(os.getenv('SUPER_ADMIN_ID', '0')) if os.getenv('SUPER_ADMIN
 # 私聊配置
 ENABLE_PRIVATE_CHAT = os.getenv('ENABLE_PRIVATE_CHAT', 'true').lower() == 'true'
 MAX_PRIVATE_CHATS_PER_ADMIN = int(os.getenv('MAX_PRIVATE_CHATS_PER_ADMIN', '10'))
+# /chat 自动分配负载最低的管理员，而不是让用户选择；粘性分配时老用户优先回到上次的管理员
+PRIVATE_CHAT_AUTO_ASSIGN = os.getenv('PRIVATE_CHAT_AUTO_ASSIGN', 'false').lower() == 'true'
+PRIVATE_CHAT_STICKY = os.getenv('PRIVATE_CHAT_STICKY', 'true').lower() == 'true'
+# 管理员超过该秒数没有活动即视为离线，自动分配时排在在线管理员之后
+ADMIN_ONLINE_TIMEOUT = int(os.getenv('ADMIN_ONLINE_TIMEOUT', '900'))
+
+# 管理员和私聊数据的修改在该时间（毫秒）内合并为一次数据库事务，0 表示当前事件处理完后立即写入
+ADMIN_SAVE_DELAY_MS = int(os.getenv('ADMIN_SAVE_DELAY_MS', '0'))
+# 每隔该秒数重新加载其他机器人进程对管理员列表和负载的修改，0 表示不刷新
+# （私聊请求的状态变化总是直接在数据库中判断，不依赖刷新）
+ADMIN_STATE_REFRESH_INTERVAL = int(os.getenv('ADMIN_STATE_REFRESH_INTERVAL', '60'))
+
+# 管理员查看聊天历史时每页显示的消息数
+HISTORY_PAGE_SIZE = int(os.getenv('HISTORY_PAGE_SIZE', '10'))
+
+# 管理员收件箱：每次认领的未回复消息数，以及认领超时（秒）
+INBOX_CLAIM_SIZE = int(os.getenv('INBOX_CLAIM_SIZE', '10'))
+UNREPLIED_CLAIM_TIMEOUT = int(os.getenv('UNREPLIED_CLAIM_TIMEOUT', '600'))
 
 # 支持的文件类型
 SUPPORTED_PHOTO_FORMATS = ['.jpg', '.jpeg', '.png', '.gif', '.webp']
@@ -29,6 +47,55 @@ SUPPORTED_DOCUMENT_FORMATS = ['.pdf', '.doc', '.docx', '.txt', '.zip', '.rar']
 
 # 数据库配置
 DATABASE_URL = os.getenv('DATABASE_URL', 'data/bot.db')
+DB_READ_POOL_SIZE = int(os.getenv('DB_READ_POOL_SIZE', '4'))
+DB_WRITE_BATCH_LIMIT = int(os.getenv('DB_WRITE_BATCH_LIMIT', '64'))  # 写任务单次事务最多合并的操作数
+DB_BATCH_MAX_SIZE = int(os.getenv('DB_BATCH_MAX_SIZE', '500'))  # 写缓冲达到该条数立即落盘
+DB_BATCH_MAX_DELAY_MS = int(os.getenv('DB_BATCH_MAX_DELAY_MS', '200'))  # 写缓冲最长等待时间（毫秒）
+DB_SLOW_QUERY_MS = int(os.getenv('DB_SLOW_QUERY_MS', '200'))  # 数据库方法耗时超过该值时记录慢查询日志和查询计划
+
+# 导出导入时每块读写的行数
+EXPORT_CHUNK_SIZE = int(os.getenv('EXPORT_CHUNK_SIZE', '5000'))
+
+# 用户信息读缓存：最多缓存的用户数和过期时间（秒）
+USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+
+# PostgreSQL 连接池大小（DATABASE_URL 为 postgresql:// 时使用）
+PG_POOL_MIN_SIZE = int(os.getenv('PG_POOL_MIN_SIZE', '1'))
+PG_POOL_MAX_SIZE = int(os.getenv('PG_POOL_MAX_SIZE', '10'))
+
+# 冷数据归档：已回复且超过指定天数的消息按月移入归档库
+ARCHIVE_DIR = os.getenv('ARCHIVE_DIR', 'data/archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', '90'))
+ARCHIVE_BATCH_SIZE = int(os.getenv('ARCHIVE_BATCH_SIZE', '500'))  # 每个写事务归档的消息数
+
+# 数据保留：按消息类型的保留天数，如 "photo:30,video:30,*:365"，* 表示其它类型，
+# 未配置或为 0 的类型永久保留
+RETENTION_DAYS = {
+    name.strip(): int(days)
+    for name, days in (item.split(':', 1) for item in os.getenv('RETENTION_DAYS', '').split(',') if ':' in item)
+    if days.strip().isdigit()
+}
+UPDATE_KEEP_VERSIONS = int(os.getenv('UPDATE_KEEP_VERSIONS', '0'))  # 只保留最新的若干条更新记录，0 表示全部保留
+RETENTION_INTERVAL = int(os.getenv('RETENTION_INTERVAL', '3600'))  # 后台执行间隔（秒），0 表示不在后台执行
+RETENTION_BATCH_SIZE = int(os.getenv('RETENTION_BATCH_SIZE', '500'))  # 每个写事务删除的消息数
+RETENTION_BATCH_DELAY_MS = int(os.getenv('RETENTION_BATCH_DELAY_MS', '100'))  # 批次之间的暂停（毫秒）
+RETENTION_VACUUM_PAGES = int(os.getenv('RETENTION_VACUUM_PAGES', '1000'))  # 每步增量回收的页数
+
+# 在线备份：备份目录、每步复制的页数和步间暂停（毫秒）
+BACKUP_DIR = os.getenv('BACKUP_DIR', 'data/backups')
+BACKUP_PAGES_PER_STEP = int(os.getenv('BACKUP_PAGES_PER_STEP', '1024'))
+BACKUP_STEP_SLEEP_MS = int(os.getenv('BACKUP_STEP_SLEEP_MS', '5'))
+
+# SQLite PRAGMA 配置（每个连接打开时应用）
+SQLITE_PRAGMAS = {
+    'journal_mode': os.getenv('SQLITE_JOURNAL_MODE', 'WAL'),
+    'synchronous': os.getenv('SQLITE_SYNCHRONOUS', 'NORMAL'),
+    'mmap_size': int(os.getenv('SQLITE_MMAP_SIZE', str(128 * 1024 * 1024))),  # 128MB
+    'cache_size': int(os.getenv('SQLITE_CACHE_SIZE', '-16000')),  # 负数表示KB，约16MB
+    'busy_timeout': int(os.getenv('SQLITE_BUSY_TIMEOUT', '5000')),  # 毫秒
+    'temp_store': os.getenv('SQLITE_TEMP_STORE', 'MEMORY'),
+}
 
 # 更新配置
 UPDATE_CHECK_URL = os.getenv('UPDATE_CHECK_URL', '')
@@ -0,0 +1,184 @@
+"""
+消息存储的流式导出导入
+
+每张表写成一个文件，按块读写，内存占用与数据量无关。安装了 pyarrow 时
+支持 Parquet 和 Arrow IPC 格式，否则使用 gzip 压缩的 NDJSON。
+"""
+
+import os
+import gzip
+import json
+import asyncio
+import logging
+from typing import List, Dict, Optional, Tuple, Iterator
+
+try:
+    import pyarrow as pa
+    import pyarrow.ipc
+    import pyarrow.parquet as pq
+except ImportError:  # 没有 pyarrow 时只能使用 NDJSON
+    pa = None
+
+import config
+from database import BaseDatabase, TABLE_COLUMNS
+
+logger = logging.getLogger(__name__)
+
+# 按依赖顺序导入：回复的全文索引需要先有对应的消息
+TRANSFER_TABLES = ['users', 'messages', 'replies']
+
+FORMAT_EXTENSIONS = {
+    'parquet': '.parquet',
+    'arrow': '.arrow',
+    'ndjson': '.ndjson.gz',
+}
+
+BOOL_COLUMNS = {'is_blocked', 'is_replied', 'is_read'}
+TEXT_COLUMNS = {'username', 'first_name', 'last_name', 'block_reason', 'message_type',
+                'content', 'file_id', 'file_path'}
+
+def default_format() -> str:
+    """安装了 pyarrow 时默认使用 Parquet"""
+    return 'parquet' if pa is not None else 'ndjson'
+
+def table_path(directory: str, table: str, fmt: str) -> str:
+    """表对应的导出文件"""
+    return os.path.join(directory, table + FORMAT_EXTENSIONS[fmt])
+
+def detect_format(directory: str, table: str) -> Optional[str]:
+    """根据目录中已有的文件判断表的导出格式"""
+    for fmt in FORMAT_EXTENSIONS:
+        if os.path.exists(table_path(directory, table, fmt)):
+            return fmt
+    return None
+
+def normalize_rows(table: str, rows: List[Tuple]) -> List[Dict]:
+    """把数据库行转换为字典，SQLite 的 0/1 统一转换为布尔值"""
+    columns = TABLE_COLUMNS[table]
+    records = []
+    for row in rows:
+        record = dict(zip(columns, row))
+        for column in BOOL_COLUMNS.intersection(record):
+            if record[column] is not None:
+                record[column] = bool(record[column])
+        records.append(record)
+    return records
+
+def arrow_schema(table: str):
+    """表的 Arrow 结构"""
+    fields = []
+    for column in TABLE_COLUMNS[table]:
+        if column in BOOL_COLUMNS:
+            fields.append(pa.field(column, pa.bool_()))
+        elif column in TEXT_COLUMNS:
+            fields.append(pa.field(column, pa.string()))
+        else:
+            fields.append(pa.field(column, pa.int64()))
+    return pa.schema(fields)
+
+class ChunkWriter:
+    """按块追加写入一张表的导出文件"""
+    
+    def __init__(self, path: str, table: str, fmt: str):
+        self.table = table
+        self.fmt = fmt
+        if fmt == 'ndjson':
+            self._file = gzip.open(path, 'wt', encoding='utf-8')
+        elif fmt == 'parquet':
+            self.schema = arrow_schema(table)
+            self._file = pq.ParquetWriter(path, self.schema, compression='zstd')
+        else:
+            self.schema = arrow_schema(table)
+            self._sink = pa.OSFile(path, 'wb')
+            self._file = pa.ipc.new_file(self._sink, self.schema,
+                                         options=pa.ipc.IpcWriteOptions(compression='zstd'))
+    
+    def write(self, rows: List[Tuple]):
+        """写入一块行（Parquet 每块一个行组）"""
+        records = normalize_rows(self.table, rows)
+        if self.fmt == 'ndjson':
+            for record in records:
+                self._file.write(json.dumps(record, ensure_ascii=False) + '\n')
+        elif self.fmt == 'parquet':
+            self._file.write_table(pa.Table.from_pylist(records, schema=self.schema))
+        else:
+            self._file.write_batch(pa.RecordBatch.from_pylist(records, schema=self.schema))
+    
+    def close(self):
+        """结束写入"""
+        self._file.close()
+        if self.fmt == 'arrow':
+            self._sink.close()
+
+def read_chunks(path: str, table: str, fmt: str, chunk_size: int) -> Iterator[List[Tuple]]:
+    """按块读取导出文件，生成按 TABLE_COLUMNS 排列的行"""
+    columns = TABLE_COLUMNS[table]
+    
+    def to_rows(records: List[Dict]) -> List[Tuple]:
+        return [tuple(record.get(column) for column in columns) for record in records]
+    
+    if fmt == 'ndjson':
+        with gzip.open(path, 'rt', encoding='utf-8') as f:
+            records = []
+            for line in f:
+                if line.strip():
+                    records.append(json.loads(line))
+                if len(records) >= chunk_size:
+                    yield to_rows(records)
+                    records = []
+            if records:
+                yield to_rows(records)
+    elif fmt == 'parquet':
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size):
+            yield to_rows(batch.to_pylist())
+    else:
+        with pa.memory_map(path) as source:
+            reader = pa.ipc.open_file(source)
+            for i in range(reader.num_record_batches):
+                yield to_rows(reader.get_batch(i).to_pylist())
+
+async def export_tables(db: BaseDatabase, directory: str, fmt: Optional[str] = None,
+                        tables: Optional[List[str]] = None,
+                        chunk_size: int = config.EXPORT_CHUNK_SIZE) -> Dict[str, int]:
+    """把表流式导出到目录，每张表一个文件，返回各表导出的行数"""
+    fmt = fmt or default_format()
+    if fmt != 'ndjson' and pa is None:
+        raise RuntimeError(f"导出 {fmt} 格式需要安装 pyarrow: pip install pyarrow")
+    
+    os.makedirs(directory, exist_ok=True)
+    counts = {}
+    for table in tables or TRANSFER_TABLES:
+        writer = ChunkWriter(table_path(directory, table, fmt), table, fmt)
+        counts[table] = 0
+        try:
+            async for rows in db.iter_table(table, chunk_size):
+                # 编码和压缩放到线程中执行，不占用事件循环
+                await asyncio.to_thread(writer.write, rows)
+                counts[table] += len(rows)
+        finally:
+            await asyncio.to_thread(writer.close)
+        logger.info(f"已导出 {table}: {counts[table]} 行")
+    return counts
+
+async def import_tables(db: BaseDatabase, directory: str, tables: Optional[List[str]] = None,
+                        chunk_size: int = config.EXPORT_CHUNK_SIZE) -> Dict[str, int]:
+    """从目录流式导入表，主键已存在的行跳过，返回各表实际写入的行数"""
+    counts = {}
+    for table in tables or TRANSFER_TABLES:
+        fmt = detect_format(directory, table)
+        if fmt is None:
+            logger.warning(f"目录 {directory} 中没有 {table} 的导出文件，已跳过")
+            continue
+        if fmt != 'ndjson' and pa is None:
+            raise RuntimeError(f"导入 {fmt} 格式需要安装 pyarrow: pip install pyarrow")
+        
+        counts[table] = 0
+        chunks = read_chunks(table_path(directory, table, fmt), table, fmt, chunk_size)
+        while True:
+            # 解压和解码放到线程中执行，每块在写任务中单独提交
+            rows = await asyncio.to_thread(next, chunks, None)
+            if rows is None:
+                break
+            counts[table] += await db.import_rows(table, rows)
+        logger.info(f"已导入 {table}: {counts[table]} 行")
+    return counts
@@ -1,26 +1,82 @@
+import os
+import gzip
+import shutil
 import sqlite3
 import json
 import logging
-from datetime import datetime
-from typing import List, Dict, Optional, Tuple
-from dataclasses import dataclass, asdict
+import asyncio
+import functools
+import time
+import tempfile
+from abc import ABC, abstractmethod
+from contextlib import asynccontextmanager
+from datetime import datetime, timezone
+from pathlib import Path
+from typing import List, Dict, Optional, Tuple, Callable, Awaitable
+from dataclasses import dataclass, asdict, field, replace
+from collections import OrderedDict
 import aiosqlite
 
+import config
+from db_metrics import ErrorCounter, TracedConnection, bind_call, instrument_methods, uninstrumented
+
 logger = logging.getLogger(__name__)
+# 方法内部捕获后记录的错误计入该方法的错误数
+logger.addHandler(ErrorCounter())
 
-@dataclass
+def now_ms() -> int:
+    """当前时间的毫秒时间戳"""
+    return int(time.time() * 1000)
+
+def to_epoch_ms(value) -> int:
+    """把 datetime、ISO 时间字符串或毫秒时间戳统一转换为毫秒时间戳"""
+    if isinstance(value, datetime):
+        return int(value.timestamp() * 1000)
+    if isinstance(value, str):
+        return int(datetime.fromisoformat(value).timestamp() * 1000) if value else 0
+    return int(value or 0)
+
+def from_epoch_ms(value: int) -> Optional[datetime]:
+    """把毫秒时间戳转换为本地时间的 datetime，0 表示未知"""
+    return datetime.fromtimestamp(value / 1000) if value else None
+
+def archive_month(timestamp_ms: int) -> str:
+    """毫秒时间戳所属的归档月份（UTC），格式为 YYYYMM"""
+    return datetime.fromtimestamp(timestamp_ms / 1000, tz=timezone.utc).strftime('%Y%m')
+
+def group_replies(rows: List[Tuple]) -> Dict[int, set]:
+    """按原消息ID把回复行分组"""
+    groups: Dict[int, set] = {}
+    for row in rows:
+        groups.setdefault(row[1], set()).add(row)
+    return groups
+
+def month_bounds(month: str) -> Tuple[int, int]:
+    """归档月份的毫秒时间范围 [开始, 结束)"""
+    year, mon = int(month[:4]), int(month[4:])
+    start = datetime(year, mon, 1, tzinfo=timezone.utc)
+    end = datetime(year + mon // 12, mon % 12 + 1, 1, tzinfo=timezone.utc)
+    return int(start.timestamp() * 1000), int(end.timestamp() * 1000)
+
+@dataclass(slots=True)
 class User:
     """用户信息"""
     user_id: int
     username: str
     first_name: str
     last_name: str
-    join_date: str
-    last_active: str
+    join_date: int  # 毫秒时间戳
+    last_active: int  # 毫秒时间戳
     is_blocked: bool = False
     block_reason: str = ""
+    
+    def join_datetime(self) -> Optional[datetime]:
+        return from_epoch_ms(self.join_date)
+    
+    def last_active_datetime(self) -> Optional[datetime]:
+        return from_epoch_ms(self.last_active)
 
-@dataclass
+@dataclass(slots=True)
 class Message:
     """消息记录"""
     message_id: int
@@ -30,11 +86,14 @@ class Message:
     content: str
     file_id: str = ""
     file_path: str = ""
-    timestamp: str = ""
+    timestamp: int = 0  # 毫秒时间戳
     is_replied: bool = False
     reply_message_id: int = 0
+    
+    def timestamp_datetime(self) -> Optional[datetime]:
+        return from_epoch_ms(self.timestamp)
 
-@dataclass
+@dataclass(slots=True)
 class Reply:
     """回复记录"""
     reply_id: int
@@ -44,10 +103,13 @@ class Reply:
     message_type: str = "text"
     file_id: str = ""
     file_path: str = ""
-    timestamp: str = ""
+    timestamp: int = 0  # 毫秒时间戳
     is_read: bool = False
+    
+    def timestamp_datetime(self) -> Optional[datetime]:
+        return from_epoch_ms(self.timestamp)
 
-@dataclass
+@dataclass(slots=True)
 class UpdateInfo:
     """更新信息"""
     version: str
@@ -57,123 +119,1626 @@ class UpdateInfo:
     is_forced: bool = False
     changelog: str = ""
 
-class Database:
-    """数据库管理器"""
-    
-    def __init__(self, db_path: str = "data/bot.db"):
-        self.db_path = db_path
-        self.init_database()
+# 带时间列的核心表结构，{table} 占位符便于迁移时重建表
+TABLE_SCHEMAS = {
+    'users': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            join_date INTEGER DEFAULT 0,
+            last_active INTEGER DEFAULT 0,
+            is_blocked INTEGER DEFAULT 0,
+            block_reason TEXT DEFAULT ''
+        )
+    ''',
+    'messages': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            message_id INTEGER PRIMARY KEY,
+            user_id INTEGER,
+            chat_id INTEGER,
+            message_type TEXT,
+            content TEXT,
+            file_id TEXT DEFAULT '',
+            file_path TEXT DEFAULT '',
+            timestamp INTEGER DEFAULT 0,
+            is_replied INTEGER DEFAULT 0,
+            reply_message_id INTEGER DEFAULT 0,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+    ''',
+    'replies': '''
+        CREATE TABLE IF NOT EXISTS {table} (
+            reply_id INTEGER PRIMARY KEY AUTOINCREMENT,
+            original_message_id INTEGER,
+            admin_id INTEGER,
+            content TEXT,
+            message_type TEXT DEFAULT 'text',
+            file_id TEXT DEFAULT '',
+            file_path TEXT DEFAULT '',
+            timestamp INTEGER DEFAULT 0,
+            is_read INTEGER DEFAULT 0,
+            FOREIGN KEY (original_message_id) REFERENCES messages (message_id)
+        )
+    ''',
+}
+
+# 旧版本以 ISO 字符串保存的时间列，迁移为毫秒时间戳
+EPOCH_COLUMNS = {
+    'users': ['join_date', 'last_active'],
+    'messages': ['timestamp'],
+    'replies': ['timestamp'],
+}
+
+# 统计计数器及其重建查询（counters 表由触发器实时维护）
+COUNTER_QUERIES = {
+    'total_users': 'SELECT COUNT(*) FROM users',
+    'total_messages': 'SELECT COUNT(*) FROM messages',
+    'total_replies': 'SELECT COUNT(*) FROM replies',
+    'unreplied_messages': 'SELECT COUNT(*) FROM messages WHERE is_replied = 0',
+}
+
+COUNTER_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_count_insert AFTER INSERT ON users
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'total_users';
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_users_count_delete AFTER DELETE ON users
+    BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'total_users';
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_count_insert AFTER INSERT ON messages
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'total_messages';
+        UPDATE counters SET value = value + 1 WHERE name = 'unreplied_messages' AND NEW.is_replied = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_count_delete AFTER DELETE ON messages
+    BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'total_messages';
+        UPDATE counters SET value = value - 1 WHERE name = 'unreplied_messages' AND OLD.is_replied = 0;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_count_replied AFTER UPDATE OF is_replied ON messages
+    WHEN (OLD.is_replied = 0) != (NEW.is_replied = 0)
+    BEGIN
+        UPDATE counters SET value = value + (CASE WHEN NEW.is_replied = 0 THEN 1 ELSE -1 END)
+        WHERE name = 'unreplied_messages';
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_replies_count_insert AFTER INSERT ON replies
+    BEGIN
+        UPDATE counters SET value = value + 1 WHERE name = 'total_replies';
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_replies_count_delete AFTER DELETE ON replies
+    BEGIN
+        UPDATE counters SET value = value - 1 WHERE name = 'total_replies';
+    END
+    ''',
+]
+
+# 可导出导入的表及其列，列顺序与数据类字段一致，第一列为按主键分块读取用的键
+TABLE_COLUMNS = {
+    'users': ['user_id', 'username', 'first_name', 'last_name', 'join_date', 'last_active',
+              'is_blocked', 'block_reason'],
+    'messages': ['message_id', 'user_id', 'chat_id', 'message_type', 'content', 'file_id',
+                 'file_path', 'timestamp', 'is_replied', 'reply_message_id'],
+    'replies': ['reply_id', 'original_message_id', 'admin_id', 'content', 'message_type',
+                'file_id', 'file_path', 'timestamp', 'is_read'],
+}
+
+# 查询时显式列出的列，顺序与数据类字段一致，行可以直接解包构造数据类
+USER_SELECT = ', '.join(TABLE_COLUMNS['users'])
+MESSAGE_SELECT = ', '.join(TABLE_COLUMNS['messages'])
+REPLY_SELECT = ', '.join(TABLE_COLUMNS['replies'])
+UPDATE_SELECT = 'version, description, download_url, release_date, is_forced, changelog'
+
+# 管理员和私聊请求表的列；管理员的私聊列表由状态为 accepted 的私聊请求得出，不单独保存
+ADMIN_COLUMNS = ['user_id', 'username', 'first_name', 'last_name', 'is_super_admin', 'join_date',
+                 'last_active', 'max_private_chats', 'is_online']
+PRIVATE_CHAT_COLUMNS = ['user_id', 'username', 'first_name', 'admin_id', 'request_time', 'status',
+                        'chat_id']
+ADMIN_SELECT = ', '.join(ADMIN_COLUMNS)
+PRIVATE_CHAT_SELECT = ', '.join(PRIVATE_CHAT_COLUMNS)
+
+# 归档计数器：由归档任务维护，get_stats 把它们计入总数
+ARCHIVE_COUNTERS = ['archived_messages', 'archived_replies']
+
+# 归档库中的表结构与热库相同，只保留分页和按消息查回复需要的索引
+ARCHIVE_TABLES = ['messages', 'replies']
+ARCHIVE_INDEXES = [
+    'CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages(user_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_replies_message_id ON replies(original_message_id)',
+]
+
+# 全文索引：消息 rowid = message_id * 2，回复 rowid = reply_id * 2 + 1
+SEARCH_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_search_insert AFTER INSERT ON messages
+    WHEN NEW.content IS NOT NULL AND NEW.content != ''
+    BEGIN
+        INSERT INTO search_index (rowid, content, user_id, timestamp)
+        VALUES (NEW.message_id * 2, NEW.content, NEW.user_id, NEW.timestamp);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_search_delete AFTER DELETE ON messages
+    BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.message_id * 2;
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_messages_search_update AFTER UPDATE OF content ON messages
+    BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.message_id * 2;
+        INSERT INTO search_index (rowid, content, user_id, timestamp)
+        SELECT NEW.message_id * 2, NEW.content, NEW.user_id, NEW.timestamp
+        WHERE NEW.content IS NOT NULL AND NEW.content != '';
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_replies_search_insert AFTER INSERT ON replies
+    WHEN NEW.content IS NOT NULL AND NEW.content != ''
+    BEGIN
+        INSERT INTO search_index (rowid, content, user_id, timestamp)
+        VALUES (NEW.reply_id * 2 + 1, NEW.content,
+                (SELECT user_id FROM messages WHERE message_id = NEW.original_message_id),
+                NEW.timestamp);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS trg_replies_search_delete AFTER DELETE ON replies
+    BEGIN
+        DELETE FROM search_index WHERE rowid = OLD.reply_id * 2 + 1;
+    END
+    ''',
+]
+
+# trigram 分词器支持中文等无空格文本的子串检索，但检索词至少需要 3 个字符
+SEARCH_MIN_TERM_LENGTH = 3
+
+def reconcile_statements() -> List[str]:
+    """生成按实际数据重建计数器的语句"""
+    return [f"INSERT OR REPLACE INTO counters (name, value) VALUES ('{name}', ({query}))"
+            for name, query in COUNTER_QUERIES.items()]
+
+def create_base_tables(conn: sqlite3.Connection):
+    """创建用户表、消息表、回复表和更新表"""
+    cursor = conn.cursor()
+    for table, schema in TABLE_SCHEMAS.items():
+        cursor.execute(schema.format(table=table))
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS updates (
+            version TEXT PRIMARY KEY,
+            description TEXT,
+            download_url TEXT,
+            release_date TEXT,
+            is_forced INTEGER DEFAULT 0,
+            changelog TEXT DEFAULT ''
+        )
+    ''')
+
+def migrate_epoch_timestamps(conn: sqlite3.Connection):
+    """把 TEXT 类型的时间列重建为 INTEGER 毫秒时间戳
     
-    def init_database(self):
-        """初始化数据库"""
+    SQLite 不能修改列类型，因此按官方流程新建表、转换复制、删除旧表并改名。
+    ISO 字符串按本地时区解析，与 datetime.now().isoformat() 写入时一致。
+    """
+    cursor = conn.cursor()
+    for table, columns in EPOCH_COLUMNS.items():
+        column_types = {row[1]: row[2].upper() for row in cursor.execute(f'PRAGMA table_info({table})')}
+        if all(column_types.get(column) == 'INTEGER' for column in columns):
+            continue
+        
+        logger.info(f"正在迁移 {table} 表的时间列为毫秒时间戳...")
+        names = list(column_types)
+        select_list = []
+        for name in names:
+            if name in columns:
+                select_list.append(f'''
+                    CASE 
+                        WHEN typeof({name}) = 'integer' THEN {name}
+                        ELSE COALESCE(CAST(ROUND((julianday({name}, 'utc') - 2440587.5) * 86400000) AS INTEGER), 0)
+                    END''')
+            else:
+                select_list.append(name)
+        
+        cursor.execute('BEGIN')
         try:
-            conn = sqlite3.connect(self.db_path)
-            cursor = conn.cursor()
-            
-            # 创建用户表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS users (
-                    user_id INTEGER PRIMARY KEY,
-                    username TEXT,
-                    first_name TEXT,
-                    last_name TEXT,
-                    join_date TEXT,
-                    last_active TEXT,
-                    is_blocked INTEGER DEFAULT 0,
-                    block_reason TEXT DEFAULT ''
-                )
-            ''')
-            
-            # 创建消息表
-            cursor.execute('''
-                CREATE TABLE IF NOT EXISTS messages (
-                    message_id INTEGER PRIMARY KEY,
-                    user_id INTEGER,
-                    chat_id INTEGER,
-                    message_type TEXT,
-                    content TEXT,
-                    file_id TEXT DEFAULT '',
-                    file_path TEXT DEFAULT '',
-                    timestamp TEXT,
-                    is_replied INTEGER DEFAULT 0,
-                    reply_message_id INTEGER DEFAULT 0,
-                    FOREIGN KEY (user_id) REFERENCES users (user_id)
-                )
+            cursor.execute(TABLE_SCHEMAS[table].format(table=f'{table}_new'))
+            cursor.execute(f'''
+                INSERT INTO {table}_new ({', '.join(names)})
+                SELECT {', '.join(select_list)} FROM {table}
             ''')
-            
-            # 创建回复表
+            # 删除旧表会一并删除其索引和触发器，稍后会重新创建
+            cursor.execute(f'DROP TABLE {table}')
+            cursor.execute(f'ALTER TABLE {table}_new RENAME TO {table}')
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+    
+    # 认领记录只是临时状态，旧格式直接重建
+    claim_types = {row[1]: row[2].upper() for row in cursor.execute('PRAGMA table_info(message_claims)')}
+    if claim_types.get('claimed_at') == 'TEXT':
+        cursor.execute('DROP TABLE message_claims')
+
+def create_counters(conn: sqlite3.Connection):
+    """创建统计计数器表及维护触发器，并按现有数据初始化"""
+    cursor = conn.cursor()
+    cursor.execute('''
+        CREATE TABLE IF NOT EXISTS counters (
+            name TEXT PRIMARY KEY,
+            value INTEGER NOT NULL DEFAULT 0
+        )
+    ''')
+    for trigger in COUNTER_TRIGGERS:
+        cursor.execute(trigger)
+    for statement in reconcile_statements():
+        cursor.execute(statement)
+    cursor.executemany('INSERT OR IGNORE INTO counters (name, value) VALUES (?, 0)',
+                       [(name,) for name in ARCHIVE_COUNTERS])
+    conn.commit()
+
+def move_private_chats_to_requests(conn: sqlite3.Connection):
+    """把 admins.private_chats 中的 JSON 列表拆成每个私聊一行（状态为 accepted 的私聊请求）
+    
+    整个列表作为一个字段保存时，多个进程各自写回自己的列表会互相覆盖。
+    """
+    columns = [row[1] for row in conn.execute('PRAGMA table_info(admins)')]
+    if 'private_chats' not in columns:
+        return
+    
+    now = datetime.now().isoformat()
+    rows = []
+    for admin_id, private_chats in conn.execute('SELECT user_id, private_chats FROM admins').fetchall():
+        for user_id in json.loads(private_chats or '[]'):
+            rows.append((user_id, admin_id, now, user_id))
+    # 已有请求记录的用户以请求记录为准
+    conn.executemany('''
+        INSERT OR IGNORE INTO private_chat_requests 
+        (user_id, username, first_name, admin_id, request_time, status, chat_id)
+        VALUES (?, '', '', ?, ?, 'accepted', ?)
+    ''', rows)
+    conn.execute('ALTER TABLE admins DROP COLUMN private_chats')
+
+def create_search_index(conn: sqlite3.Connection):
+    """创建 FTS5 全文索引及同步触发器，首次创建时导入已有数据"""
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1 FROM sqlite_master WHERE name = 'search_index'")
+    exists = cursor.fetchone() is not None
+    
+    if not exists:
+        try:
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS replies (
-                    reply_id INTEGER PRIMARY KEY AUTOINCREMENT,
-                    original_message_id INTEGER,
-                    admin_id INTEGER,
-                    content TEXT,
-                    message_type TEXT DEFAULT 'text',
-                    file_id TEXT DEFAULT '',
-                    file_path TEXT DEFAULT '',
-                    timestamp TEXT,
-                    is_read INTEGER DEFAULT 0,
-                    FOREIGN KEY (original_message_id) REFERENCES messages (message_id)
+                CREATE VIRTUAL TABLE search_index USING fts5(
+                    content, user_id UNINDEXED, timestamp UNINDEXED, tokenize = 'trigram'
                 )
             ''')
-            
-            # 创建更新表
+        except sqlite3.OperationalError:
+            # 旧版本 SQLite 没有 trigram 分词器
+            logger.warning("SQLite 不支持 trigram 分词器，全文搜索改用 unicode61")
             cursor.execute('''
-                CREATE TABLE IF NOT EXISTS updates (
-                    version TEXT PRIMARY KEY,
-                    description TEXT,
-                    download_url TEXT,
-                    release_date TEXT,
-                    is_forced INTEGER DEFAULT 0,
-                    changelog TEXT DEFAULT ''
+                CREATE VIRTUAL TABLE search_index USING fts5(
+                    content, user_id UNINDEXED, timestamp UNINDEXED
                 )
             ''')
+        
+        cursor.execute('''
+            INSERT INTO search_index (rowid, content, user_id, timestamp)
+            SELECT message_id * 2, content, user_id, timestamp FROM messages
+            WHERE content IS NOT NULL AND content != ''
+        ''')
+        cursor.execute('''
+            INSERT INTO search_index (rowid, content, user_id, timestamp)
+            SELECT r.reply_id * 2 + 1, r.content, m.user_id, r.timestamp
+            FROM replies r LEFT JOIN messages m ON m.message_id = r.original_message_id
+            WHERE r.content IS NOT NULL AND r.content != ''
+        ''')
+    
+    for trigger in SEARCH_TRIGGERS:
+        cursor.execute(trigger)
+
+def enable_incremental_vacuum(db_path: str) -> Optional[int]:
+    """把已有数据库切换为增量回收空闲页，返回 VACUUM 耗时（毫秒），已开启时返回 None
+    
+    切换需要一次完整 VACUUM，期间整个数据库的写入都会等待，所以不作为启动时的
+    迁移执行，而是由 python db_manage.py vacuum-mode 在维护窗口手动执行。
+    """
+    conn = sqlite3.connect(db_path, timeout=config.SQLITE_PRAGMAS.get('busy_timeout', 5000) / 1000)
+    try:
+        if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+            return None
+        start = time.perf_counter()
+        conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+        conn.execute('VACUUM')
+        return int((time.perf_counter() - start) * 1000)
+    finally:
+        conn.close()
+
+@dataclass
+class Migration:
+    """数据库迁移步骤
+    
+    离线迁移在启动时同步执行；在线迁移（建索引等）在启动后由写任务执行，
+    期间读连接不受影响，写操作只需排队等待。迁移必须可以重复执行。
+    """
+    version: int
+    description: str
+    statements: List[str] = field(default_factory=list)
+    apply: Optional[Callable[[sqlite3.Connection], None]] = None
+    online: bool = False
+
+# 按版本号顺序执行；已发布的迁移不要修改，新的结构变更追加新版本
+MIGRATIONS = [
+    Migration(1, '创建用户表、消息表、回复表和更新表', apply=create_base_tables),
+    Migration(2, '时间列从 ISO 字符串迁移为毫秒时间戳', apply=migrate_epoch_timestamps),
+    Migration(3, '创建未回复消息认领表', [
+        '''
+        CREATE TABLE IF NOT EXISTS message_claims (
+            message_id INTEGER PRIMARY KEY,
+            admin_id INTEGER NOT NULL,
+            claimed_at INTEGER NOT NULL
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_message_claims_admin ON message_claims(admin_id)',
+    ]),
+    Migration(4, '创建统计计数器表及维护触发器', apply=create_counters),
+    Migration(5, '创建消息和回复内容的全文索引', apply=create_search_index),
+    # (user_id, timestamp) 复合索引支持按时间倒序分页，并取代原来的单列索引
+    Migration(6, '创建消息 (user_id, timestamp) 复合索引', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages(user_id, timestamp)',
+        'DROP INDEX IF EXISTS idx_messages_user_id',
+    ], online=True),
+    Migration(7, '创建会话和回复查询索引', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)',
+        'CREATE INDEX IF NOT EXISTS idx_replies_message_id ON replies(original_message_id)',
+    ], online=True),
+    # 覆盖索引：用户统计只需扫描索引，无需回表
+    Migration(8, '创建用户消息统计覆盖索引', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_user_type 
+        ON messages(user_id, message_type, is_replied, timestamp)
+        ''',
+    ], online=True),
+    # 部分索引：只包含未回复的消息，按时间排序
+    Migration(9, '创建未回复消息部分索引', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_unreplied 
+        ON messages(timestamp) WHERE is_replied = 0
+        ''',
+    ], online=True),
+    # 与上面互补的部分索引：归档任务按时间查找已回复的旧消息
+    Migration(10, '创建已回复消息部分索引', [
+        '''
+        CREATE INDEX IF NOT EXISTS idx_messages_replied_time 
+        ON messages(timestamp) WHERE is_replied = 1
+        ''',
+    ], online=True),
+    # 保留策略按消息类型查找过期消息
+    Migration(11, '创建消息 (message_type, timestamp) 索引', [
+        'CREATE INDEX IF NOT EXISTS idx_messages_type_time ON messages(message_type, timestamp)',
+    ], online=True),
+    # 切换增量回收需要完整 VACUUM，已改为 db_manage vacuum-mode 手动执行；新建的库在创建时直接开启
+    Migration(12, '开启增量回收（已改为手动执行 db_manage vacuum-mode）'),
+    # 管理员和私聊请求原来保存在 JSON 文件中，多个进程无法共享
+    Migration(13, '创建管理员表和私聊请求表', [
+        '''
+        CREATE TABLE IF NOT EXISTS admins (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            is_super_admin INTEGER DEFAULT 0,
+            join_date TEXT,
+            last_active TEXT,
+            private_chats TEXT DEFAULT '[]',
+            max_private_chats INTEGER,
+            is_online INTEGER DEFAULT 0
+        )
+        ''',
+        'CREATE INDEX IF NOT EXISTS idx_admins_username ON admins(username)',
+        '''
+        CREATE TABLE IF NOT EXISTS private_chat_requests (
+            user_id INTEGER PRIMARY KEY,
+            username TEXT,
+            first_name TEXT,
+            admin_id INTEGER,
+            request_time TEXT,
+            status TEXT,
+            chat_id INTEGER
+        )
+        ''',
+        '''
+        CREATE INDEX IF NOT EXISTS idx_private_chat_requests_admin_status 
+        ON private_chat_requests(admin_id, status)
+        ''',
+    ]),
+    Migration(14, '管理员私聊列表改为每个私聊一行', apply=move_private_chats_to_requests),
+    # 清理归档库时先在热库中记下已扣减计数器的消息，再删除归档库中的行，中断后可以补完
+    Migration(15, '创建归档清理记录表', [
+        '''
+        CREATE TABLE IF NOT EXISTS archive_purges (
+            month TEXT NOT NULL,
+            message_id INTEGER NOT NULL,
+            PRIMARY KEY (month, message_id)
+        )
+        ''',
+    ]),
+]
+
+SCHEMA_VERSION_TABLE = '''
+    CREATE TABLE IF NOT EXISTS schema_version (
+        version INTEGER PRIMARY KEY,
+        description TEXT,
+        applied_at INTEGER,
+        duration_ms INTEGER
+    )
+'''
+
+def pending_migrations(conn: sqlite3.Connection, online: Optional[bool] = None) -> List[Migration]:
+    """列出尚未执行的迁移，online 为 None 时包含全部"""
+    conn.execute(SCHEMA_VERSION_TABLE)
+    applied = {row[0] for row in conn.execute('SELECT version FROM schema_version')}
+    return [migration for migration in MIGRATIONS
+            if migration.version not in applied and (online is None or migration.online == online)]
+
+def apply_migration(conn: sqlite3.Connection, migration: Migration) -> int:
+    """执行一个迁移并记录到 schema_version，返回耗时（毫秒）"""
+    start = time.perf_counter()
+    if migration.apply is not None:
+        migration.apply(conn)
+        conn.commit()
+    if migration.statements:
+        conn.execute('BEGIN')
+        try:
+            for statement in migration.statements:
+                conn.execute(statement)
+            conn.execute('COMMIT')
+        except Exception:
+            conn.execute('ROLLBACK')
+            raise
+    duration_ms = int((time.perf_counter() - start) * 1000)
+    
+    conn.execute('''
+        INSERT OR REPLACE INTO schema_version (version, description, applied_at, duration_ms)
+        VALUES (?, ?, ?, ?)
+    ''', (migration.version, migration.description, now_ms(), duration_ms))
+    conn.commit()
+    return duration_ms
+
+def dry_run_migrations(db_path: str) -> List[Dict]:
+    """在数据库副本上演练待执行的迁移
+    
+    返回每一步的耗时，即正式执行时该步骤阻塞写入的时间。SQLite 建索引和
+    重建表时整个数据库的写入都会等待，读连接在 WAL 模式下不受影响。
+    """
+    report = []
+    with tempfile.TemporaryDirectory() as tmp:
+        copy_path = os.path.join(tmp, 'dry_run.db')
+        conn = sqlite3.connect(copy_path)
+        try:
+            if os.path.exists(db_path):
+                source = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+                try:
+                    source.backup(conn)
+                finally:
+                    source.close()
             
-            # 创建索引
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_user_id ON messages(user_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)')
-            cursor.execute('CREATE INDEX IF NOT EXISTS idx_replies_message_id ON replies(original_message_id)')
+            for migration in pending_migrations(conn):
+                report.append({
+                    'version': migration.version,
+                    'description': migration.description,
+                    'online': migration.online,
+                    'duration_ms': apply_migration(conn, migration)
+                })
+        finally:
+            conn.close()
+    return report
+
+# 增量备份期间源库被其它连接修改会从头开始，超过该次数后改为一次性复制
+BACKUP_MAX_RESTARTS = 3
+
+class BackupRestarted(Exception):
+    """增量备份被反复打断"""
+
+def snapshot_database(db_path: str, snapshot_path: str, pages_per_step: int,
+                      step_sleep_ms: int) -> Dict:
+    """用 SQLite 备份 API 把数据库复制到快照文件
+    
+    每步复制 pages_per_step 页，步与步之间暂停 step_sleep_ms 毫秒，让写连接
+    有机会提交。WAL 模式下备份只持有读快照，不会阻塞写入；但每次有其它连接
+    提交，增量备份都要从头开始，被打断超过 BACKUP_MAX_RESTARTS 次后改为
+    一次性复制全部页面。
+    """
+    progress = {'steps': 0, 'restarts': 0, 'remaining': None}
+    
+    def on_progress(status: int, remaining: int, total: int):
+        if progress['remaining'] is not None and remaining > progress['remaining']:
+            progress['restarts'] += 1
+            if progress['restarts'] > BACKUP_MAX_RESTARTS:
+                raise BackupRestarted()
+        progress['steps'] += 1
+        progress['remaining'] = remaining
+        progress['pages'] = total
+        if remaining and step_sleep_ms > 0:
+            time.sleep(step_sleep_ms / 1000)
+    
+    source = sqlite3.connect(f'file:{db_path}?mode=ro', uri=True)
+    try:
+        target = sqlite3.connect(snapshot_path)
+        try:
+            try:
+                source.backup(target, pages=max(1, pages_per_step), progress=on_progress)
+            except BackupRestarted:
+                logger.warning(f"增量备份被写入打断 {progress['restarts']} 次，改为一次性复制")
+                progress['remaining'] = None
+                source.backup(target, pages=-1, progress=on_progress)
             
-            conn.commit()
+            integrity = [row[0] for row in target.execute('PRAGMA integrity_check')]
+        finally:
+            target.close()
+    finally:
+        source.close()
+    
+    if integrity != ['ok']:
+        raise RuntimeError(f"备份快照完整性检查失败: {'; '.join(integrity[:5])}")
+    return progress
+
+def compress_snapshot(db_path: str, dest_path: str, pages_per_step: int, step_sleep_ms: int) -> Dict:
+    """把数据库快照压缩写入 dest_path，写入完成并通过完整性检查后才出现在目标路径"""
+    directory = os.path.dirname(dest_path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    
+    with tempfile.TemporaryDirectory(dir=directory) as tmp:
+        snapshot_path = os.path.join(tmp, 'snapshot.db')
+        progress = snapshot_database(db_path, snapshot_path, pages_per_step, step_sleep_ms)
+        
+        partial_path = os.path.join(tmp, 'snapshot.db.gz')
+        with open(snapshot_path, 'rb') as src, gzip.open(partial_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, 1024 * 1024)
+        progress['size'] = os.path.getsize(snapshot_path)
+        os.replace(partial_path, dest_path)
+    return progress
+
+def archive_backup_path(backup_path: str, month: str) -> str:
+    """归档库备份与主备份放在同一目录：<备份名>.archive_<月份>.db.gz"""
+    base = backup_path[:-len('.db.gz')] if backup_path.endswith('.db.gz') else backup_path
+    return f'{base}.archive_{month}.db.gz'
+
+def find_archive_backups(backup_path: str) -> Dict[str, str]:
+    """查找与主备份同一批生成的归档库备份，返回 {月份: 路径}"""
+    prefix = os.path.basename(archive_backup_path(backup_path, ''))[:-len('.db.gz')]
+    directory = os.path.dirname(backup_path) or '.'
+    backups = {}
+    for name in os.listdir(directory):
+        month = name[len(prefix):-len('.db.gz')]
+        if name.startswith(prefix) and name.endswith('.db.gz') and len(month) == 6 and month.isdigit():
+            backups[month] = os.path.join(directory, name)
+    return dict(sorted(backups.items()))
+
+def backup_database(db_path: str, dest_path: str,
+                    pages_per_step: int = config.BACKUP_PAGES_PER_STEP,
+                    step_sleep_ms: int = config.BACKUP_STEP_SLEEP_MS,
+                    archive_paths: Optional[Dict[str, str]] = None) -> Dict:
+    """在线备份数据库及其归档库到 gzip 压缩文件
+    
+    archive_paths 为 {月份: 归档库路径}，每个归档库保存在主备份旁边（见
+    archive_backup_path）。主备份最后写入，它出现时整套备份已经完整。
+    """
+    start = time.perf_counter()
+    
+    archives = {}
+    archive_size = 0
+    for month, path in sorted((archive_paths or {}).items()):
+        archives[month] = archive_backup_path(dest_path, month)
+        archive_size += compress_snapshot(path, archives[month], pages_per_step, step_sleep_ms)['size']
+    progress = compress_snapshot(db_path, dest_path, pages_per_step, step_sleep_ms)
+    
+    return {
+        'path': dest_path,
+        'archives': archives,
+        'pages': progress.get('pages', 0),
+        'steps': progress['steps'],
+        'restarts': progress['restarts'],
+        'size': progress['size'] + archive_size,
+        'compressed_size': sum(os.path.getsize(path) for path in [dest_path, *archives.values()]),
+        'duration_ms': int((time.perf_counter() - start) * 1000)
+    }
+
+def restore_to(backup_path: str, restored_path: str) -> List[str]:
+    """把 gzip 备份解压到 restored_path，返回 integrity_check 的结果"""
+    with gzip.open(backup_path, 'rb') as src, open(restored_path, 'wb') as dst:
+        shutil.copyfileobj(src, dst, 1024 * 1024)
+    conn = sqlite3.connect(restored_path)
+    try:
+        return [row[0] for row in conn.execute('PRAGMA integrity_check')]
+    finally:
+        conn.close()
+
+def verify_backup(backup_path: str) -> Dict:
+    """把备份解压到临时目录，检查完整性并统计各表行数，用于验证备份可以恢复
+    
+    同一批的归档库备份也会逐个检查，其中的消息和回复总数必须与主库中
+    archived_messages / archived_replies 计数器一致，否则说明缺少归档文件。
+    """
+    with tempfile.TemporaryDirectory() as tmp:
+        restored_path = os.path.join(tmp, 'restored.db')
+        integrity = restore_to(backup_path, restored_path)
+        
+        conn = sqlite3.connect(restored_path)
+        try:
+            tables = {}
+            for table in TABLE_COLUMNS:
+                tables[table] = conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+            schema_version = conn.execute('SELECT MAX(version) FROM schema_version').fetchone()[0]
+            counters = dict(conn.execute(
+                f"SELECT name, value FROM counters WHERE name IN ({','.join('?' * len(ARCHIVE_COUNTERS))})",
+                ARCHIVE_COUNTERS))
+        finally:
             conn.close()
+        
+        archives = {}
+        archived = {table: 0 for table in ARCHIVE_TABLES}
+        for month, path in find_archive_backups(backup_path).items():
+            archive_path = os.path.join(tmp, f'archive_{month}.db')
+            result = restore_to(path, archive_path)
+            if result != ['ok']:
+                integrity.extend(f'archive_{month}: {line}' for line in result)
+            
+            conn = sqlite3.connect(archive_path)
+            try:
+                archives[month] = {table: conn.execute(f'SELECT COUNT(*) FROM {table}').fetchone()[0]
+                                   for table in ARCHIVE_TABLES}
+            finally:
+                conn.close()
+            os.remove(archive_path)
+            for table, count in archives[month].items():
+                archived[table] += count
+    
+    for table in ARCHIVE_TABLES:
+        expected = counters.get(f'archived_{table}', 0)
+        if archived[table] != expected:
+            integrity.append(f'归档 {table} 行数 {archived[table]} 与计数器 {expected} 不一致')
+    
+    return {
+        'ok': integrity == ['ok'],
+        'integrity': integrity,
+        'schema_version': schema_version,
+        'tables': tables,
+        'archives': archives
+    }
+
+class UserCache:
+    """带过期时间的 LRU 用户缓存
+    
+    写入用户时调用 invalidate()。每次失效都会推进代号，查询期间发生过失效的
+    结果不会被放入缓存，避免把旧数据写回缓存。
+    """
+    
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max(0, max_size)
+        self.ttl = ttl
+        self._entries: OrderedDict = OrderedDict()
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, user_id: int) -> Optional[User]:
+        """读取未过期的缓存项"""
+        entry = self._entries.get(user_id)
+        if entry is None:
+            self.misses += 1
+            return None
+        
+        expires_at, user = entry
+        if expires_at < time.monotonic():
+            del self._entries[user_id]
+            self.misses += 1
+            return None
+        
+        self._entries.move_to_end(user_id)
+        self.hits += 1
+        return user
+    
+    def put(self, user: User, generation: int):
+        """缓存查询结果，generation 为查询开始前的代号"""
+        if generation != self.generation or not self.max_size:
+            return
+        
+        self._entries[user.user_id] = (time.monotonic() + self.ttl, user)
+        self._entries.move_to_end(user.user_id)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+    
+    def update(self, user_id: int, **changes):
+        """就地更新已缓存用户的字段，不改变过期时间"""
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (entry[0], replace(entry[1], **changes))
+    
+    def invalidate(self, user_id: int):
+        """删除缓存项"""
+        self._entries.pop(user_id, None)
+        self.generation += 1
+    
+    def clear(self):
+        """删除全部缓存项"""
+        self._entries.clear()
+        self.generation += 1
+    
+    def stats(self) -> Dict:
+        """命中、未命中和淘汰次数"""
+        lookups = self.hits + self.misses
+        return {
+            'size': len(self._entries),
+            'max_size': self.max_size,
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'hit_rate': self.hits / lookups * 100 if lookups else 0.0
+        }
+
+class BaseDatabase(ABC):
+    """存储后端接口
+    
+    SQLite 和 PostgreSQL 后端实现同一组异步方法；写缓冲等与具体存储无关的
+    逻辑在这里实现，后端只需提供批量写入。
+    """
+    
+    def __init__(self):
+        # 写缓冲：合并消息插入和 last_active 更新，按数量或时间批量落盘
+        self.batch_max_size = max(1, config.DB_BATCH_MAX_SIZE)
+        self.batch_max_delay = config.DB_BATCH_MAX_DELAY_MS / 1000
+        self._pending_messages: List[Message] = []
+        self._pending_activity: Dict[int, int] = {}
+        self._flush_timer: Optional[asyncio.TimerHandle] = None
+        self._flush_tasks: set = set()
+        # 已从缓冲取出、正在写入的批次，读取刚缓冲的消息前需要等待它们完成
+        self._inflight_writes: set = set()
+        
+        # 用户信息读缓存，由 add_user 和 update_user_activity 失效
+        self.user_cache = UserCache(config.USER_CACHE_SIZE, config.USER_CACHE_TTL)
+        # 最近写入的用户资料指纹，资料未变化时 add_user 不再访问数据库
+        self._profile_fingerprints: OrderedDict = OrderedDict()
+    
+    def __init_subclass__(cls, **kwargs):
+        super().__init_subclass__(**kwargs)
+        # 后端的公开方法统一统计耗时、行数和错误数
+        instrument_methods(cls)
+    
+    async def _explain(self, sql: str, parameters=None) -> List[str]:
+        """返回语句的查询计划，供慢查询日志使用；后端不支持时返回空列表"""
+        return []
+    
+    @abstractmethod
+    async def connect(self):
+        """打开连接（在机器人启动时调用）"""
+    
+    @abstractmethod
+    async def close(self):
+        """落盘写缓冲并关闭连接（在机器人停止时调用）"""
+    
+    @abstractmethod
+    async def _add_user(self, user: User) -> bool:
+        """插入新用户；已存在时只更新有变化的资料字段，保留加入时间和封禁状态"""
+    
+    @abstractmethod
+    async def _update_user_activity(self, user_id: int, last_active: int):
+        """写入用户活动时间"""
+    
+    @abstractmethod
+    async def _fetch_user(self, user_id: int) -> Optional[User]:
+        """从数据库读取用户"""
+    
+    @abstractmethod
+    async def add_message(self, message: Message) -> bool:
+        """添加消息"""
+    
+    @abstractmethod
+    async def _write_buffered(self, messages: List[Message], activity: Dict[int, int]):
+        """在一个事务中写入缓冲的消息（跳过重复ID）和用户活动时间"""
+    
+    @abstractmethod
+    async def get_user_messages_page(self, user_id: int, before: Optional[int] = None,
+                                     after: Optional[int] = None,
+                                     limit: int = 10) -> Tuple[List[Message], bool, bool]:
+        """按游标分页获取用户消息历史"""
+    
+    @abstractmethod
+    async def get_user_message_stats(self, user_id: int) -> Dict:
+        """获取用户消息统计"""
+    
+    async def add_reply(self, reply: Reply) -> Optional[int]:
+        """添加回复，返回新回复的ID，失败时返回 None"""
+        reply_ids = await self.add_replies([reply])
+        return reply_ids[0] if reply_ids else None
+    
+    @abstractmethod
+    async def add_replies(self, replies: List[Reply]) -> List[int]:
+        """在一个事务中添加一批回复并标记对应消息为已回复，返回各回复的ID，失败时返回空列表"""
+    
+    @abstractmethod
+    async def get_unreplied_messages(self, limit: int = 100, after: Optional[int] = None) -> List[Message]:
+        """按时间顺序分页获取未回复的消息"""
+    
+    @abstractmethod
+    async def claim_unreplied(self, limit: int, admin_id: int) -> List[Message]:
+        """为管理员认领最早的未回复消息"""
+    
+    @abstractmethod
+    async def search(self, query: str, user_id: Optional[int] = None, limit: int = 10,
+                     cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """搜索消息和回复内容，cursor 为上一页返回的不透明游标"""
+    
+    @abstractmethod
+    async def release_claims(self, admin_id: int) -> int:
+        """释放管理员认领的全部消息"""
+    
+    @abstractmethod
+    async def get_message_with_replies(self, message_id: int) -> Tuple[Optional[Message], List[Reply]]:
+        """获取消息及其回复"""
+    
+    @abstractmethod
+    async def add_update(self, update_info: UpdateInfo) -> bool:
+        """添加更新信息"""
+    
+    @abstractmethod
+    async def get_latest_update(self) -> Optional[UpdateInfo]:
+        """获取最新更新信息"""
+    
+    @abstractmethod
+    async def get_stats(self) -> Dict:
+        """获取统计信息"""
+    
+    async def add_user(self, user: User) -> bool:
+        """添加用户或更新用户资料（用户名和姓名）
+        
+        已存在的用户不会改动加入时间、活动时间和封禁状态；资料与最近一次
+        写入相同时直接返回，重复的 /start 不产生任何数据库写入。
+        """
+        fingerprint = (user.username, user.first_name, user.last_name)
+        if self._profile_fingerprints.get(user.user_id) == fingerprint:
+            self._profile_fingerprints.move_to_end(user.user_id)
+            return True
+        
+        self.user_cache.invalidate(user.user_id)
+        if not await self._add_user(user):
+            return False
+        
+        self._profile_fingerprints[user.user_id] = fingerprint
+        self._profile_fingerprints.move_to_end(user.user_id)
+        while len(self._profile_fingerprints) > self.user_cache.max_size:
+            self._profile_fingerprints.popitem(last=False)
+        return True
+    
+    def _forget_user_profiles(self):
+        """批量删除或导入数据后调用：清空用户缓存和资料指纹，
+        之后的 add_user 重新写入，不会因为指纹相同而跳过已不存在的用户"""
+        self._profile_fingerprints.clear()
+        self.user_cache.clear()
+    
+    async def update_user_activity(self, user_id: int):
+        """更新用户活动时间"""
+        self.user_cache.invalidate(user_id)
+        await self._update_user_activity(user_id, now_ms())
+    
+    async def get_user(self, user_id: int) -> Optional[User]:
+        """获取用户信息（优先读缓存）"""
+        user = self.user_cache.get(user_id)
+        if user is not None:
+            return user
+        
+        generation = self.user_cache.generation
+        user = await self._fetch_user(user_id)
+        if user is not None:
+            self.user_cache.put(user, generation)
+        return user
+    
+    def get_cache_stats(self) -> Dict:
+        """用户缓存的命中、未命中和淘汰统计"""
+        return self.user_cache.stats()
+    
+    async def buffer_message(self, message: Message):
+        """把消息放入写缓冲，稍后与其它消息一起批量写入"""
+        self._pending_messages.append(message)
+        self._schedule_flush()
+    
+    async def buffer_user_activity(self, user_id: int):
+        """把用户活动时间放入写缓冲，同一用户的多次更新只保留最后一次"""
+        self._pending_activity[user_id] = now_ms()
+        # 缓存中的用户直接改为最新活动时间，不必失效
+        self.user_cache.update(user_id, last_active=self._pending_activity[user_id])
+        self._schedule_flush()
+    
+    def _schedule_flush(self):
+        """缓冲达到数量上限时立即落盘，否则在最大延迟后落盘"""
+        pending = len(self._pending_messages) + len(self._pending_activity)
+        if pending >= self.batch_max_size:
+            if self._flush_timer is not None:
+                self._flush_timer.cancel()
+                self._flush_timer = None
+            self._start_flush()
+        elif self._flush_timer is None:
+            loop = asyncio.get_running_loop()
+            self._flush_timer = loop.call_later(self.batch_max_delay, self._start_flush)
+    
+    def _start_flush(self):
+        """在后台任务中落盘写缓冲"""
+        self._flush_timer = None
+        task = asyncio.create_task(self.flush_writes())
+        self._flush_tasks.add(task)
+        task.add_done_callback(self._flush_tasks.discard)
+    
+    def _has_buffered_writes(self) -> bool:
+        """是否有尚未写入数据库的缓冲消息或活动时间（包括正在写入的批次）"""
+        return bool(self._pending_messages or self._pending_activity or self._inflight_writes)
+    
+    async def flush_writes(self) -> int:
+        """把写缓冲中的消息和活动时间在一个事务中写入，返回写入的条数
+        
+        返回前也会等待之前已开始的批次完成，因此调用之后缓冲过的数据都已可读。
+        写入失败时这一批放回缓冲的最前面，等下次落盘时重试。
+        """
+        if self._flush_timer is not None:
+            self._flush_timer.cancel()
+            self._flush_timer = None
+        
+        earlier = list(self._inflight_writes)
+        messages, self._pending_messages = self._pending_messages, []
+        activity, self._pending_activity = self._pending_activity, {}
+        
+        written = 0
+        if messages or activity:
+            done = asyncio.get_running_loop().create_future()
+            self._inflight_writes.add(done)
+            try:
+                await self._write_buffered(messages, activity)
+                written = len(messages) + len(activity)
+            except Exception as e:
+                logger.error(f"批量写入失败，已放回写缓冲 (消息: {len(messages)}, 活动: {len(activity)}): {e}")
+                self._pending_messages[:0] = messages
+                # 放回期间又缓冲的活动时间更新，以较新的为准
+                self._pending_activity = {**activity, **self._pending_activity}
+            finally:
+                self._inflight_writes.discard(done)
+                done.set_result(None)
+        
+        if earlier:
+            await asyncio.gather(*earlier)
+        return written
+    
+    async def _drain_write_buffer(self):
+        """关闭前把写缓冲全部落盘，并等待后台落盘任务结束"""
+        await self.flush_writes()
+        if self._flush_tasks:
+            await asyncio.gather(*self._flush_tasks, return_exceptions=True)
+        if self._pending_messages or self._pending_activity:
+            logger.error(f"关闭前写缓冲未能落盘 (消息: {len(self._pending_messages)}, "
+                         f"活动: {len(self._pending_activity)})")
+    
+    async def get_user_messages(self, user_id: int, limit: int = 50) -> List[Message]:
+        """获取用户消息历史（热库不足时包含归档的消息）"""
+        messages, _, _ = await self.get_user_messages_page(user_id, limit=limit)
+        return messages
+    
+    @staticmethod
+    def _message_stats_from_rows(rows) -> Dict:
+        """汇总 (消息类型, 条数, 已回复数, 最早时间, 最晚时间) 行为用户消息统计"""
+        stats = {
+            'total_messages': 0,
+            'replied_messages': 0,
+            'reply_rate': 0.0,
+            'first_message_time': None,
+            'last_message_time': None,
+            'by_type': {}
+        }
+        
+        for message_type, count, replied, first_time, last_time in rows:
+            stats['by_type'][message_type] = stats['by_type'].get(message_type, 0) + count
+            stats['total_messages'] += count
+            stats['replied_messages'] += replied or 0
+            if first_time and (stats['first_message_time'] is None or first_time < stats['first_message_time']):
+                stats['first_message_time'] = first_time
+            if last_time and (stats['last_message_time'] is None or last_time > stats['last_message_time']):
+                stats['last_message_time'] = last_time
+        
+        if stats['total_messages']:
+            stats['reply_rate'] = stats['replied_messages'] / stats['total_messages'] * 100
+        
+        return stats
+    
+    async def reconcile_counters(self) -> Dict:
+        """按实际数据重建计数器（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不使用统计计数器")
+    
+    @uninstrumented
+    async def archive_old_messages(self, older_than_days: Optional[int] = None) -> Dict[str, int]:
+        """把旧消息移入归档库（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持按月归档")
+    
+    @uninstrumented
+    async def reindex_archives(self) -> int:
+        """把归档的内容补回全文索引（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持按月归档")
+    
+    @uninstrumented
+    async def backup(self, directory: Optional[str] = None) -> Dict:
+        """在线备份到压缩快照文件（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持在线备份，请使用数据库自带的备份工具")
+    
+    @uninstrumented
+    async def run_retention(self) -> Dict:
+        """执行数据保留策略并回收空闲页（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不支持数据保留策略")
+    
+    async def run_online_migrations(self) -> List[Dict]:
+        """执行待执行的在线迁移（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不使用迁移脚本")
+    
+    async def wait_for_migrations(self) -> List[Dict]:
+        """等待 connect() 启动的在线迁移完成（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不使用迁移脚本")
+    
+    async def migration_status(self) -> List[Dict]:
+        """列出各迁移的执行情况（仅 SQLite 后端）"""
+        raise NotImplementedError(f"{type(self).__name__} 不使用迁移脚本")
+    
+    @abstractmethod
+    async def get_admins(self) -> Optional[List[Dict]]:
+        """获取全部管理员（字段见 ADMIN_COLUMNS），失败时返回 None"""
+    
+    @abstractmethod
+    async def get_admin_by_username(self, username: str) -> Optional[Dict]:
+        """按用户名查找管理员"""
+    
+    @abstractmethod
+    async def get_private_chat_requests(self, admin_id: Optional[int] = None,
+                                        status: Optional[str] = None,
+                                        user_id: Optional[int] = None) -> Optional[List[Dict]]:
+        """按管理员、状态和用户获取私聊请求（字段见 PRIVATE_CHAT_COLUMNS），失败时返回 None"""
+    
+    @abstractmethod
+    async def create_private_chat_request(self, request: Dict, max_chats: int) -> bool:
+        """用户没有私聊请求且管理员已接受的私聊少于 max_chats 时插入请求，返回是否插入"""
+    
+    @abstractmethod
+    async def update_private_chat_status(self, user_id: int, admin_id: int, old_status: str,
+                                         new_status: str) -> Optional[Dict]:
+        """仅当请求属于该管理员且状态为 old_status 时修改状态，返回修改后的请求，未修改时返回 None"""
+    
+    @abstractmethod
+    async def reassign_private_chat_request(self, user_id: int, old_admin_id: int, new_admin_id: int,
+                                            request_time: str, max_chats: int) -> Optional[Dict]:
+        """仅当请求仍待处理、属于 old_admin_id 且新管理员已接受的私聊少于 max_chats 时
+        转给新管理员，返回修改后的请求，未修改时返回 None"""
+    
+    @abstractmethod
+    async def delete_private_chat_request(self, user_id: int, admin_id: int, status: str) -> bool:
+        """仅当请求属于该管理员且状态为 status 时删除，返回是否删除"""
+    
+    @abstractmethod
+    async def expire_private_chat_requests(self, before: str) -> Optional[List[Dict]]:
+        """删除 request_time 早于 before 的待处理请求，返回删除的请求，失败时返回 None"""
+    
+    @abstractmethod
+    async def save_admin_state(self, added_admins: List[Dict], admins: List[Dict], deleted_admins: List[int],
+                               requests: List[Dict], deleted_requests: List[int]) -> bool:
+        """在一个事务中写入或删除管理员和私聊请求
+        
+        added_admins 只在不存在时插入；admins 只更新已存在的行，不会恢复其他进程
+        删除的管理员；requests 只在用户没有请求时插入，已有请求的状态只能通过
+        条件写入修改。
+        """
+    
+    @abstractmethod
+    def iter_table(self, table: str, chunk_size: int = config.EXPORT_CHUNK_SIZE):
+        """按主键顺序分块读取整张表（列顺序见 TABLE_COLUMNS），返回异步迭代器"""
+    
+    @abstractmethod
+    async def import_rows(self, table: str, rows: List[Tuple]) -> int:
+        """在一个事务中写入一块行，主键已存在的行跳过，返回实际写入的行数"""
+    
+class SQLiteDatabase(BaseDatabase):
+    """SQLite 存储后端"""
+    
+    def __init__(self, db_path: str = "data/bot.db", read_pool_size: int = config.DB_READ_POOL_SIZE,
+                 pragmas: Optional[Dict[str, object]] = None, archive_dir: Optional[str] = None):
+        super().__init__()
+        self.db_path = db_path
+        self.archive_dir = config.ARCHIVE_DIR if archive_dir is None else archive_dir
+        self.read_pool_size = max(1, read_pool_size)
+        self.pragmas = dict(config.SQLITE_PRAGMAS if pragmas is None else pragmas)
+        
+        # 长连接池：一个写连接 + N 个读连接，由 connect()/close() 管理
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._readers: Optional[asyncio.Queue] = None
+        self._reader_conns: List[aiosqlite.Connection] = []
+        
+        # 所有写操作都排队交给唯一的写任务执行
+        self._write_queue: Optional[asyncio.Queue] = None
+        self._writer_task: Optional[asyncio.Task] = None
+        self._migration_task: Optional[asyncio.Task] = None
+        
+        # 归档和备份互斥，备份中的主库计数器与归档库内容保持一致
+        self._archive_lock = asyncio.Lock()
+        
+        # 首次打开连接时才初始化，导入模块不会创建或迁移数据库文件
+        self._initialized = False
+    
+    def init_database(self):
+        """初始化数据库：应用 PRAGMA 并执行待执行的离线迁移
+        
+        索引等在线迁移在 connect() 之后由写任务在后台执行，不阻塞启动。
+        """
+        try:
+            os.makedirs(os.path.dirname(self.db_path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.db_path)
+            try:
+                # 新建的空库可以直接开启增量回收，不需要 VACUUM；必须在建表之前设置
+                if conn.execute('PRAGMA page_count').fetchone()[0] == 0:
+                    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                
+                # WAL 等 PRAGMA 设置（journal_mode 会持久化到数据库文件中）
+                for statement in self._pragma_statements():
+                    conn.execute(statement)
+                
+                for migration in pending_migrations(conn, online=False):
+                    logger.info(f"正在执行数据库迁移 {migration.version}: {migration.description}")
+                    apply_migration(conn, migration)
+            finally:
+                conn.close()
+            self._initialized = True
             logger.info("数据库初始化完成")
             
         except Exception as e:
+            # 表结构不完整时继续运行只会在之后的每次读写中失败，直接中止启动
             logger.error(f"数据库初始化失败: {e}")
+            raise
     
-    async def add_user(self, user: User) -> bool:
-        """添加用户"""
-        try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
-                    INSERT OR REPLACE INTO users 
-                    (user_id, username, first_name, last_name, join_date, last_active)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (user.user_id, user.username, user.first_name, 
-                      user.last_name, user.join_date, user.last_active))
-                await db.commit()
-                return True
+    def _pragma_statements(self, read_only: bool = False) -> List[str]:
+        """生成连接初始化时执行的 PRAGMA 语句"""
+        statements = [f"PRAGMA {name} = {value}" for name, value in self.pragmas.items()]
+        # INSERT OR REPLACE 删除旧行时也要触发计数器的删除触发器
+        statements.append("PRAGMA recursive_triggers = 1")
+        if read_only:
+            statements.append("PRAGMA query_only = 1")
+        return statements
+    
+    async def _open_connection(self, read_only: bool = False, **kwargs) -> aiosqlite.Connection:
+        """打开一个应用了 PRAGMA 配置的连接"""
+        if not self._initialized:
+            self.init_database()
+        conn = await aiosqlite.connect(self.db_path, **kwargs)
+        try:
+            for statement in self._pragma_statements(read_only):
+                await conn.execute(statement)
+        except Exception:
+            await conn.close()
+            raise
+        return TracedConnection(conn)
+    
+    async def connect(self):
+        """打开连接池并启动写任务（在机器人启动时调用）"""
+        if self._writer is not None:
+            return
+        
+        try:
+            # 事务由写任务显式控制
+            self._writer = await self._open_connection(isolation_level=None)
+            self._readers = asyncio.Queue()
+            for _ in range(self.read_pool_size):
+                conn = await self._open_connection(read_only=True)
+                self._reader_conns.append(conn)
+                self._readers.put_nowait(conn)
+            
+            self._write_queue = asyncio.Queue()
+            self._writer_task = asyncio.create_task(self._writer_loop(self._writer, self._write_queue))
+            logger.info(f"数据库连接池已启动 (读连接: {self.read_pool_size})")
+            
+            # 在线迁移排在正常写操作之间执行，不阻塞启动
+            self._migration_task = asyncio.create_task(self.run_online_migrations())
+        except Exception as e:
+            logger.error(f"启动数据库连接池失败: {e}")
+            await self.close()
+            raise
+    
+    async def close(self):
+        """停止写任务并关闭连接池（在机器人停止时调用）"""
+        # 未开始的在线迁移留到下次启动；正在执行的那一步会在写任务中完成
+        if self._migration_task is not None:
+            self._migration_task.cancel()
+            await asyncio.gather(self._migration_task, return_exceptions=True)
+            self._migration_task = None
+        
+        # 关闭前必须把写缓冲全部落盘
+        await self._drain_write_buffer()
+        
+        if self._writer_task is not None:
+            # 队列中剩余的写操作会先于停止信号被执行
+            self._write_queue.put_nowait(None)
+            try:
+                await self._writer_task
+            except Exception as e:
+                logger.error(f"写任务异常退出: {e}")
+        
+        conns = self._reader_conns + ([self._writer] if self._writer else [])
+        self._writer = None
+        self._readers = None
+        self._reader_conns = []
+        self._write_queue = None
+        self._writer_task = None
+        
+        for conn in conns:
+            try:
+                await conn.close()
+            except Exception as e:
+                logger.error(f"关闭数据库连接失败: {e}")
+        
+        if conns:
+            logger.info("数据库连接池已关闭")
+    
+    async def _writer_loop(self, conn: aiosqlite.Connection, queue: asyncio.Queue):
+        """写任务：串行执行所有写操作，并把同时排队的操作合并为一次提交"""
+        while True:
+            item = await queue.get()
+            if item is None:
+                return
+            
+            batch = [item]
+            stopping = False
+            while len(batch) < config.DB_WRITE_BATCH_LIMIT and not queue.empty():
+                item = queue.get_nowait()
+                if item is None:
+                    stopping = True
+                    break
+                batch.append(item)
+            
+            try:
+                await self._run_write_jobs(conn, batch)
+            except Exception as e:
+                # 写任务不能退出，否则之后提交的写操作会一直等待
+                logger.error(f"执行写操作失败: {e}")
+                for _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+            if stopping:
+                return
+    
+    async def _run_write_jobs(self, conn: aiosqlite.Connection, batch: List[Tuple]):
+        """在一个事务中执行一批写操作，每个操作使用独立的保存点"""
+        results = []
+        try:
+            await conn.execute("BEGIN IMMEDIATE")
+            for job, future in batch:
+                await conn.execute("SAVEPOINT write_job")
+                try:
+                    result = await job(conn)
+                except Exception as e:
+                    # 只回滚失败的那个操作，同批其它操作照常提交
+                    await conn.execute("ROLLBACK TO write_job")
+                    await conn.execute("RELEASE write_job")
+                    results.append((future, None, e))
+                else:
+                    await conn.execute("RELEASE write_job")
+                    results.append((future, result, None))
+            await conn.execute("COMMIT")
+        except Exception as e:
+            logger.error(f"提交写事务失败: {e}")
+            try:
+                if conn.in_transaction:
+                    await conn.execute("ROLLBACK")
+            except Exception as rollback_error:
+                logger.error(f"回滚写事务失败: {rollback_error}")
+            results = [(future, None, e) for _, future in batch]
+        
+        for future, result, error in results:
+            if future.done():
+                continue
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+    
+    async def _submit_write(self, job: Callable[[aiosqlite.Connection], Awaitable]):
+        """提交写操作并等待其提交完成；写任务未启动时使用临时连接执行"""
+        future = asyncio.get_running_loop().create_future()
+        # 写任务中执行的语句仍记在提交它的方法名下
+        job = bind_call(job)
+        
+        if self._write_queue is None:
+            conn = await self._open_connection(isolation_level=None)
+            try:
+                await self._run_write_jobs(conn, [(job, future)])
+            finally:
+                await conn.close()
+        else:
+            self._write_queue.put_nowait((job, future))
+        
+        return await future
+    
+    async def _execute_write(self, sql: str, parameters: Tuple = ()) -> int:
+        """提交单条写语句，返回受影响的行数"""
+        async def job(conn: aiosqlite.Connection) -> int:
+            cursor = await conn.execute(sql, parameters)
+            return cursor.rowcount
+        
+        return await self._submit_write(job)
+    
+    @asynccontextmanager
+    async def _read_conn(self):
+        """从连接池借出一个读连接；连接池未启动时退回到临时连接"""
+        if self._readers is None:
+            conn = await self._open_connection(read_only=True)
+            try:
+                yield conn
+            finally:
+                await conn.close()
+            return
+        
+        readers = self._readers
+        conn = await readers.get()
+        try:
+            yield conn
+        finally:
+            readers.put_nowait(conn)
+    
+    def _archive_path(self, month: str) -> str:
+        """归档月份对应的归档库文件"""
+        return os.path.join(self.archive_dir, f'archive_{month}.db')
+    
+    def _archive_months(self) -> List[str]:
+        """列出已有的归档月份（按时间升序）"""
+        try:
+            names = os.listdir(self.archive_dir)
+        except FileNotFoundError:
+            return []
+        
+        months = [name[8:14] for name in names
+                  if len(name) == 17 and name.startswith('archive_') and name.endswith('.db')
+                  and name[8:14].isdigit()]
+        return sorted(months)
+    
+    @asynccontextmanager
+    async def _archive_conn(self, month: str):
+        """以只读方式打开一个归档库"""
+        uri = Path(self._archive_path(month)).resolve().as_uri() + '?mode=ro'
+        conn = await aiosqlite.connect(uri, uri=True)
+        try:
+            yield TracedConnection(conn)
+        finally:
+            await conn.close()
+    
+    async def _explain(self, sql: str, parameters=None) -> List[str]:
+        """在读连接上执行 EXPLAIN QUERY PLAN，返回计划中每一步的说明"""
+        async with self._read_conn() as db:
+            async with db.execute(f'EXPLAIN QUERY PLAN {sql}', parameters or ()) as cursor:
+                return [row[3] for row in await cursor.fetchall()]
+    
+    async def _write_archive(self, month: str, messages: List[Tuple], replies: List[Tuple]):
+        """把消息和回复写入归档库（重复执行是幂等的）"""
+        os.makedirs(self.archive_dir, exist_ok=True)
+        conn = await aiosqlite.connect(self._archive_path(month))
+        try:
+            for table in ARCHIVE_TABLES:
+                await conn.execute(TABLE_SCHEMAS[table].format(table=table))
+            for statement in ARCHIVE_INDEXES:
+                await conn.execute(statement)
+            for table, rows in (('messages', messages), ('replies', replies)):
+                if rows:
+                    columns = TABLE_COLUMNS[table]
+                    await conn.executemany(f'''
+                        INSERT OR REPLACE INTO {table} ({', '.join(columns)})
+                        VALUES ({', '.join('?' * len(columns))})
+                    ''', rows)
+            await conn.commit()
+        finally:
+            await conn.close()
+    
+    async def _remove_archived(self, month: str, message_ids: List[int]) -> Tuple[int, int]:
+        """从归档库删除消息及其回复，返回删除的 (消息数, 回复数)"""
+        placeholders = ','.join('?' * len(message_ids))
+        conn = await aiosqlite.connect(self._archive_path(month))
+        try:
+            cursor = await conn.execute(f'DELETE FROM replies WHERE original_message_id IN ({placeholders})',
+                                        message_ids)
+            replies = cursor.rowcount
+            cursor = await conn.execute(f'DELETE FROM messages WHERE message_id IN ({placeholders})',
+                                        message_ids)
+            messages = cursor.rowcount
+            await conn.commit()
+        finally:
+            await conn.close()
+        return messages, replies
+    
+    async def _find_archived(self, sql: str, parameters: Tuple) -> Optional[Tuple[str, Tuple]]:
+        """从最新的归档月份开始查找第一条匹配的记录，返回 (月份, 行)"""
+        for month in reversed(self._archive_months()):
+            async with self._archive_conn(month) as conn:
+                async with conn.execute(sql, parameters) as cursor:
+                    row = await cursor.fetchone()
+            if row:
+                return month, row
+        return None
+    
+    async def _merge_archived_page(self, sql: str, parameters: Tuple, rows: List[Tuple], count: int,
+                                   ascending: bool, key: Optional[Tuple[int, int]] = None) -> List[Tuple]:
+        """把归档库中同一分页查询的结果合并进热库结果，返回排序后的前 count 行
+        
+        归档库按月分区：游标范围之外的月份直接跳过，某个月份已不可能进入
+        前 count 行时停止扫描，所以热库足够填满一页时不会打开任何归档库。
+        """
+        def sort_key(row):
+            return row[7], row[0]
+        
+        merged = {row[0]: row for row in rows}
+        months = self._archive_months()
+        if not ascending:
+            months.reverse()
+        
+        for month in months:
+            start, end = month_bounds(month)
+            if key is not None and (start > key[0] if not ascending else end <= key[0]):
+                continue
+            if len(merged) >= count:
+                boundary = sorted(merged.values(), key=sort_key, reverse=not ascending)[count - 1][7]
+                if (end <= boundary) if not ascending else (start > boundary):
+                    break
+            
+            async with self._archive_conn(month) as conn:
+                async with conn.execute(sql, parameters) as cursor:
+                    for row in await cursor.fetchall():
+                        # 归档中途失败时同一条消息可能同时存在于热库和归档库
+                        merged.setdefault(row[0], row)
+        
+        return sorted(merged.values(), key=sort_key, reverse=not ascending)[:count]
+    
+    async def _message_key(self, message_id: int) -> Optional[Tuple[int, int]]:
+        """查找消息的分页键 (timestamp, message_id)，热库中没有时查找归档库"""
+        sql = 'SELECT timestamp, message_id FROM messages WHERE message_id = ?'
+        async with self._read_conn() as db:
+            async with db.execute(sql, (message_id,)) as cursor:
+                row = await cursor.fetchone()
+        if row is None:
+            found = await self._find_archived(sql, (message_id,))
+            row = found[1] if found else None
+        return tuple(row) if row else None
+    
+    async def run_online_migrations(self) -> List[Dict]:
+        """由写任务依次执行待执行的在线迁移，返回每一步的耗时"""
+        results = []
+        try:
+            async with self._read_conn() as db:
+                async with db.execute('SELECT version FROM schema_version') as cursor:
+                    applied = {row[0] for row in await cursor.fetchall()}
+            
+            for migration in MIGRATIONS:
+                if not migration.online or migration.version in applied:
+                    continue
+                
+                async def job(db: aiosqlite.Connection, migration: Migration = migration) -> int:
+                    start = time.perf_counter()
+                    for statement in migration.statements:
+                        await db.execute(statement)
+                    duration_ms = int((time.perf_counter() - start) * 1000)
+                    await db.execute('''
+                        INSERT OR REPLACE INTO schema_version (version, description, applied_at, duration_ms)
+                        VALUES (?, ?, ?, ?)
+                    ''', (migration.version, migration.description, now_ms(), duration_ms))
+                    return duration_ms
+                
+                duration_ms = await self._submit_write(job)
+                logger.info(f"在线迁移 {migration.version} 完成: {migration.description} ({duration_ms}ms)")
+                results.append({
+                    'version': migration.version,
+                    'description': migration.description,
+                    'online': True,
+                    'duration_ms': duration_ms
+                })
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logger.error(f"执行在线迁移失败: {e}")
+        return results
+    
+    async def wait_for_migrations(self) -> List[Dict]:
+        """等待 connect() 启动的在线迁移完成，返回每一步的耗时"""
+        if self._migration_task is None:
+            return []
+        # shield 保证调用方被取消时不会连带取消后台迁移
+        return await asyncio.shield(self._migration_task)
+    
+    async def migration_status(self) -> List[Dict]:
+        """列出各迁移的版本、说明以及执行时间和耗时（未执行的为 None）"""
+        try:
+            async with self._read_conn() as db:
+                async with db.execute('SELECT version, applied_at, duration_ms FROM schema_version') as cursor:
+                    applied = {row[0]: row[1:] for row in await cursor.fetchall()}
+        except Exception as e:
+            logger.error(f"获取迁移状态失败: {e}")
+            return []
+        
+        return [{
+            'version': migration.version,
+            'description': migration.description,
+            'online': migration.online,
+            'applied_at': applied.get(migration.version, (None, None))[0],
+            'duration_ms': applied.get(migration.version, (None, None))[1]
+        } for migration in MIGRATIONS]
+    
+    @uninstrumented
+    async def backup(self, directory: Optional[str] = None) -> Dict:
+        """在线备份数据库和归档库到 gzip 压缩的快照文件
+        
+        备份在线程中分步执行，不占用事件循环也不进入写任务，消息照常写入。
+        快照通过完整性检查后才会出现在备份目录中。失败时返回空字典。
+        """
+        if not self._initialized:
+            self.init_database()
+        
+        directory = config.BACKUP_DIR if directory is None else directory
+        name = f"{Path(self.db_path).stem}_{datetime.now().strftime('%Y%m%d_%H%M%S')}.db.gz"
+        try:
+            async with self._archive_lock:
+                archive_paths = {month: self._archive_path(month) for month in self._archive_months()}
+                result = await asyncio.to_thread(backup_database, self.db_path, os.path.join(directory, name),
+                                                 archive_paths=archive_paths)
+        except Exception as e:
+            logger.error(f"在线备份失败: {e}")
+            return {}
+        
+        logger.info(f"在线备份完成: {result['path']} ({result['pages']} 页, {result['duration_ms']}ms)")
+        return result
+    
+    async def _add_user(self, user: User) -> bool:
+        """插入新用户；已存在时只更新有变化的资料字段"""
+        try:
+            await self._execute_write('''
+                INSERT INTO users 
+                (user_id, username, first_name, last_name, join_date, last_active)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = excluded.username,
+                    first_name = excluded.first_name,
+                    last_name = excluded.last_name
+                WHERE username IS NOT excluded.username
+                   OR first_name IS NOT excluded.first_name
+                   OR last_name IS NOT excluded.last_name
+            ''', (user.user_id, user.username, user.first_name, 
+                  user.last_name, user.join_date, user.last_active))
+            return True
         except Exception as e:
             logger.error(f"添加用户失败: {e}")
             return False
     
-    async def update_user_activity(self, user_id: int):
-        """更新用户活动时间"""
+    async def _update_user_activity(self, user_id: int, last_active: int):
+        """写入用户活动时间"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
-                    UPDATE users SET last_active = ? WHERE user_id = ?
-                ''', (datetime.now().isoformat(), user_id))
-                await db.commit()
+            await self._execute_write('''
+                UPDATE users SET last_active = ? WHERE user_id = ?
+            ''', (last_active, user_id))
         except Exception as e:
             logger.error(f"更新用户活动失败: {e}")
     
-    async def get_user(self, user_id: int) -> Optional[User]:
-        """获取用户信息"""
+    async def _fetch_user(self, user_id: int) -> Optional[User]:
+        """从数据库读取用户"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute('''
-                    SELECT * FROM users WHERE user_id = ?
+            async with self._read_conn() as db:
+                async with db.execute(f'''
+                    SELECT {USER_SELECT} FROM users WHERE user_id = ?
                 ''', (user_id,)) as cursor:
                     row = await cursor.fetchone()
                     if row:
@@ -186,99 +1751,360 @@ class Database:
     async def add_message(self, message: Message) -> bool:
         """添加消息"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
-                    INSERT INTO messages 
-                    (message_id, user_id, chat_id, message_type, content, 
-                     file_id, file_path, timestamp)
-                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                ''', (message.message_id, message.user_id, message.chat_id,
-                      message.message_type, message.content, message.file_id,
-                      message.file_path, message.timestamp))
-                await db.commit()
-                return True
+            await self._execute_write('''
+                INSERT INTO messages 
+                (message_id, user_id, chat_id, message_type, content, 
+                 file_id, file_path, timestamp)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (message.message_id, message.user_id, message.chat_id,
+                  message.message_type, message.content, message.file_id,
+                  message.file_path, message.timestamp))
+            return True
         except Exception as e:
             logger.error(f"添加消息失败: {e}")
             return False
     
-    async def get_user_messages(self, user_id: int, limit: int = 50) -> List[Message]:
-        """获取用户消息历史"""
+    async def _write_buffered(self, messages: List[Message], activity: Dict[int, int]):
+        """在写任务的一个事务中写入缓冲的消息和活动时间"""
+        async def job(db: aiosqlite.Connection):
+            if messages:
+                # 批量写入时跳过重复的消息ID，避免一条坏数据拖垮整批
+                await db.executemany('''
+                    INSERT OR IGNORE INTO messages 
+                    (message_id, user_id, chat_id, message_type, content, 
+                     file_id, file_path, timestamp)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                ''', [(m.message_id, m.user_id, m.chat_id, m.message_type, m.content,
+                       m.file_id, m.file_path, m.timestamp) for m in messages])
+            if activity:
+                await db.executemany('''
+                    UPDATE users SET last_active = ? WHERE user_id = ?
+                ''', [(last_active, user_id) for user_id, last_active in activity.items()])
+        
+        await self._submit_write(job)
+    
+    async def get_user_messages_page(self, user_id: int, before: Optional[int] = None,
+                                     after: Optional[int] = None,
+                                     limit: int = 10) -> Tuple[List[Message], bool, bool]:
+        """按游标分页获取用户消息历史
+        
+        before/after 为上一页边界消息的ID，分别表示向更早/更新的方向翻页。
+        返回 (按时间倒序的消息, 是否还有更早的消息, 是否还有更新的消息)。
+        翻页超出热库范围时透明地从归档库读取。
+        """
+        ascending = after is not None
+        order = 'ASC' if ascending else 'DESC'
+        
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute('''
-                    SELECT * FROM messages 
-                    WHERE user_id = ? 
-                    ORDER BY timestamp DESC 
-                    LIMIT ?
-                ''', (user_id, limit)) as cursor:
+            key = None
+            if after is not None or before is not None:
+                key = await self._message_key(after if ascending else before)
+                if key is None:
+                    return [], False, False
+            
+            if key is None:
+                condition = ''
+                parameters = (user_id, limit + 1)
+            else:
+                condition = f"AND (timestamp, message_id) {'>' if ascending else '<'} (?, ?)"
+                parameters = (user_id, *key, limit + 1)
+            sql = f'''
+                SELECT {MESSAGE_SELECT} FROM messages 
+                WHERE user_id = ? {condition}
+                ORDER BY timestamp {order}, message_id {order} 
+                LIMIT ?
+            '''
+            
+            async with self._read_conn() as db:
+                async with db.execute(sql, parameters) as cursor:
                     rows = await cursor.fetchall()
-                    return [Message(*row) for row in rows]
+            rows = await self._merge_archived_page(sql, parameters, rows, limit + 1, ascending, key)
         except Exception as e:
-            logger.error(f"获取用户消息失败: {e}")
-            return []
+            logger.error(f"分页获取用户消息失败: {e}")
+            return [], False, False
+        
+        # 多取的一行只用来判断翻页方向上是否还有数据
+        has_more = len(rows) > limit
+        messages = [Message(*row) for row in rows[:limit]]
+        
+        if after is not None:
+            messages.reverse()
+            return messages, True, has_more
+        return messages, has_more, before is not None
     
-    async def add_reply(self, reply: Reply) -> bool:
-        """添加回复"""
+    async def get_user_message_stats(self, user_id: int) -> Dict:
+        """获取用户消息统计（在数据库中聚合，内存占用与消息数量无关）"""
+        sql = '''
+            SELECT message_type, COUNT(*), SUM(is_replied), MIN(timestamp), MAX(timestamp)
+            FROM messages 
+            WHERE user_id = ? 
+            GROUP BY message_type
+        '''
+        rows = []
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                # 添加回复
-                await db.execute('''
+            async with self._read_conn() as db:
+                async with db.execute(sql, (user_id,)) as cursor:
+                    rows = await cursor.fetchall()
+            # 归档库中的消息同样计入统计
+            for month in self._archive_months():
+                async with self._archive_conn(month) as conn:
+                    async with conn.execute(sql, (user_id,)) as cursor:
+                        rows.extend(await cursor.fetchall())
+        except Exception as e:
+            logger.error(f"获取用户消息统计失败: {e}")
+            return self._message_stats_from_rows([])
+        
+        # 每个库中每种消息类型一行，行数很少
+        return self._message_stats_from_rows(rows)
+    
+    async def add_replies(self, replies: List[Reply]) -> List[int]:
+        """在一个事务中添加一批回复并标记对应消息为已回复，返回各回复的ID"""
+        if not replies:
+            return []
+        
+        # 被回复的消息可能还在写缓冲中
+        if self._has_buffered_writes():
+            await self.flush_writes()
+        
+        async def job(db: aiosqlite.Connection) -> List[int]:
+            # 添加回复，由 RETURNING 直接取回新回复的ID
+            reply_ids = []
+            for reply in replies:
+                async with db.execute('''
                     INSERT INTO replies 
                     (original_message_id, admin_id, content, message_type, 
                      file_id, file_path, timestamp)
                     VALUES (?, ?, ?, ?, ?, ?, ?)
+                    RETURNING reply_id
                 ''', (reply.original_message_id, reply.admin_id, reply.content,
-                      reply.message_type, reply.file_id, reply.file_path, reply.timestamp))
-                
-                # 更新消息状态
-                await db.execute('''
-                    UPDATE messages 
-                    SET is_replied = 1, reply_message_id = last_insert_rowid()
-                    WHERE message_id = ?
-                ''', (reply.original_message_id,))
-                
-                await db.commit()
-                return True
+                      reply.message_type, reply.file_id, reply.file_path, reply.timestamp)) as cursor:
+                    reply_ids.append((await cursor.fetchone())[0])
+            
+            # 更新消息状态
+            await db.executemany('''
+                UPDATE messages 
+                SET is_replied = 1, reply_message_id = ?
+                WHERE message_id = ?
+            ''', [(reply_id, reply.original_message_id) for reply_id, reply in zip(reply_ids, replies)])
+            
+            # 已回复的消息不再占用认领
+            await db.executemany('DELETE FROM message_claims WHERE message_id = ?',
+                                 [(reply.original_message_id,) for reply in replies])
+            return reply_ids
+        
+        try:
+            reply_ids = await self._submit_write(job)
         except Exception as e:
             logger.error(f"添加回复失败: {e}")
-            return False
+            return []
+        
+        for reply, reply_id in zip(replies, reply_ids):
+            reply.reply_id = reply_id
+        return reply_ids
     
-    async def get_unreplied_messages(self) -> List[Message]:
-        """获取未回复的消息"""
+    async def get_unreplied_messages(self, limit: int = 100, after: Optional[int] = None) -> List[Message]:
+        """按时间顺序分页获取未回复的消息，after 为上一页最后一条消息的ID"""
+        if after is not None:
+            condition = 'AND (timestamp, message_id) > (SELECT timestamp, message_id FROM messages WHERE message_id = ?)'
+            parameters = (after, limit)
+        else:
+            condition = ''
+            parameters = (limit,)
+        
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute('''
-                    SELECT m.* FROM messages m
-                    LEFT JOIN replies r ON m.message_id = r.original_message_id
-                    WHERE m.is_replied = 0 AND r.reply_id IS NULL
-                    ORDER BY m.timestamp ASC
-                ''') as cursor:
+            async with self._read_conn() as db:
+                async with db.execute(f'''
+                    SELECT {MESSAGE_SELECT} FROM messages 
+                    WHERE is_replied = 0 {condition}
+                    ORDER BY timestamp ASC, message_id ASC 
+                    LIMIT ?
+                ''', parameters) as cursor:
                     rows = await cursor.fetchall()
                     return [Message(*row) for row in rows]
         except Exception as e:
             logger.error(f"获取未回复消息失败: {e}")
             return []
     
+    async def claim_unreplied(self, limit: int, admin_id: int) -> List[Message]:
+        """为管理员认领最早的未回复消息
+        
+        已被该管理员认领的消息会一并返回并续期；其他管理员的认领在
+        UNREPLIED_CLAIM_TIMEOUT 秒后过期，可被重新认领。认领在写任务中
+        用一条语句完成，多个管理员同时认领不会拿到同一条消息。
+        """
+        now = now_ms()
+        expired_before = now - config.UNREPLIED_CLAIM_TIMEOUT * 1000
+        
+        async def job(db: aiosqlite.Connection) -> List[Message]:
+            async with db.execute('''
+                INSERT OR REPLACE INTO message_claims (message_id, admin_id, claimed_at)
+                SELECT m.message_id, ?, ? FROM messages m
+                LEFT JOIN message_claims c ON c.message_id = m.message_id
+                WHERE m.is_replied = 0 
+                  AND (c.message_id IS NULL OR c.admin_id = ? OR c.claimed_at < ?)
+                ORDER BY m.timestamp ASC, m.message_id ASC
+                LIMIT ?
+                RETURNING message_id
+            ''', (admin_id, now, admin_id, expired_before, limit)) as cursor:
+                claimed = [row[0] for row in await cursor.fetchall()]
+            
+            if not claimed:
+                return []
+            
+            placeholders = ','.join('?' * len(claimed))
+            async with db.execute(f'''
+                SELECT {MESSAGE_SELECT} FROM messages WHERE message_id IN ({placeholders})
+                ORDER BY timestamp ASC, message_id ASC
+            ''', claimed) as cursor:
+                return [Message(*row) for row in await cursor.fetchall()]
+        
+        try:
+            await self.flush_writes()
+            return await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"认领未回复消息失败: {e}")
+            return []
+    
+    async def search(self, query: str, user_id: Optional[int] = None, limit: int = 10,
+                     cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """全文搜索消息和回复内容，按相关度排序
+        
+        cursor 为上一页返回的游标，返回 (结果列表, 下一页游标)，没有更多结果时
+        下一页游标为 None。游标记录上一页最后一条的 (rank, rowid)，翻页直接从
+        该位置继续，不需要重新扫描前面的结果。新写入的内容会改变全部 rank 值，
+        因此翻页时按 rowid 重新读取这一条当前的 rank，它已不存在时才用游标中的值。
+        """
+        terms = [term for term in query.split() if term]
+        if not terms:
+            return [], None
+        
+        # 每个检索词按短语匹配，避免用户输入被当作 FTS 语法解析
+        match_terms = [term for term in terms if len(term) >= SEARCH_MIN_TERM_LENGTH]
+        short_terms = [term for term in terms if len(term) < SEARCH_MIN_TERM_LENGTH]
+        
+        conditions = []
+        parameters: List = []
+        if match_terms:
+            conditions.append('search_index MATCH ?')
+            parameters.append(' '.join('"' + term.replace('"', '""') + '"' for term in match_terms))
+        for term in short_terms:
+            # 过短的检索词无法使用 trigram 索引，退化为子串匹配
+            conditions.append("content LIKE ? ESCAPE '\\'")
+            escaped = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            parameters.append(f'%{escaped}%')
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            parameters.append(user_id)
+        
+        # 有 MATCH 条件时按相关度排序，否则按时间倒序；游标为排序键
+        if match_terms:
+            order = 'rank, rowid'
+            snippet = "snippet(search_index, 0, '[', ']', '…', 16)"
+            rank = 'rank'
+        else:
+            order = 'rowid DESC'
+            snippet = 'substr(content, 1, 80)'
+            rank = '0'
+        
+        last_rank, last_rowid = 0.0, 0
+        if cursor:
+            try:
+                if match_terms:
+                    rank_text, rowid_text = cursor.split(':')
+                    last_rank, last_rowid = float(rank_text), int(rowid_text)
+                else:
+                    last_rowid = int(cursor)
+            except ValueError:
+                logger.warning(f"无效的搜索游标: {cursor}")
+                return [], None
+        
+        try:
+            async with self._read_conn() as db:
+                if cursor and match_terms:
+                    async with db.execute(
+                            'SELECT rank FROM search_index WHERE search_index MATCH ? AND rowid = ?',
+                            (parameters[0], last_rowid)) as db_cursor:
+                        row = await db_cursor.fetchone()
+                    if row:
+                        last_rank = row[0]
+                    conditions.append('(rank > ? OR (rank = ? AND rowid > ?))')
+                    parameters.extend([last_rank, last_rank, last_rowid])
+                elif cursor:
+                    conditions.append('rowid < ?')
+                    parameters.append(last_rowid)
+                
+                async with db.execute(f'''
+                    SELECT rowid, {snippet}, user_id, timestamp, {rank} FROM search_index
+                    WHERE {' AND '.join(conditions)}
+                    ORDER BY {order}
+                    LIMIT ?
+                ''', (*parameters, limit + 1)) as db_cursor:
+                    rows = await db_cursor.fetchall()
+        except Exception as e:
+            logger.error(f"全文搜索失败: {e}")
+            return [], None
+        
+        results = []
+        for rowid, text, owner_id, timestamp, _ in rows[:limit]:
+            results.append({
+                'kind': 'reply' if rowid % 2 else 'message',
+                'id': rowid // 2,
+                'user_id': owner_id,
+                'timestamp': timestamp,
+                'snippet': text
+            })
+        
+        next_cursor = None
+        if len(rows) > limit:
+            last = rows[limit - 1]
+            next_cursor = f'{last[4]!r}:{last[0]}' if match_terms else str(last[0])
+        return results, next_cursor
+    
+    async def release_claims(self, admin_id: int) -> int:
+        """释放管理员认领的全部消息"""
+        try:
+            return await self._execute_write('DELETE FROM message_claims WHERE admin_id = ?', (admin_id,))
+        except Exception as e:
+            logger.error(f"释放认领失败: {e}")
+            return 0
+    
     async def get_message_with_replies(self, message_id: int) -> Tuple[Optional[Message], List[Reply]]:
         """获取消息及其回复"""
+        if self._has_buffered_writes():
+            await self.flush_writes()
+        
         try:
-            async with aiosqlite.connect(self.db_path) as db:
+            async with self._read_conn() as db:
                 # 获取消息
-                async with db.execute('''
-                    SELECT * FROM messages WHERE message_id = ?
+                async with db.execute(f'''
+                    SELECT {MESSAGE_SELECT} FROM messages WHERE message_id = ?
                 ''', (message_id,)) as cursor:
                     row = await cursor.fetchone()
                     message = Message(*row) if row else None
                 
                 # 获取回复
-                async with db.execute('''
-                    SELECT * FROM replies WHERE original_message_id = ?
+                async with db.execute(f'''
+                    SELECT {REPLY_SELECT} FROM replies WHERE original_message_id = ?
                     ORDER BY timestamp ASC
                 ''', (message_id,)) as cursor:
                     rows = await cursor.fetchall()
-                    replies = [Reply(*row) for row in rows]
-                
-                return message, replies
+            
+            # 已归档的消息及其回复从归档库读取；归档后新增的回复仍在热库中
+            if message is None:
+                found = await self._find_archived(
+                    f'SELECT {MESSAGE_SELECT} FROM messages WHERE message_id = ?', (message_id,))
+                if found:
+                    month, row = found
+                    message = Message(*row)
+                    async with self._archive_conn(month) as conn:
+                        async with conn.execute(f'''
+                            SELECT {REPLY_SELECT} FROM replies WHERE original_message_id = ?
+                        ''', (message_id,)) as cursor:
+                            archived = await cursor.fetchall()
+                    rows = sorted(archived + list(rows), key=lambda row: row[7])
+            
+            replies = [Reply(*row) for row in rows]
+            return message, replies
         except Exception as e:
             logger.error(f"获取消息及回复失败: {e}")
             return None, []
@@ -286,15 +2112,13 @@ class Database:
     async def add_update(self, update_info: UpdateInfo) -> bool:
         """添加更新信息"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                await db.execute('''
-                    INSERT OR REPLACE INTO updates 
-                    (version, description, download_url, release_date, is_forced, changelog)
-                    VALUES (?, ?, ?, ?, ?, ?)
-                ''', (update_info.version, update_info.description, update_info.download_url,
-                      update_info.release_date, update_info.is_forced, update_info.changelog))
-                await db.commit()
-                return True
+            await self._execute_write('''
+                INSERT OR REPLACE INTO updates 
+                (version, description, download_url, release_date, is_forced, changelog)
+                VALUES (?, ?, ?, ?, ?, ?)
+            ''', (update_info.version, update_info.description, update_info.download_url,
+                  update_info.release_date, update_info.is_forced, update_info.changelog))
+            return True
         except Exception as e:
             logger.error(f"添加更新信息失败: {e}")
             return False
@@ -302,9 +2126,9 @@ class Database:
     async def get_latest_update(self) -> Optional[UpdateInfo]:
         """获取最新更新信息"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute('''
-                    SELECT * FROM updates 
+            async with self._read_conn() as db:
+                async with db.execute(f'''
+                    SELECT {UPDATE_SELECT} FROM updates 
                     ORDER BY release_date DESC 
                     LIMIT 1
                 ''') as cursor:
@@ -315,35 +2139,666 @@ class Database:
             return None
     
     async def get_stats(self) -> Dict:
-        """获取统计信息"""
+        """获取统计信息（读取触发器维护的计数器，常数时间）"""
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                stats = {}
-                
-                # 用户统计
-                async with db.execute('SELECT COUNT(*) FROM users') as cursor:
+            async with self._read_conn() as db:
+                async with db.execute('SELECT name, value FROM counters') as cursor:
+                    rows = await cursor.fetchall()
+            
+            stats = {name: 0 for name in [*COUNTER_QUERIES, *ARCHIVE_COUNTERS]}
+            stats.update({name: value for name, value in rows if name in stats})
+            # 总数包含已移入归档库的消息和回复
+            stats['total_messages'] += stats['archived_messages']
+            stats['total_replies'] += stats['archived_replies']
+            return stats
+        except Exception as e:
+            logger.error(f"获取统计信息失败: {e}")
+            return {}
+    
+    async def reconcile_counters(self) -> Dict:
+        """按实际数据重建计数器，返回重建后的值"""
+        async def job(db: aiosqlite.Connection) -> Dict:
+            async with db.execute('SELECT name, value FROM counters') as cursor:
+                before = dict(await cursor.fetchall())
+            for statement in reconcile_statements():
+                await db.execute(statement)
+            async with db.execute('SELECT name, value FROM counters') as cursor:
+                after = dict(await cursor.fetchall())
+            
+            for name, value in after.items():
+                if before.get(name) != value:
+                    logger.warning(f"计数器 {name} 已校正: {before.get(name)} -> {value}")
+            return after
+        
+        try:
+            # 先把写缓冲落盘，避免校正后立刻又产生偏差
+            await self.flush_writes()
+            return await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"重建计数器失败: {e}")
+            return {}
+    
+    async def iter_table(self, table: str, chunk_size: int = config.EXPORT_CHUNK_SIZE):
+        """按主键顺序分块读取整张表，消息和回复表包括归档库中的行
+        
+        每块是一次独立的短查询，读连接在块之间归还连接池，导出大表
+        既不阻塞写任务，也不会长期持有读快照妨碍 WAL 检查点。
+        """
+        columns = TABLE_COLUMNS[table]
+        sql = f'''
+            SELECT {', '.join(columns)} FROM {table}
+            WHERE {columns[0]} > ?
+            ORDER BY {columns[0]}
+            LIMIT ?
+        '''
+        
+        last_key = -2 ** 63
+        while True:
+            async with self._read_conn() as db:
+                async with db.execute(sql, (last_key, chunk_size)) as cursor:
+                    rows = await cursor.fetchall()
+            if not rows:
+                break
+            yield rows
+            last_key = rows[-1][0]
+        
+        if table not in ARCHIVE_TABLES:
+            return
+        for month in self._archive_months():
+            last_key = -2 ** 63
+            async with self._archive_conn(month) as conn:
+                while True:
+                    async with conn.execute(sql, (last_key, chunk_size)) as cursor:
+                        rows = await cursor.fetchall()
+                    if not rows:
+                        break
+                    yield rows
+                    last_key = rows[-1][0]
+    
+    async def import_rows(self, table: str, rows: List[Tuple]) -> int:
+        """由写任务在一个事务中写入一块行，主键已存在的行跳过"""
+        columns = TABLE_COLUMNS[table]
+        
+        async def job(db: aiosqlite.Connection) -> int:
+            cursor = await db.executemany(f'''
+                INSERT OR IGNORE INTO {table} ({', '.join(columns)})
+                VALUES ({', '.join('?' * len(columns))})
+            ''', rows)
+            return cursor.rowcount
+        
+        count = await self._submit_write(job)
+        if table == 'users':
+            self._forget_user_profiles()
+        return count
+    
+    @uninstrumented
+    async def archive_old_messages(self, older_than_days: Optional[int] = None) -> Dict[str, int]:
+        """把已回复且早于指定天数的消息及其回复移入按月分区的归档库
+        
+        未回复的消息始终留在热库中，收件箱不受影响。每批消息先在写任务之外
+        写入归档库，再由写任务核对后从热库删除；中途失败时重复执行即可，不会丢失数据。
+        全文索引保留在热库中，归档的内容仍可搜索。返回 {归档月份: 归档消息数}。
+        """
+        days = config.ARCHIVE_AFTER_DAYS if older_than_days is None else older_than_days
+        cutoff = now_ms() - days * 86400 * 1000
+        
+        async def job(db: aiosqlite.Connection, messages: List[Tuple], replies: List[Tuple],
+                      message_months: Dict[int, str]) -> Tuple[Dict[str, int], List[int]]:
+            # 选出这批消息之后热库中的行可能又有变化（新的回复、已读状态等），
+            # 只删除与归档库中副本完全一致的消息，其余的留到下一批重新归档
+            ids = [row[0] for row in messages]
+            placeholders = ','.join('?' * len(ids))
+            async with db.execute(f'''
+                SELECT {MESSAGE_SELECT} FROM messages WHERE message_id IN ({placeholders})
+            ''', ids) as cursor:
+                current_messages = {row[0]: row for row in await cursor.fetchall()}
+            async with db.execute(f'''
+                SELECT {REPLY_SELECT} FROM replies WHERE original_message_id IN ({placeholders})
+            ''', ids) as cursor:
+                current_replies = group_replies(await cursor.fetchall())
+            archived_replies = group_replies(replies)
+            
+            moved = [row for row in messages
+                     if current_messages.get(row[0]) == row
+                     and current_replies.get(row[0], set()) == archived_replies.get(row[0], set())]
+            moved_ids = {row[0] for row in moved}
+            moved_replies = [row for row in replies if row[1] in moved_ids]
+            stale = [message_id for message_id in ids if message_id not in moved_ids]
+            if not moved:
+                return {}, stale
+            
+            placeholders = ','.join('?' * len(moved_ids))
+            await db.execute(f'DELETE FROM replies WHERE original_message_id IN ({placeholders})', list(moved_ids))
+            await db.execute(f'DELETE FROM message_claims WHERE message_id IN ({placeholders})', list(moved_ids))
+            await db.execute(f'DELETE FROM messages WHERE message_id IN ({placeholders})', list(moved_ids))
+            # 删除触发器同时移除了全文索引行，归档的内容仍要能被 /search 搜到
+            owners = {row[0]: row[1] for row in moved}
+            await db.executemany('''
+                INSERT INTO search_index (rowid, content, user_id, timestamp) VALUES (?, ?, ?, ?)
+            ''', [(row[0] * 2, row[4], row[1], row[7]) for row in moved if row[4]] +
+                [(row[0] * 2 + 1, row[3], owners[row[1]], row[7]) for row in moved_replies if row[3]])
+            await db.execute("UPDATE counters SET value = value + ? WHERE name = 'archived_messages'",
+                             (len(moved),))
+            await db.execute("UPDATE counters SET value = value + ? WHERE name = 'archived_replies'",
+                             (len(moved_replies),))
+            
+            counts: Dict[str, int] = {}
+            for row in moved:
+                month = message_months[row[0]]
+                counts[month] = counts.get(month, 0) + 1
+            return counts, stale
+        
+        archived: Dict[str, int] = {}
+        try:
+            await self.flush_writes()
+            async with self._archive_lock:
+                # 分批处理：读取和写归档库都不进入写任务，写任务只负责从热库删除
+                while True:
+                    async with self._read_conn() as db:
+                        async with db.execute(f'''
+                            SELECT {MESSAGE_SELECT} FROM messages 
+                            WHERE timestamp < ? AND is_replied = 1 
+                            ORDER BY timestamp ASC 
+                            LIMIT ?
+                        ''', (cutoff, config.ARCHIVE_BATCH_SIZE)) as cursor:
+                            messages = await cursor.fetchall()
+                        if not messages:
+                            break
+                        
+                        ids = [row[0] for row in messages]
+                        placeholders = ','.join('?' * len(ids))
+                        async with db.execute(f'''
+                            SELECT {REPLY_SELECT} FROM replies WHERE original_message_id IN ({placeholders})
+                        ''', ids) as cursor:
+                            replies = await cursor.fetchall()
+                    
+                    # 回复与其原消息归入同一个月份
+                    months: Dict[str, Tuple[List, List]] = {}
+                    message_months = {}
+                    for row in messages:
+                        month = message_months[row[0]] = archive_month(row[7])
+                        months.setdefault(month, ([], []))[0].append(row)
+                    for row in replies:
+                        months[message_months[row[1]]][1].append(row)
+                    for month, (month_messages, month_replies) in months.items():
+                        await self._write_archive(month, month_messages, month_replies)
+                    
+                    batch, stale = await self._submit_write(
+                        functools.partial(job, messages=messages, replies=replies,
+                                          message_months=message_months))
+                    # 没有从热库删除的消息不能留在归档库中，否则会被重复计数
+                    for month in {message_months[message_id] for message_id in stale}:
+                        await self._remove_archived(month, [message_id for message_id in stale
+                                                            if message_months[message_id] == month])
+                    if not batch:
+                        break
+                    for month, count in batch.items():
+                        archived[month] = archived.get(month, 0) + count
+        except Exception as e:
+            logger.error(f"归档消息失败: {e}")
+        
+        if archived:
+            logger.info(f"已归档 {sum(archived.values())} 条消息: {archived}")
+        return archived
+    
+    @uninstrumented
+    async def reindex_archives(self) -> int:
+        """把归档库中的消息和回复补回全文索引，已在索引中的跳过，返回补回的行数
+        
+        早期版本归档时会连同全文索引行一起删除，升级后执行一次即可恢复搜索。
+        """
+        statements = [
+            '''
+            SELECT message_id * 2, content, user_id, timestamp FROM messages
+            WHERE content IS NOT NULL AND content != ''
+            ''',
+            '''
+            SELECT r.reply_id * 2 + 1, r.content, m.user_id, r.timestamp
+            FROM replies r LEFT JOIN messages m ON m.message_id = r.original_message_id
+            WHERE r.content IS NOT NULL AND r.content != ''
+            ''',
+        ]
+        
+        total = 0
+        try:
+            for month in self._archive_months():
+                async with self._archive_conn(month) as conn:
+                    for sql in statements:
+                        async with conn.execute(sql) as cursor:
+                            while rows := await cursor.fetchmany(config.ARCHIVE_BATCH_SIZE):
+                                async def job(db: aiosqlite.Connection, rows: List[Tuple] = rows) -> int:
+                                    cursor = await db.executemany('''
+                                        INSERT INTO search_index (rowid, content, user_id, timestamp)
+                                        SELECT ?, ?, ?, ?
+                                        WHERE NOT EXISTS (SELECT 1 FROM search_index WHERE rowid = ?)
+                                    ''', [(*row, row[0]) for row in rows])
+                                    return cursor.rowcount
+                                
+                                total += await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"重建归档全文索引失败: {e}")
+        
+        if total:
+            logger.info(f"已把 {total} 条归档内容补回全文索引")
+        return total
+    
+    @staticmethod
+    def _admin_from_row(row: Tuple) -> Dict:
+        """把管理员行转换为字典"""
+        admin = dict(zip(ADMIN_COLUMNS, row))
+        admin['is_super_admin'] = bool(admin['is_super_admin'])
+        admin['is_online'] = bool(admin['is_online'])
+        return admin
+    
+    async def get_admins(self) -> Optional[List[Dict]]:
+        """获取全部管理员，失败时返回 None"""
+        try:
+            async with self._read_conn() as db:
+                async with db.execute(f'SELECT {ADMIN_SELECT} FROM admins') as cursor:
+                    rows = await cursor.fetchall()
+        except Exception as e:
+            logger.error(f"获取管理员列表失败: {e}")
+            return None
+        return [self._admin_from_row(row) for row in rows]
+    
+    async def get_admin_by_username(self, username: str) -> Optional[Dict]:
+        """按用户名查找管理员，同名时返回最早加入的"""
+        try:
+            async with self._read_conn() as db:
+                async with db.execute(f'SELECT {ADMIN_SELECT} FROM admins WHERE username = ? '
+                                      f'ORDER BY join_date, user_id LIMIT 1',
+                                      (username,)) as cursor:
                     row = await cursor.fetchone()
-                    stats['total_users'] = row[0] if row else 0
+        except Exception as e:
+            logger.error(f"按用户名查找管理员失败: {e}")
+            return None
+        return self._admin_from_row(row) if row else None
+    
+    async def get_private_chat_requests(self, admin_id: Optional[int] = None,
+                                        status: Optional[str] = None,
+                                        user_id: Optional[int] = None) -> Optional[List[Dict]]:
+        """按管理员、状态和用户获取私聊请求，使用 (admin_id, status) 索引或主键，失败时返回 None"""
+        conditions = []
+        parameters = []
+        if admin_id is not None:
+            conditions.append('admin_id = ?')
+            parameters.append(admin_id)
+        if status is not None:
+            conditions.append('status = ?')
+            parameters.append(status)
+        if user_id is not None:
+            conditions.append('user_id = ?')
+            parameters.append(user_id)
+        where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+        
+        try:
+            async with self._read_conn() as db:
+                async with db.execute(f'''
+                    SELECT {PRIVATE_CHAT_SELECT} FROM private_chat_requests {where}
+                    ORDER BY request_time
+                ''', parameters) as cursor:
+                    rows = await cursor.fetchall()
+        except Exception as e:
+            logger.error(f"获取私聊请求失败: {e}")
+            return None
+        return [dict(zip(PRIVATE_CHAT_COLUMNS, row)) for row in rows]
+    
+    async def create_private_chat_request(self, request: Dict, max_chats: int) -> bool:
+        """用户没有私聊请求且管理员私聊未满时插入请求，检查和插入在同一条语句中完成"""
+        async def job(db: aiosqlite.Connection) -> bool:
+            cursor = await db.execute(f'''
+                INSERT INTO private_chat_requests ({PRIVATE_CHAT_SELECT})
+                SELECT {', '.join('?' * len(PRIVATE_CHAT_COLUMNS))}
+                WHERE (SELECT COUNT(*) FROM private_chat_requests 
+                       WHERE admin_id = ? AND status = 'accepted') < ?
+                ON CONFLICT (user_id) DO NOTHING
+            ''', (*(request[column] for column in PRIVATE_CHAT_COLUMNS), request['admin_id'], max_chats))
+            return cursor.rowcount == 1
+        
+        try:
+            return await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"创建私聊请求失败: {e}")
+            return False
+    
+    async def update_private_chat_status(self, user_id: int, admin_id: int, old_status: str,
+                                         new_status: str) -> Optional[Dict]:
+        """条件更新单行私聊请求的状态，接受时 chat_id 设为用户ID"""
+        async def job(db: aiosqlite.Connection) -> Optional[Tuple]:
+            async with db.execute(f'''
+                UPDATE private_chat_requests 
+                SET status = ?, chat_id = CASE WHEN ? = 'accepted' THEN user_id ELSE chat_id END
+                WHERE user_id = ? AND admin_id = ? AND status = ?
+                RETURNING {PRIVATE_CHAT_SELECT}
+            ''', (new_status, new_status, user_id, admin_id, old_status)) as cursor:
+                return await cursor.fetchone()
+        
+        try:
+            row = await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"修改私聊请求状态失败: {e}")
+            return None
+        return dict(zip(PRIVATE_CHAT_COLUMNS, row)) if row else None
+    
+    async def reassign_private_chat_request(self, user_id: int, old_admin_id: int, new_admin_id: int,
+                                            request_time: str, max_chats: int) -> Optional[Dict]:
+        """条件修改待处理请求的管理员，容量检查与创建请求相同"""
+        async def job(db: aiosqlite.Connection) -> Optional[Tuple]:
+            async with db.execute(f'''
+                UPDATE private_chat_requests SET admin_id = ?, request_time = ?
+                WHERE user_id = ? AND admin_id = ? AND status = 'pending'
+                  AND (SELECT COUNT(*) FROM private_chat_requests 
+                       WHERE admin_id = ? AND status = 'accepted') < ?
+                RETURNING {PRIVATE_CHAT_SELECT}
+            ''', (new_admin_id, request_time, user_id, old_admin_id, new_admin_id, max_chats)) as cursor:
+                return await cursor.fetchone()
+        
+        try:
+            row = await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"转交私聊请求失败: {e}")
+            return None
+        return dict(zip(PRIVATE_CHAT_COLUMNS, row)) if row else None
+    
+    async def delete_private_chat_request(self, user_id: int, admin_id: int, status: str) -> bool:
+        """条件删除单行私聊请求"""
+        async def job(db: aiosqlite.Connection) -> bool:
+            cursor = await db.execute('''
+                DELETE FROM private_chat_requests WHERE user_id = ? AND admin_id = ? AND status = ?
+            ''', (user_id, admin_id, status))
+            return cursor.rowcount == 1
+        
+        try:
+            return await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"删除私聊请求失败: {e}")
+            return False
+    
+    async def expire_private_chat_requests(self, before: str) -> Optional[List[Dict]]:
+        """删除过期的待处理请求并返回被删除的请求"""
+        async def job(db: aiosqlite.Connection) -> List[Tuple]:
+            async with db.execute(f'''
+                DELETE FROM private_chat_requests WHERE status = 'pending' AND request_time < ?
+                RETURNING {PRIVATE_CHAT_SELECT}
+            ''', (before,)) as cursor:
+                return await cursor.fetchall()
+        
+        try:
+            rows = await self._submit_write(job)
+        except Exception as e:
+            logger.error(f"清理过期私聊请求失败: {e}")
+            return None
+        return [dict(zip(PRIVATE_CHAT_COLUMNS, row)) for row in rows]
+    
+    async def save_admin_state(self, added_admins: List[Dict], admins: List[Dict], deleted_admins: List[int],
+                               requests: List[Dict], deleted_requests: List[int]) -> bool:
+        """在一个事务中写入或删除管理员和私聊请求，已有的行不会被整行覆盖"""
+        def insert(table: str, columns: List[str]) -> str:
+            return f'''
+                INSERT INTO {table} ({', '.join(columns)}) VALUES ({', '.join('?' * len(columns))})
+                ON CONFLICT ({columns[0]}) DO NOTHING
+            '''
+        
+        updates = ', '.join(f'{column} = ?' for column in ADMIN_COLUMNS[1:])
+        
+        async def job(db: aiosqlite.Connection):
+            if added_admins:
+                await db.executemany(insert('admins', ADMIN_COLUMNS),
+                                     [tuple(admin[column] for column in ADMIN_COLUMNS) for admin in added_admins])
+            if admins:
+                await db.executemany(f'UPDATE admins SET {updates} WHERE user_id = ?',
+                                     [(*(admin[column] for column in ADMIN_COLUMNS[1:]), admin['user_id'])
+                                      for admin in admins])
+            if deleted_admins:
+                await db.executemany('DELETE FROM admins WHERE user_id = ?',
+                                     [(user_id,) for user_id in deleted_admins])
+            if requests:
+                await db.executemany(insert('private_chat_requests', PRIVATE_CHAT_COLUMNS),
+                                     [tuple(request[column] for column in PRIVATE_CHAT_COLUMNS)
+                                      for request in requests])
+            if deleted_requests:
+                await db.executemany('DELETE FROM private_chat_requests WHERE user_id = ?',
+                                     [(user_id,) for user_id in deleted_requests])
+        
+        try:
+            await self._submit_write(job)
+            return True
+        except Exception as e:
+            logger.error(f"保存管理员数据失败: {e}")
+            return False
+    
+    @uninstrumented
+    async def purge_expired(self, retention_days: Optional[Dict[str, int]] = None) -> Dict[str, int]:
+        """按消息类型的保留天数删除过期消息及其回复，返回 {消息类型: 删除的消息数}
+        
+        retention_days 中 '*' 表示未单独配置的类型，未配置或为 0 的类型永久保留。
+        每个写事务最多删除 RETENTION_BATCH_SIZE 条消息，批次之间暂停
+        RETENTION_BATCH_DELAY_MS 毫秒，删除期间消息照常写入。归档库按同样的
+        规则清理，删空的月份直接删除归档文件。
+        """
+        retention_days = config.RETENTION_DAYS if retention_days is None else retention_days
+        if not any(retention_days.values()):
+            return {}
+        
+        now = now_ms()
+        purged: Dict[str, int] = {}
+        try:
+            async with self._read_conn() as db:
+                async with db.execute('SELECT DISTINCT message_type FROM messages') as cursor:
+                    message_types = [row[0] for row in await cursor.fetchall()]
+            
+            for message_type in message_types:
+                days = retention_days.get(message_type, retention_days.get('*'))
+                if not days:
+                    continue
+                cutoff = now - days * 86400 * 1000
                 
-                # 消息统计
-                async with db.execute('SELECT COUNT(*) FROM messages') as cursor:
-                    row = await cursor.fetchone()
-                    stats['total_messages'] = row[0] if row else 0
+                async def job(db: aiosqlite.Connection, message_type: str = message_type,
+                              cutoff: int = cutoff) -> int:
+                    async with db.execute('''
+                        SELECT message_id FROM messages 
+                        WHERE message_type = ? AND timestamp < ? 
+                        LIMIT ?
+                    ''', (message_type, cutoff, config.RETENTION_BATCH_SIZE)) as cursor:
+                        ids = [row[0] for row in await cursor.fetchall()]
+                    if not ids:
+                        return 0
+                    
+                    # 计数器和全文索引由删除触发器同步
+                    placeholders = ','.join('?' * len(ids))
+                    await db.execute(f'DELETE FROM replies WHERE original_message_id IN ({placeholders})', ids)
+                    await db.execute(f'DELETE FROM message_claims WHERE message_id IN ({placeholders})', ids)
+                    await db.execute(f'DELETE FROM messages WHERE message_id IN ({placeholders})', ids)
+                    return len(ids)
                 
-                # 回复统计
-                async with db.execute('SELECT COUNT(*) FROM replies') as cursor:
-                    row = await cursor.fetchone()
-                    stats['total_replies'] = row[0] if row else 0
+                while True:
+                    count = await self._submit_write(job)
+                    if not count:
+                        break
+                    purged[message_type] = purged.get(message_type, 0) + count
+                    await asyncio.sleep(config.RETENTION_BATCH_DELAY_MS / 1000)
+            
+            async with self._archive_lock:
+                for month in self._archive_months():
+                    await self._purge_archive(month, retention_days, now, purged)
+        except Exception as e:
+            logger.error(f"删除过期消息失败: {e}")
+        finally:
+            self._forget_user_profiles()
+        
+        return purged
+    
+    async def _purge_archive(self, month: str, retention_days: Dict[str, int], now: int,
+                             purged: Dict[str, int]):
+        """按保留天数清理一个归档库，删除的消息数累加到 purged，删空后删除归档文件
+        
+        每批先由写任务删除全文索引行、扣减计数器并在 archive_purges 中记下这批
+        消息，再在写任务之外从归档库删除，最后清除记录。中途失败时，下次执行
+        先补完已记录的删除，计数器不会重复扣减。
+        """
+        path = self._archive_path(month)
+        start, _ = month_bounds(month)
+        await self._finish_archive_purge(month)
+        
+        async with self._archive_conn(month) as conn:
+            async with conn.execute('SELECT DISTINCT message_type FROM messages') as cursor:
+                message_types = [row[0] for row in await cursor.fetchall()]
+        
+        for message_type in message_types:
+            days = retention_days.get(message_type, retention_days.get('*'))
+            if not days or start >= now - days * 86400 * 1000:
+                continue
+            
+            cutoff = now - days * 86400 * 1000
+            while True:
+                async with self._archive_conn(month) as conn:
+                    async with conn.execute('''
+                        SELECT message_id FROM messages 
+                        WHERE message_type = ? AND timestamp < ? 
+                        LIMIT ?
+                    ''', (message_type, cutoff, config.RETENTION_BATCH_SIZE)) as cursor:
+                        ids = [row[0] for row in await cursor.fetchall()]
+                    if not ids:
+                        break
+                    placeholders = ','.join('?' * len(ids))
+                    async with conn.execute(f'''
+                        SELECT reply_id FROM replies WHERE original_message_id IN ({placeholders})
+                    ''', ids) as cursor:
+                        reply_ids = [row[0] for row in await cursor.fetchall()]
                 
-                # 未回复消息
-                async with db.execute('SELECT COUNT(*) FROM messages WHERE is_replied = 0') as cursor:
-                    row = await cursor.fetchone()
-                    stats['unreplied_messages'] = row[0] if row else 0
+                async def job(db: aiosqlite.Connection, ids: List[int] = ids,
+                              reply_ids: List[int] = reply_ids):
+                    await db.executemany('DELETE FROM search_index WHERE rowid = ?',
+                                         [(message_id * 2,) for message_id in ids] +
+                                         [(reply_id * 2 + 1,) for reply_id in reply_ids])
+                    await db.execute("UPDATE counters SET value = value - ? WHERE name = 'archived_messages'",
+                                     (len(ids),))
+                    await db.execute("UPDATE counters SET value = value - ? WHERE name = 'archived_replies'",
+                                     (len(reply_ids),))
+                    await db.executemany('INSERT OR IGNORE INTO archive_purges (month, message_id) VALUES (?, ?)',
+                                         [(month, message_id) for message_id in ids])
                 
-                return stats
+                await self._submit_write(job)
+                await self._finish_archive_purge(month)
+                purged[message_type] = purged.get(message_type, 0) + len(ids)
+                await asyncio.sleep(config.RETENTION_BATCH_DELAY_MS / 1000)
+        
+        async with self._archive_conn(month) as conn:
+            async with conn.execute('SELECT 1 FROM messages LIMIT 1') as cursor:
+                empty = await cursor.fetchone() is None
+        if empty:
+            # 回复总是与原消息归入同一个月份，没有消息的归档库也没有回复
+            os.remove(path)
+            logger.info(f"归档月份 {month} 已全部过期，删除归档文件 {path}")
+    
+    async def _finish_archive_purge(self, month: str):
+        """从归档库删除 archive_purges 中已记录的消息（热库一侧已经处理），然后清除记录"""
+        async with self._read_conn() as db:
+            async with db.execute('SELECT message_id FROM archive_purges WHERE month = ?', (month,)) as cursor:
+                ids = [row[0] for row in await cursor.fetchall()]
+        if not ids:
+            return
+        
+        await self._remove_archived(month, ids)
+        
+        async def job(db: aiosqlite.Connection):
+            await db.executemany('DELETE FROM archive_purges WHERE month = ? AND message_id = ?',
+                                 [(month, message_id) for message_id in ids])
+        
+        await self._submit_write(job)
+    
+    @uninstrumented
+    async def purge_old_updates(self, keep: int = config.UPDATE_KEEP_VERSIONS) -> int:
+        """只保留最新的 keep 条更新记录，keep 为 0 时全部保留，返回删除的条数"""
+        if keep <= 0:
+            return 0
+        
+        async def job(db: aiosqlite.Connection) -> int:
+            cursor = await db.execute('''
+                DELETE FROM updates WHERE version NOT IN (
+                    SELECT version FROM updates ORDER BY release_date DESC LIMIT ?
+                )
+            ''', (keep,))
+            return cursor.rowcount
+        
+        try:
+            return await self._submit_write(job)
         except Exception as e:
-            logger.error(f"获取统计信息失败: {e}")
-            return {}
+            logger.error(f"删除旧更新记录失败: {e}")
+            return 0
+    
+    @uninstrumented
+    async def incremental_vacuum(self, pages_per_step: int = config.RETENTION_VACUUM_PAGES) -> int:
+        """分步把空闲页归还给文件系统，返回回收的页数
+        
+        每步在写任务中回收最多 pages_per_step 页，步与步之间让出写任务。
+        WAL 模式下数据库文件在下次检查点时才会变小。
+        """
+        async def job(db: aiosqlite.Connection) -> int:
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                before = (await cursor.fetchone())[0]
+            if not before:
+                return 0
+            # 必须取完结果，否则每执行一步只回收一页
+            async with db.execute(f'PRAGMA incremental_vacuum({max(1, pages_per_step)})') as cursor:
+                await cursor.fetchall()
+            async with db.execute('PRAGMA freelist_count') as cursor:
+                return before - (await cursor.fetchone())[0]
+        
+        reclaimed = 0
+        try:
+            while True:
+                # 未开启 auto_vacuum = INCREMENTAL 时空闲页数不会减少
+                pages = await self._submit_write(job)
+                if not pages:
+                    break
+                reclaimed += pages
+                await asyncio.sleep(config.RETENTION_BATCH_DELAY_MS / 1000)
+        except Exception as e:
+            logger.error(f"回收空闲页失败: {e}")
+        return reclaimed
+    
+    @uninstrumented
+    async def run_retention(self) -> Dict:
+        """删除过期消息和旧更新记录，再分步回收空闲页，返回删除条数和回收的字节数"""
+        purged = await self.purge_expired()
+        updates = await self.purge_old_updates()
+        pages = await self.incremental_vacuum()
+        
+        try:
+            async with self._read_conn() as db:
+                async with db.execute('PRAGMA page_size') as cursor:
+                    page_size = (await cursor.fetchone())[0]
+        except Exception as e:
+            logger.error(f"获取页大小失败: {e}")
+            page_size = 0
+        
+        report = {
+            'purged_messages': purged,
+            'purged_updates': updates,
+            'reclaimed_pages': pages,
+            'reclaimed_bytes': pages * page_size
+        }
+        if purged or updates or pages:
+            logger.info(f"保留策略执行完成: 删除消息 {sum(purged.values())} 条, "
+                        f"更新记录 {updates} 条, 回收 {pages * page_size} 字节")
+        return report
+
+instrument_methods(BaseDatabase)
+
+# 保持旧名称可用
+Database = SQLiteDatabase
+
+def create_database(url: str = config.DATABASE_URL) -> BaseDatabase:
+    """按 DATABASE_URL 选择存储后端
+    
+    postgres:// 或 postgresql:// 开头时使用 PostgreSQL（需要安装 asyncpg），
+    否则视为 SQLite 数据库文件路径。
+    """
+    if url.startswith(('postgres://', 'postgresql://')):
+        from pg_database import PostgresDatabase
+        return PostgresDatabase(url)
+    return SQLiteDatabase(url)
 
 # 全局数据库实例
-db = Database()
\ No newline at end of file
+db = create_database()
\ No newline at end of file
@@ -0,0 +1,245 @@
+#!/usr/bin/env python3
+"""
+数据库维护脚本
+
+使用方法:
+    python db_manage.py reconcile    按实际数据重建统计计数器
+    python db_manage.py archive      把已回复的旧消息移入按月分区的归档库
+    python db_manage.py migrate      执行待执行的数据库迁移并显示迁移状态
+    python db_manage.py export DIR   把用户、消息和回复流式导出到目录
+    python db_manage.py import DIR   从导出目录流式导入，已存在的记录跳过
+    python db_manage.py retention    删除过期消息和旧更新记录，并分步回收空闲页
+    python db_manage.py backup       在线备份数据库和归档库到 gzip 压缩的快照文件
+    python db_manage.py verify FILE  解压备份并检查完整性，验证备份可以恢复
+    python db_manage.py vacuum-mode  切换为增量回收空闲页（执行一次完整 VACUUM，期间写入会等待）
+
+选项:
+    --db        数据库文件路径或 postgresql:// 连接串 (默认: DATABASE_URL)
+    --days      archive: 归档早于该天数的消息 (默认: ARCHIVE_AFTER_DAYS)
+    --reindex   archive: 先把已归档的内容补回全文索引（早期版本归档的消息搜索不到时使用）
+    --dry-run   migrate: 在数据库副本上演练待执行的迁移，报告每一步阻塞写入的时间
+    --format    export: parquet / arrow / ndjson (默认: 安装了 pyarrow 时为 parquet)
+    --tables    export/import: 只处理指定的表，用逗号分隔
+    --dir       backup: 备份目录 (默认: BACKUP_DIR)
+"""
+
+import asyncio
+import argparse
+import logging
+import sys
+from pathlib import Path
+
+# 添加项目根目录到Python路径
+project_root = Path(__file__).parent
+sys.path.insert(0, str(project_root))
+
+import config
+from database import (BaseDatabase, create_database, dry_run_migrations, enable_incremental_vacuum,
+                      verify_backup)
+from data_transfer import FORMAT_EXTENSIONS, TRANSFER_TABLES, export_tables, import_tables
+
+# 配置日志
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+
+logger = logging.getLogger(__name__)
+
+async def cmd_reconcile(db: BaseDatabase, args) -> int:
+    """重建统计计数器"""
+    counters = await db.reconcile_counters()
+    if not counters:
+        return 1
+
+    for name, value in sorted(counters.items()):
+        print(f"{name}: {value}")
+    return 0
+
+async def cmd_archive(db: BaseDatabase, args) -> int:
+    """归档旧消息"""
+    if args.reindex:
+        print(f"补回全文索引: {await db.reindex_archives()} 条")
+    archived = await db.archive_old_messages(args.days)
+    for month, count in sorted(archived.items()):
+        print(f"{month}: {count}")
+    print(f"共归档 {sum(archived.values())} 条消息")
+    return 0
+
+async def cmd_migrate(db: BaseDatabase, args) -> int:
+    """等待在线迁移完成并显示迁移状态（离线迁移在打开数据库时已执行，在线迁移由 connect() 启动）"""
+    await db.wait_for_migrations()
+    for item in await db.migration_status():
+        kind = '在线' if item['online'] else '离线'
+        if item['applied_at'] is None:
+            print(f"{item['version']:>4} [{kind}] {item['description']}: 未执行")
+        else:
+            print(f"{item['version']:>4} [{kind}] {item['description']}: 已执行 ({item['duration_ms']}ms)")
+    return 0
+
+def parse_tables(value: str):
+    """解析 --tables 参数"""
+    tables = [table.strip() for table in value.split(',') if table.strip()]
+    for table in tables:
+        if table not in TRANSFER_TABLES:
+            raise argparse.ArgumentTypeError(f"未知的表: {table}")
+    return tables
+
+async def cmd_export(db: BaseDatabase, args) -> int:
+    """流式导出"""
+    counts = await export_tables(db, args.directory, args.format, args.tables)
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+    return 0
+
+async def cmd_import(db: BaseDatabase, args) -> int:
+    """流式导入"""
+    counts = await import_tables(db, args.directory, args.tables)
+    for table, count in counts.items():
+        print(f"{table}: {count}")
+    return 0 if counts else 1
+
+async def cmd_retention(db: BaseDatabase, args) -> int:
+    """执行数据保留策略"""
+    report = await db.run_retention()
+    for message_type, count in sorted(report['purged_messages'].items()):
+        print(f"{message_type}: 删除 {count} 条")
+    print(f"更新记录: 删除 {report['purged_updates']} 条")
+    print(f"回收空闲页: {report['reclaimed_pages']} 页 ({report['reclaimed_bytes']} 字节)")
+    return 0
+
+async def cmd_backup(db: BaseDatabase, args) -> int:
+    """在线备份"""
+    result = await db.backup(args.dir)
+    if not result:
+        return 1
+
+    print(f"备份文件: {result['path']}")
+    for month, path in result['archives'].items():
+        print(f"归档库 {month}: {path}")
+    print(f"页数: {result['pages']}，步数: {result['steps']}，重新开始: {result['restarts']} 次")
+    print(f"大小: {result['size']} -> {result['compressed_size']} 字节，耗时 {result['duration_ms']}ms")
+    return 0
+
+def verify(backup_path: str) -> int:
+    """验证备份文件"""
+    try:
+        result = verify_backup(backup_path)
+    except Exception as e:
+        logger.error(f"验证备份失败: {e}")
+        return 1
+
+    for table, count in result['tables'].items():
+        print(f"{table}: {count}")
+    for month, counts in result['archives'].items():
+        print(f"归档库 {month}: " + ', '.join(f"{table} {count}" for table, count in counts.items()))
+    print(f"迁移版本: {result['schema_version']}")
+    print(f"完整性检查: {'; '.join(result['integrity'])}")
+    return 0 if result['ok'] else 1
+
+def vacuum_mode(db_path: str) -> int:
+    """切换为增量回收空闲页"""
+    try:
+        duration_ms = enable_incremental_vacuum(db_path)
+    except Exception as e:
+        logger.error(f"切换增量回收失败: {e}")
+        return 1
+
+    if duration_ms is None:
+        print("已经开启增量回收")
+    else:
+        print(f"已开启增量回收，VACUUM 耗时 {duration_ms}ms")
+    return 0
+
+def dry_run(db_path: str) -> int:
+    """演练待执行的迁移并打印耗时"""
+    report = dry_run_migrations(db_path)
+    if not report:
+        print("没有待执行的迁移")
+        return 0
+
+    for item in report:
+        kind = '在线' if item['online'] else '离线'
+        print(f"{item['version']:>4} [{kind}] {item['description']}: 预计阻塞写入 {item['duration_ms']}ms")
+    print(f"合计 {sum(item['duration_ms'] for item in report)}ms")
+    return 0
+
+async def main() -> int:
+    """主函数"""
+    parser = argparse.ArgumentParser(description='数据库维护脚本')
+    parser.add_argument('--db', default=config.DATABASE_URL,
+                        help='数据库文件路径或 postgresql:// 连接串 (默认: DATABASE_URL)')
+
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('reconcile', help='按实际数据重建统计计数器')
+    archive_parser = subparsers.add_parser('archive', help='把已回复的旧消息移入按月分区的归档库')
+    archive_parser.add_argument('--days', type=int, default=None,
+                                help='归档早于该天数的消息 (默认: ARCHIVE_AFTER_DAYS)')
+    archive_parser.add_argument('--reindex', action='store_true',
+                                help='先把已归档的内容补回全文索引')
+
+    migrate_parser = subparsers.add_parser('migrate', help='执行待执行的数据库迁移并显示迁移状态')
+    migrate_parser.add_argument('--dry-run', action='store_true',
+                                help='在数据库副本上演练待执行的迁移，报告每一步阻塞写入的时间')
+
+    export_parser = subparsers.add_parser('export', help='把用户、消息和回复流式导出到目录')
+    export_parser.add_argument('directory', help='导出目录')
+    export_parser.add_argument('--format', choices=list(FORMAT_EXTENSIONS), default=None,
+                               help='导出格式 (默认: 安装了 pyarrow 时为 parquet，否则为 ndjson)')
+    export_parser.add_argument('--tables', type=parse_tables, default=None,
+                               help='只导出指定的表，用逗号分隔')
+    import_parser = subparsers.add_parser('import', help='从导出目录流式导入，已存在的记录跳过')
+    import_parser.add_argument('directory', help='导出目录')
+    import_parser.add_argument('--tables', type=parse_tables, default=None,
+                               help='只导入指定的表，用逗号分隔')
+
+    subparsers.add_parser('retention', help='删除过期消息和旧更新记录，并分步回收空闲页')
+    backup_parser = subparsers.add_parser('backup', help='在线备份数据库和归档库到 gzip 压缩的快照文件')
+    backup_parser.add_argument('--dir', default=None, help='备份目录 (默认: BACKUP_DIR)')
+    verify_parser = subparsers.add_parser('verify', help='解压备份并检查完整性，验证备份可以恢复')
+    verify_parser.add_argument('file', help='备份文件')
+    subparsers.add_parser('vacuum-mode', help='切换为增量回收空闲页（执行一次完整 VACUUM，期间写入会等待）')
+
+    args = parser.parse_args()
+
+    # 演练必须在打开数据库之前进行，否则离线迁移已经在打开时执行
+    if args.command == 'migrate' and args.dry_run:
+        if args.db.startswith(('postgres://', 'postgresql://')):
+            logger.error("--dry-run 只支持 SQLite 数据库文件")
+            return 1
+        return dry_run(args.db)
+    # 验证只读取备份文件，不需要打开数据库
+    if args.command == 'verify':
+        return verify(args.file)
+    # VACUUM 不能在写任务的事务中执行，直接使用独立连接
+    if args.command == 'vacuum-mode':
+        if args.db.startswith(('postgres://', 'postgresql://')):
+            logger.error("vacuum-mode 只支持 SQLite 数据库文件")
+            return 1
+        return vacuum_mode(args.db)
+
+    commands = {
+        'reconcile': cmd_reconcile,
+        'archive': cmd_archive,
+        'migrate': cmd_migrate,
+        'export': cmd_export,
+        'import': cmd_import,
+        'retention': cmd_retention,
+        'backup': cmd_backup,
+    }
+
+    db = create_database(args.db)
+    await db.connect()
+    try:
+        return await commands[args.command](db, args)
+    except NotImplementedError as e:
+        logger.error(f"当前存储后端不支持该命令: {e}")
+        return 1
+    except RuntimeError as e:
+        logger.error(str(e))
+        return 1
+    finally:
+        await db.close()
+
+if __name__ == '__main__':
+    sys.exit(asyncio.run(main()))
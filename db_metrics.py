@@ -0,0 +1,261 @@
+"""
+数据库调用的耗时统计
+
+BaseDatabase 及其子类的每个公开协程方法都会被 instrumented() 包装，按方法
+记录耗时直方图、返回行数和错误数，并以 Prometheus 文本格式输出到 /metrics。
+方法内部调用的其它公开方法只计入最外层的调用；归档、备份等维护操作用
+uninstrumented() 排除，避免拉高普通查询的耗时分布。
+存储方法内部捕获异常后只记录日志，因此错误数由挂在数据库模块日志上的
+ErrorCounter 统计。超过 DB_SLOW_QUERY_MS 的调用会记录慢查询日志，并附上
+调用期间执行的语句的查询计划。
+"""
+
+import time
+import asyncio
+import logging
+import functools
+import inspect
+import contextvars
+from dataclasses import dataclass, field
+from typing import List, Dict, Optional, Tuple, Any
+
+import config
+
+logger = logging.getLogger(__name__)
+
+# 耗时直方图的桶上限（秒）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# 每次调用最多记录的语句数，慢查询日志只需要看前几条
+MAX_TRACED_STATEMENTS = 16
+
+@dataclass(slots=True)
+class CallRecord:
+    """一次方法调用期间收集的信息"""
+    method: str
+    error: bool = False
+    # 调用返回后置为 False，调用期间创建的后台任务不再算作嵌套调用
+    active: bool = True
+    statements: List[Tuple[str, Any]] = field(default_factory=list)
+
+@dataclass(slots=True)
+class MethodMetrics:
+    """单个方法的累计统计"""
+    calls: int = 0
+    errors: int = 0
+    rows: int = 0
+    slow: int = 0
+    total_seconds: float = 0.0
+    buckets: List[int] = field(default_factory=lambda: [0] * len(LATENCY_BUCKETS))
+
+_current_call: contextvars.ContextVar[Optional[CallRecord]] = contextvars.ContextVar('db_current_call', default=None)
+
+class QueryMetrics:
+    """按方法汇总的耗时、行数和错误数"""
+    
+    def __init__(self):
+        self.methods: Dict[str, MethodMetrics] = {}
+    
+    def observe(self, method: str, seconds: float, rows: int, error: bool, slow: bool):
+        """记录一次调用"""
+        metrics = self.methods.get(method)
+        if metrics is None:
+            metrics = self.methods[method] = MethodMetrics()
+        metrics.calls += 1
+        metrics.rows += rows
+        metrics.total_seconds += seconds
+        if error:
+            metrics.errors += 1
+        if slow:
+            metrics.slow += 1
+        for i, bound in enumerate(LATENCY_BUCKETS):
+            if seconds <= bound:
+                metrics.buckets[i] += 1
+                break
+    
+    def snapshot(self) -> Dict[str, Dict]:
+        """各方法的统计摘要，按总耗时降序"""
+        items = sorted(self.methods.items(), key=lambda item: item[1].total_seconds, reverse=True)
+        return {method: {
+            'calls': m.calls,
+            'errors': m.errors,
+            'rows': m.rows,
+            'slow': m.slow,
+            'avg_ms': m.total_seconds / m.calls * 1000 if m.calls else 0.0
+        } for method, m in items}
+    
+    def render_prometheus(self) -> str:
+        """以 Prometheus 文本格式输出"""
+        lines = [
+            '# HELP bot_db_call_duration_seconds 数据库方法调用耗时',
+            '# TYPE bot_db_call_duration_seconds histogram',
+        ]
+        for method, m in sorted(self.methods.items()):
+            cumulative = 0
+            for bound, count in zip(LATENCY_BUCKETS, m.buckets):
+                cumulative += count
+                lines.append(f'bot_db_call_duration_seconds_bucket{{method="{method}",le="{bound}"}} {cumulative}')
+            lines.append(f'bot_db_call_duration_seconds_bucket{{method="{method}",le="+Inf"}} {m.calls}')
+            lines.append(f'bot_db_call_duration_seconds_sum{{method="{method}"}} {m.total_seconds:.6f}')
+            lines.append(f'bot_db_call_duration_seconds_count{{method="{method}"}} {m.calls}')
+        
+        counters = [
+            ('bot_db_call_rows_total', '数据库方法返回或写入的行数', 'rows'),
+            ('bot_db_call_errors_total', '数据库方法出错次数', 'errors'),
+            ('bot_db_slow_calls_total', f'耗时超过 {config.DB_SLOW_QUERY_MS}ms 的调用次数', 'slow'),
+        ]
+        for name, help_text, attribute in counters:
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} counter')
+            for method, m in sorted(self.methods.items()):
+                lines.append(f'{name}{{method="{method}"}} {getattr(m, attribute)}')
+        return '\n'.join(lines) + '\n'
+    
+    def reset(self):
+        """清空统计"""
+        self.methods.clear()
+
+query_metrics = QueryMetrics()
+
+# 慢查询计划在后台任务中输出，保留引用避免任务被回收
+_explain_tasks = set()
+
+def count_rows(result) -> int:
+    """估算方法结果中的行数：列表按长度计，单个对象计 1，统计字典和标量不计"""
+    if result is None or isinstance(result, (bool, int, float, str, dict)):
+        return 0
+    if isinstance(result, list):
+        return len(result)
+    if isinstance(result, tuple):
+        return sum(count_rows(item) for item in result)
+    return 1
+
+def trace_statement(sql: str, parameters: Any = None):
+    """记录当前调用执行的语句，没有正在统计的调用时什么也不做"""
+    call = _current_call.get()
+    if call is not None and len(call.statements) < MAX_TRACED_STATEMENTS:
+        call.statements.append((sql, parameters))
+
+def bind_call(job):
+    """让交给写任务执行的操作继续归属于提交它的方法调用"""
+    call = _current_call.get()
+    if call is None:
+        return job
+    
+    @functools.wraps(job)
+    async def bound(*args, **kwargs):
+        token = _current_call.set(call)
+        try:
+            return await job(*args, **kwargs)
+        finally:
+            _current_call.reset(token)
+    return bound
+
+def instrumented(func):
+    """统计协程方法的耗时、行数和错误，慢调用记录查询计划"""
+    method = func.__name__
+    
+    @functools.wraps(func)
+    async def wrapper(self, *args, **kwargs):
+        outer = _current_call.get()
+        if outer is not None and outer.active:
+            # 嵌套调用（如 add_reply -> add_replies）的耗时和语句都归入外层调用
+            return await func(self, *args, **kwargs)
+        
+        call = CallRecord(method)
+        token = _current_call.set(call)
+        start = time.perf_counter()
+        result = None
+        try:
+            result = await func(self, *args, **kwargs)
+            return result
+        except Exception:
+            call.error = True
+            raise
+        finally:
+            call.active = False
+            _current_call.reset(token)
+            seconds = time.perf_counter() - start
+            rows = count_rows(result)
+            slow = seconds * 1000 >= config.DB_SLOW_QUERY_MS
+            query_metrics.observe(method, seconds, rows, call.error, slow)
+            if slow:
+                log_slow_call(self, call, seconds, rows)
+    
+    wrapper.__instrumented__ = True
+    return wrapper
+
+def uninstrumented(func):
+    """标记不统计的方法；子类覆盖该方法时同样不统计"""
+    func.__uninstrumented__ = True
+    return func
+
+def instrument_methods(cls):
+    """包装类中直接定义的全部公开协程方法"""
+    for name, attribute in list(vars(cls).items()):
+        if name.startswith('_') or not inspect.iscoroutinefunction(attribute):
+            continue
+        if getattr(attribute, '__instrumented__', False) or getattr(attribute, '__isabstractmethod__', False):
+            continue
+        if any(getattr(vars(base).get(name), '__uninstrumented__', False) for base in cls.__mro__):
+            continue
+        setattr(cls, name, instrumented(attribute))
+    return cls
+
+def log_slow_call(database, call: CallRecord, seconds: float, rows: int):
+    """记录慢调用，并在后台输出调用期间各语句的查询计划"""
+    logger.warning(f"慢查询: {call.method} 耗时 {seconds * 1000:.0f}ms，{rows} 行，"
+                   f"执行 {len(call.statements)} 条语句")
+    if not call.statements:
+        return
+    
+    try:
+        task = asyncio.get_running_loop().create_task(log_query_plans(database, call))
+    except RuntimeError:
+        return
+    _explain_tasks.add(task)
+    task.add_done_callback(_explain_tasks.discard)
+
+async def log_query_plans(database, call: CallRecord):
+    """逐条输出语句的查询计划，事务控制语句跳过"""
+    for sql, parameters in call.statements:
+        statement = ' '.join(sql.split())
+        if statement.split(' ', 1)[0].upper() not in ('SELECT', 'WITH', 'INSERT', 'UPDATE', 'DELETE'):
+            continue
+        try:
+            plan = await database._explain(sql, parameters)
+        except Exception as e:
+            logger.warning(f"获取查询计划失败 ({call.method}): {e}")
+            continue
+        if plan:
+            logger.warning(f"查询计划 {call.method}: {statement}\n    " + '\n    '.join(plan))
+
+class ErrorCounter(logging.Handler):
+    """把存储模块记录的错误日志计入当前方法调用的错误数"""
+    
+    def __init__(self):
+        super().__init__(level=logging.ERROR)
+    
+    def emit(self, record: logging.LogRecord):
+        call = _current_call.get()
+        if call is not None:
+            call.error = True
+
+class TracedConnection:
+    """包装 aiosqlite 连接，记录执行的语句供慢查询日志使用，其余属性原样转发"""
+    
+    def __init__(self, conn):
+        self._conn = conn
+    
+    def __getattr__(self, name):
+        return getattr(self._conn, name)
+    
+    def execute(self, sql: str, parameters=None):
+        trace_statement(sql, parameters)
+        return self._conn.execute(sql, parameters)
+    
+    def executemany(self, sql: str, parameters):
+        # 查询计划只需要第一组参数
+        first = parameters[0] if isinstance(parameters, (list, tuple)) and parameters else None
+        trace_statement(sql, first)
+        return self._conn.executemany(sql, parameters)
@@ -5,17 +5,17 @@ import aiofiles
 from datetime import datetime
 from typing import Optional
 
-from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
+from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, User as TelegramUser
 from telegram.ext import ContextTypes
 from telegram.constants import ParseMode
 
 import config
 from utils import (
     get_file_extension, is_supported_file_type, format_file_size,
-    generate_filename, ensure_directory_exists, format_duration
+    generate_filename, ensure_directory_exists, format_duration, format_epoch_ms
 )
 from admin_manager import admin_manager
-from database import db, User, Message, Reply
+from database import db, User, Message, Reply, now_ms
 from update_manager import update_manager
 
 logger = logging.getLogger(__name__)
@@ -39,10 +39,12 @@ async def handle_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         username=user.username or f"user_{user.id}",
         first_name=user.first_name or "",
         last_name=user.last_name or "",
-        join_date=datetime.now().isoformat(),
-        last_active=datetime.now().isoformat()
+        join_date=now_ms(),
+        last_active=now_ms()
     )
+    # 已存在的用户只更新有变化的资料，活动时间走写缓冲
     await db.add_user(user_info)
+    await db.buffer_user_activity(user.id)
     
     welcome_text = f"👋 欢迎 {user.first_name}！\n\n"
     
@@ -94,6 +96,8 @@ async def handle_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         help_text += "\n👨‍💼 管理员命令:\n"
         help_text += "/admin - 管理面板\n"
         help_text += "/stats - 查看统计信息\n"
+        help_text += "/inbox - 认领待回复消息\n"
+        help_text += "/search - 搜索消息内容\n"
         help_text += "/users - 查看用户列表\n"
         
         if admin_manager.is_super_admin(user.id):
@@ -134,7 +138,7 @@ async def handle_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     admin_text += f"🔑 权限: {'超级管理员' if admin_info.is_super_admin else '管理员'}"
     
     # 获取待处理的私聊请求
-    pending_requests = admin_manager.get_pending_requests(user.id)
+    pending_requests = await admin_manager.get_pending_requests(user.id)
     if pending_requests:
         admin_text += f"\n\n⏳ 待处理私聊请求: {len(pending_requests)}"
     
@@ -162,6 +166,27 @@ async def handle_admin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(admin_text, reply_markup=reply_markup)
     logger.info(f"管理员 {user.id} 访问了管理面板")
 
+async def notify_admin_private_request(context: ContextTypes.DEFAULT_TYPE, user, admin_id: int):
+    """通知管理员有新的私聊请求"""
+    if not admin_manager.get_admin_info(admin_id):
+        return
+    
+    notification = f"🔔 新的私聊请求\n\n"
+    notification += f"👤 用户: {user.first_name} (@{user.username or '无用户名'})\n"
+    notification += f"🆔 用户ID: {user.id}\n"
+    notification += f"⏰ 时间: {datetime.now().strftime('%H:%M:%S')}"
+    
+    keyboard = [
+        [InlineKeyboardButton("✅ 接受", callback_data=f"accept_chat_{user.id}")],
+        [InlineKeyboardButton("❌ 拒绝", callback_data=f"reject_chat_{user.id}")]
+    ]
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    try:
+        await context.bot.send_message(admin_id, notification, reply_markup=reply_markup)
+    except Exception as e:
+        logger.error(f"通知管理员失败: {e}")
+
 async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /chat 命令 - 选择管理员私聊"""
     user = update.effective_user
@@ -174,9 +199,9 @@ async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text("❌ 管理员不能使用私聊功能")
         return
     
-    # 检查是否已有私聊请求
-    if user.id in admin_manager.private_chat_requests:
-        request = admin_manager.private_chat_requests[user.id]
+    # 检查是否已有私聊请求（缓存未命中或请求待处理时读取数据库）
+    request = await admin_manager.get_private_chat_request(user.id)
+    if request is not None:
         if request.status == "pending":
             await update.message.reply_text("⏳ 您已有待处理的私聊请求，请等待管理员回复")
             return
@@ -184,6 +209,15 @@ async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await update.message.reply_text("✅ 您已与管理员建立私聊，请直接发送消息")
             return
     
+    # 自动分配给负载最低的管理员
+    if config.PRIVATE_CHAT_AUTO_ASSIGN:
+        success, message, admin_id = await admin_manager.assign_private_chat(user)
+        await update.message.reply_text(message if success else f"❌ {message}")
+        if success:
+            await notify_admin_private_request(context, user, admin_id)
+            logger.info(f"用户 {user.id} 的私聊请求已自动分配给管理员 {admin_id}")
+        return
+    
     # 获取可用的管理员
     available_admins = admin_manager.get_available_admins()
     
@@ -197,7 +231,7 @@ async def handle_chat(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 创建管理员选择键盘
     keyboard = []
     for admin in available_admins:
-        status = "🟢 在线" if admin.is_online else "🔴 离线"
+        status = "🟢 在线" if admin_manager.is_admin_online(admin) else "🔴 离线"
         private_chat_count = len(admin.private_chats)
         button_text = f"{admin.first_name} ({status}) - {private_chat_count}/{admin.max_private_chats}"
         keyboard.append([InlineKeyboardButton(button_text, callback_data=f"select_admin_{admin.user_id}")])
@@ -218,6 +252,7 @@ async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     stats = admin_manager.get_admin_stats()
+    db_stats = await db.get_stats()
     
     stats_text = "📊 机器人统计信息\n\n"
     stats_text += f"👥 总管理员数: {stats['total_admins']}\n"
@@ -225,12 +260,126 @@ async def handle_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     stats_text += f"🟢 在线管理员数: {stats['online_admins']}\n"
     stats_text += f"💬 总私聊数: {stats['total_private_chats']}\n"
     stats_text += f"⏳ 待处理请求: {stats['pending_requests']}\n"
+    if config.PRIVATE_CHAT_AUTO_ASSIGN:
+        routing = admin_manager.router.get_stats()
+        stats_text += f"🔀 自动分配: {routing['assignments']} 次 (回到原管理员 {routing['sticky_hits']} 次)\n"
+        stats_text += f"⚖️ 负载均衡度: {routing['load_fairness']:.2f} (负载 {routing['min_load']}-{routing['max_load']}, 平均响应 {routing['avg_wait_seconds']:.0f} 秒)\n"
+    if db_stats:
+        stats_text += f"🙋 总用户数: {db_stats['total_users']}\n"
+        stats_text += f"📝 总消息数: {db_stats['total_messages']}\n"
+        stats_text += f"💬 总回复数: {db_stats['total_replies']}\n"
+        stats_text += f"📭 未回复消息: {db_stats['unreplied_messages']}\n"
+        stats_text += f"🗄️ 已归档消息: {db_stats['archived_messages']}\n"
+    cache_stats = db.get_cache_stats()
+    stats_text += f"🧠 用户缓存: {cache_stats['size']}/{cache_stats['max_size']} (命中率 {cache_stats['hit_rate']:.1f}%, 淘汰 {cache_stats['evictions']})\n"
     stats_text += f"📁 上传目录: {config.UPLOAD_FOLDER}\n"
     stats_text += f"💾 最大文件大小: {config.MAX_FILE_SIZE // (1024*1024)}MB"
     
     await update.message.reply_text(stats_text)
     logger.info(f"管理员 {user.id} 查看了统计信息")
 
+async def handle_inbox(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /inbox 命令 - 认领最早的未回复消息"""
+    user = update.effective_user
+    
+    if not admin_manager.is_admin(user.id):
+        await update.message.reply_text("❌ 您没有管理员权限")
+        return
+    
+    messages = await db.claim_unreplied(config.INBOX_CLAIM_SIZE, user.id)
+    if not messages:
+        await update.message.reply_text("✅ 没有待回复的消息")
+        return
+    
+    inbox_text = f"📥 待回复消息 ({len(messages)})\n\n"
+    inbox_text += f"以下消息已分配给您，{config.UNREPLIED_CLAIM_TIMEOUT // 60} 分钟内未回复将重新分配\n\n"
+    
+    keyboard = []
+    for i, msg in enumerate(messages, 1):
+        inbox_text += f"{i}. [{msg.user_id}] {msg.content[:50]}{'...' if len(msg.content) > 50 else ''}\n"
+        keyboard.append([InlineKeyboardButton(f"💬 回复 #{i}", callback_data=f"reply_{msg.message_id}")])
+    
+    reply_markup = InlineKeyboardMarkup(keyboard)
+    
+    await update.message.reply_text(inbox_text, reply_markup=reply_markup)
+    logger.info(f"管理员 {user.id} 认领了 {len(messages)} 条未回复消息")
+
+async def handle_search(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理 /search 命令 - 全文搜索消息和回复"""
+    user = update.effective_user
+    
+    if not admin_manager.is_admin(user.id):
+        await update.message.reply_text("❌ 您没有管理员权限")
+        return
+    
+    if not context.args:
+        await update.message.reply_text("❌ 请提供搜索关键词\n用法: /search <关键词>")
+        return
+    
+    # 回调数据长度有限，搜索词和各页的游标保存在会话中，翻页按钮只携带页码
+    context.user_data['search_query'] = " ".join(context.args)
+    context.user_data['search_cursors'] = [None]
+    text, reply_markup = await build_search_page(context.user_data['search_query'],
+                                                 context.user_data['search_cursors'], 0)
+    
+    await update.message.reply_text(text, reply_markup=reply_markup)
+    logger.info(f"管理员 {user.id} 搜索了消息")
+
+async def handle_search_page(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """处理搜索结果翻页"""
+    user = update.effective_user
+    query = update.callback_query
+    
+    if not admin_manager.is_admin(user.id):
+        await query.answer("❌ 您没有权限执行此操作")
+        return
+    
+    search_query = context.user_data.get('search_query')
+    cursors = context.user_data.get('search_cursors')
+    if not search_query or not cursors:
+        await query.answer("❌ 搜索已过期，请重新搜索")
+        return
+    
+    try:
+        page = int(query.data.split('_')[2])
+    except (IndexError, ValueError):
+        await query.answer("❌ 无效的页码")
+        return
+    if not 0 <= page < len(cursors):
+        await query.answer("❌ 无效的页码")
+        return
+    
+    text, reply_markup = await build_search_page(search_query, cursors, page)
+    await query.edit_message_text(text, reply_markup=reply_markup)
+
+async def build_search_page(search_query: str, cursors: list, page: int):
+    """生成一页搜索结果的文本和翻页按钮，cursors[page] 是该页的游标"""
+    page_size = config.HISTORY_PAGE_SIZE
+    results, next_cursor = await db.search(search_query, limit=page_size, cursor=cursors[page])
+    
+    # 之后各页的游标以本次查询为准
+    del cursors[page + 1:]
+    if next_cursor is not None:
+        cursors.append(next_cursor)
+    
+    if not results:
+        return f"🔍 没有找到与 \"{search_query}\" 相关的内容", None
+    
+    text = f"🔍 \"{search_query}\" 的搜索结果\n\n"
+    for i, result in enumerate(results, page * page_size + 1):
+        kind = "💬 回复" if result['kind'] == 'reply' else "📝 消息"
+        timestamp = format_epoch_ms(result['timestamp'], '%Y-%m-%d')
+        text += f"{i}. {kind} [{result['user_id']}] {result['snippet']} ({timestamp})\n"
+    
+    page_buttons = []
+    if page > 0:
+        page_buttons.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"search_page_{page - 1}"))
+    if next_cursor is not None:
+        page_buttons.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"search_page_{page + 1}"))
+    
+    reply_markup = InlineKeyboardMarkup([page_buttons]) if page_buttons else None
+    return text, reply_markup
+
 async def handle_addadmin(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理 /addadmin 命令 - 添加管理员"""
     user = update.effective_user
@@ -269,12 +418,36 @@ async def handle_removeadmin(update: Update, context: ContextTypes.DEFAULT_TYPE)
     
     try:
         admin_id = int(context.args[0])
-        if admin_manager.remove_admin(admin_id):
-            await update.message.reply_text(f"✅ 已成功移除管理员 {admin_id}")
-        else:
-            await update.message.reply_text(f"❌ 移除管理员 {admin_id} 失败")
     except ValueError:
         await update.message.reply_text("❌ 无效的管理员ID")
+        return
+    
+    success, requeued, cancelled = await admin_manager.remove_admin(admin_id)
+    if not success:
+        await update.message.reply_text(f"❌ 移除管理员 {admin_id} 失败")
+        return
+    
+    await update.message.reply_text(
+        f"✅ 已成功移除管理员 {admin_id}\n"
+        f"转交待处理请求: {len(requeued)} 个，取消请求和私聊: {len(cancelled)} 个"
+    )
+    
+    # 通知新分配的管理员和受影响的用户
+    for request in requeued:
+        requester = TelegramUser(id=request.user_id, first_name=request.first_name, is_bot=False,
+                                 username=request.username)
+        await notify_admin_private_request(context, requester, request.admin_id)
+        try:
+            await context.bot.send_message(request.user_id, "💬 您的私聊请求已转给其他管理员，请等待回复")
+        except Exception as e:
+            logger.error(f"通知用户私聊请求转交失败: {e}")
+    for request in cancelled:
+        try:
+            await context.bot.send_message(
+                request.user_id, "💬 管理员已离开，您的私聊已结束，如需帮助请重新使用 /chat"
+            )
+        except Exception as e:
+            logger.error(f"通知用户私聊结束失败: {e}")
 
 # 保留原有的多媒体处理函数
 async def handle_echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -292,18 +465,18 @@ async def handle_echo(update: Update, context: ContextTypes.DEFAULT_TYPE):
         chat_id=chat_id,
         message_type="text",
         content=text,
-        timestamp=datetime.now().isoformat()
+        timestamp=now_ms()
     )
-    await db.add_message(message)
+    await db.buffer_message(message)
     
     # 更新用户活动时间
-    await db.update_user_activity(user.id)
+    await db.buffer_user_activity(user.id)
     
     # 检查是否为私聊
     if chat_id == user.id:  # 私聊
-        # 检查用户是否与管理员有私聊
-        if user.id in admin_manager.private_chat_requests:
-            request = admin_manager.private_chat_requests[user.id]
+        # 检查用户是否与管理员有私聊（已接受的私聊从缓存读取，不访问数据库）
+        request = await admin_manager.get_private_chat_request(user.id)
+        if request is not None:
             if request.status == "accepted":
                 # 转发消息给管理员
                 admin_id = request.admin_id
@@ -812,34 +985,17 @@ async def handle_contact_callback(update: Update, context: ContextTypes.DEFAULT_
         admin_id = int(data.split("_", 2)[2])
         user = query.from_user
         
-        success, message = admin_manager.request_private_chat(user, admin_id)
+        success, message = await admin_manager.request_private_chat(user, admin_id)
         await query.edit_message_text(message)
         
         if success:
-            # 通知管理员
-            admin_info = admin_manager.get_admin_info(admin_id)
-            if admin_info:
-                notification = f"🔔 新的私聊请求\n\n"
-                notification += f"👤 用户: {user.first_name} (@{user.username or '无用户名'})\n"
-                notification += f"🆔 用户ID: {user.id}\n"
-                notification += f"⏰ 时间: {datetime.now().strftime('%H:%M:%S')}"
-                
-                keyboard = [
-                    [InlineKeyboardButton("✅ 接受", callback_data=f"accept_chat_{user.id}")],
-                    [InlineKeyboardButton("❌ 拒绝", callback_data=f"reject_chat_{user.id}")]
-                ]
-                reply_markup = InlineKeyboardMarkup(keyboard)
-                
-                try:
-                    await context.bot.send_message(admin_id, notification, reply_markup=reply_markup)
-                except Exception as e:
-                    logger.error(f"通知管理员失败: {e}")
+            await notify_admin_private_request(context, user, admin_id)
     
     elif data.startswith("accept_chat_"):
         user_id = int(data.split("_", 2)[2])
         admin_id = query.from_user.id
         
-        if admin_manager.accept_private_chat(admin_id, user_id):
+        if await admin_manager.accept_private_chat(admin_id, user_id):
             await query.edit_message_text("✅ 已接受私聊请求")
             
             # 通知用户
@@ -854,7 +1010,7 @@ async def handle_contact_callback(update: Update, context: ContextTypes.DEFAULT_
         user_id = int(data.split("_", 2)[2])
         admin_id = query.from_user.id
         
-        if admin_manager.reject_private_chat(admin_id, user_id):
+        if await admin_manager.reject_private_chat(admin_id, user_id):
             await query.edit_message_text("❌ 已拒绝私聊请求")
             
             # 通知用户
@@ -893,6 +1049,9 @@ async def handle_contact_callback(update: Update, context: ContextTypes.DEFAULT_
     elif data.startswith("user_stats_"):
         await handle_user_stats(update, context)
     
+    elif data.startswith("search_page_"):
+        await handle_search_page(update, context)
+    
     elif data == "perform_update":
         await handle_perform_update(update, context)
     
@@ -982,7 +1141,7 @@ async def handle_manage_chats(update: Update, context: ContextTypes.DEFAULT_TYPE
 async def handle_pending_requests(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """处理待处理的私聊请求"""
     user = update.effective_user
-    pending_requests = admin_manager.get_pending_requests(user.id)
+    pending_requests = await admin_manager.get_pending_requests(user.id)
     
     if not pending_requests:
         await update.callback_query.edit_message_text("✅ 没有待处理的私聊请求")
@@ -1021,7 +1180,7 @@ async def handle_manage_admins(update: Update, context: ContextTypes.DEFAULT_TYP
     keyboard = []
     for admin in admins:
         if admin.user_id != user.id:  # 不能移除自己
-            status = "🟢 在线" if admin.is_online else "🔴 离线"
+            status = "🟢 在线" if admin_manager.is_admin_online(admin) else "🔴 离线"
             role = "🔑 超级管理员" if admin.is_super_admin else "👨‍💼 管理员"
             button_text = f"{admin.first_name} ({status}) - {role}"
             keyboard.append([InlineKeyboardButton(button_text, callback_data=f"manage_admin_{admin.user_id}")])
@@ -1063,12 +1222,12 @@ async def handle_reply_message(update: Update, context: ContextTypes.DEFAULT_TYP
     # 创建回复界面
     reply_text = f"💬 回复用户 {user_info.first_name} (@{user_info.username})\n\n"
     reply_text += f"📝 原消息: {message.content}\n"
-    reply_text += f"⏰ 时间: {message.timestamp}\n\n"
+    reply_text += f"⏰ 时间: {format_epoch_ms(message.timestamp)}\n\n"
     
     if replies:
         reply_text += "📋 回复历史:\n"
         for i, reply in enumerate(replies, 1):
-            reply_text += f"{i}. {reply.content} ({reply.timestamp})\n"
+            reply_text += f"{i}. {reply.content} ({format_epoch_ms(reply.timestamp)})\n"
     
     reply_text += "\n💡 请直接发送回复内容"
     
@@ -1101,7 +1260,7 @@ async def handle_admin_reply(update: Update, context: ContextTypes.DEFAULT_TYPE)
         admin_id=user.id,
         content=text,
         message_type="text",
-        timestamp=datetime.now().isoformat()
+        timestamp=now_ms()
     )
     
     # 保存回复到数据库
@@ -1133,9 +1292,17 @@ async def handle_view_history(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("❌ 您没有权限执行此操作")
         return
     
-    # 解析用户ID
+    # 解析用户ID和翻页游标: history_<用户ID>[_o<消息ID>|_n<消息ID>]
     try:
-        user_id = int(query.data.split('_')[1])
+        parts = query.data.split('_')
+        user_id = int(parts[1])
+        before = after = None
+        if len(parts) > 2:
+            cursor_id = int(parts[2][1:])
+            if parts[2].startswith('o'):
+                before = cursor_id
+            else:
+                after = cursor_id
     except (IndexError, ValueError):
         await query.answer("❌ 无效的用户ID")
         return
@@ -1146,8 +1313,10 @@ async def handle_view_history(update: Update, context: ContextTypes.DEFAULT_TYPE
         await query.answer("❌ 用户信息不存在")
         return
     
-    # 获取用户消息历史
-    messages = await db.get_user_messages(user_id, limit=20)
+    # 获取一页用户消息历史
+    messages, has_older, has_newer = await db.get_user_messages_page(
+        user_id, before=before, after=after, limit=config.HISTORY_PAGE_SIZE
+    )
     
     if not messages:
         await query.answer("该用户暂无消息记录")
@@ -1156,16 +1325,23 @@ async def handle_view_history(update: Update, context: ContextTypes.DEFAULT_TYPE
     # 创建历史记录显示
     history_text = f"📋 用户 {user_info.first_name} (@{user_info.username}) 的聊天历史\n\n"
     
-    for i, msg in enumerate(messages[:10], 1):  # 只显示最近10条
-        timestamp = msg.timestamp.split('T')[0] if 'T' in msg.timestamp else msg.timestamp
+    for i, msg in enumerate(messages, 1):
+        timestamp = format_epoch_ms(msg.timestamp, '%Y-%m-%d')
         status = "✅ 已回复" if msg.is_replied else "⏳ 待回复"
         history_text += f"{i}. [{status}] {msg.content[:50]}{'...' if len(msg.content) > 50 else ''} ({timestamp})\n"
     
-    if len(messages) > 10:
-        history_text += f"\n... 还有 {len(messages) - 10} 条消息"
-    
     # 创建操作按钮
-    keyboard = [
+    keyboard = []
+    
+    page_buttons = []
+    if has_older:
+        page_buttons.append(InlineKeyboardButton("⬅️ 更早", callback_data=f"history_{user_id}_o{messages[-1].message_id}"))
+    if has_newer:
+        page_buttons.append(InlineKeyboardButton("更新 ➡️", callback_data=f"history_{user_id}_n{messages[0].message_id}"))
+    if page_buttons:
+        keyboard.append(page_buttons)
+    
+    keyboard += [
         [InlineKeyboardButton("💬 开始私聊", callback_data=f"start_private_{user_id}")],
         [InlineKeyboardButton("📊 用户统计", callback_data=f"user_stats_{user_id}")],
         [InlineKeyboardButton("🔙 返回", callback_data="admin_panel")]
@@ -1197,14 +1373,19 @@ async def handle_start_private(update: Update, context: ContextTypes.DEFAULT_TYP
         await query.answer("❌ 您已达到私聊上限")
         return
     
-    # 创建私聊请求
-    success, message = admin_manager.request_private_chat(
-        User(user_id, "", "", "", "", ""), user.id
+    # 创建私聊请求，请求中记录的是目标用户的资料
+    target = await db.get_user(user_id)
+    target_user = TelegramUser(
+        id=user_id,
+        first_name=(target.first_name if target else "") or "",
+        is_bot=False,
+        username=target.username if target else None
     )
+    success, message = await admin_manager.request_private_chat(target_user, user.id)
     
     if success:
         # 直接接受私聊
-        admin_manager.accept_private_chat(user.id, user_id)
+        await admin_manager.accept_private_chat(user.id, user_id)
         
         # 通知用户
         try:
@@ -1243,24 +1424,29 @@ async def handle_user_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
     
     # 获取用户消息统计
-    messages = await db.get_user_messages(user_id, limit=1000)
-    total_messages = len(messages)
-    replied_messages = len([m for m in messages if m.is_replied])
-    reply_rate = (replied_messages / total_messages * 100) if total_messages > 0 else 0
+    message_stats = await db.get_user_message_stats(user_id)
+    total_messages = message_stats['total_messages']
+    replied_messages = message_stats['replied_messages']
+    reply_rate = message_stats['reply_rate']
     
     # 计算活跃度
-    if user_info.last_active:
-        last_active = user_info.last_active.split('T')[0] if 'T' in user_info.last_active else user_info.last_active
-    else:
-        last_active = "未知"
+    last_active = format_epoch_ms(user_info.last_active, '%Y-%m-%d')
     
     stats_text = f"📊 用户 {user_info.first_name} (@{user_info.username}) 统计信息\n\n"
     stats_text += f"🆔 用户ID: {user_id}\n"
-    stats_text += f"📅 加入时间: {user_info.join_date.split('T')[0] if 'T' in user_info.join_date else user_info.join_date}\n"
+    stats_text += f"📅 加入时间: {format_epoch_ms(user_info.join_date, '%Y-%m-%d')}\n"
     stats_text += f"🕐 最后活跃: {last_active}\n"
     stats_text += f"📝 总消息数: {total_messages}\n"
     stats_text += f"✅ 已回复: {replied_messages}\n"
     stats_text += f"📈 回复率: {reply_rate:.1f}%\n"
+    
+    if message_stats['by_type']:
+        type_counts = ", ".join(f"{t}: {c}" for t, c in sorted(message_stats['by_type'].items()))
+        stats_text += f"🗂️ 消息类型: {type_counts}\n"
+    if message_stats['first_message_time']:
+        stats_text += f"📨 首条消息: {format_epoch_ms(message_stats['first_message_time'])}\n"
+        stats_text += f"📬 最近消息: {format_epoch_ms(message_stats['last_message_time'])}\n"
+    
     stats_text += f"🚫 是否被封禁: {'是' if user_info.is_blocked else '否'}\n"
     
     if user_info.is_blocked:
@@ -0,0 +1,742 @@
+import logging
+from typing import List, Dict, Optional, Tuple
+
+try:
+    import asyncpg
+except ImportError:  # 只有使用 PostgreSQL 后端时才需要 asyncpg
+    asyncpg = None
+
+import config
+from database import (BaseDatabase, User, Message, Reply, UpdateInfo, TABLE_COLUMNS,
+                      USER_SELECT, MESSAGE_SELECT, REPLY_SELECT, UPDATE_SELECT, ADMIN_COLUMNS,
+                      PRIVATE_CHAT_COLUMNS, ADMIN_SELECT, PRIVATE_CHAT_SELECT, now_ms)
+from db_metrics import ErrorCounter
+
+logger = logging.getLogger(__name__)
+logger.addHandler(ErrorCounter())
+
+# 与 SQLite 后端相同的表结构，时间列同样保存毫秒时间戳
+PG_SCHEMA = [
+    '''
+    CREATE TABLE IF NOT EXISTS users (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        join_date BIGINT DEFAULT 0,
+        last_active BIGINT DEFAULT 0,
+        is_blocked BOOLEAN DEFAULT FALSE,
+        block_reason TEXT DEFAULT ''
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS messages (
+        message_id BIGINT PRIMARY KEY,
+        user_id BIGINT,
+        chat_id BIGINT,
+        message_type TEXT,
+        content TEXT,
+        file_id TEXT DEFAULT '',
+        file_path TEXT DEFAULT '',
+        timestamp BIGINT DEFAULT 0,
+        is_replied BOOLEAN DEFAULT FALSE,
+        reply_message_id BIGINT DEFAULT 0
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS replies (
+        reply_id BIGSERIAL PRIMARY KEY,
+        original_message_id BIGINT,
+        admin_id BIGINT,
+        content TEXT,
+        message_type TEXT DEFAULT 'text',
+        file_id TEXT DEFAULT '',
+        file_path TEXT DEFAULT '',
+        timestamp BIGINT DEFAULT 0,
+        is_read BOOLEAN DEFAULT FALSE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS updates (
+        version TEXT PRIMARY KEY,
+        description TEXT,
+        download_url TEXT,
+        release_date TEXT,
+        is_forced BOOLEAN DEFAULT FALSE,
+        changelog TEXT DEFAULT ''
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS message_claims (
+        message_id BIGINT PRIMARY KEY,
+        admin_id BIGINT NOT NULL,
+        claimed_at BIGINT NOT NULL
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS admins (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        is_super_admin BOOLEAN DEFAULT FALSE,
+        join_date TEXT,
+        last_active TEXT,
+        max_private_chats INTEGER,
+        is_online BOOLEAN DEFAULT FALSE
+    )
+    ''',
+    '''
+    CREATE TABLE IF NOT EXISTS private_chat_requests (
+        user_id BIGINT PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        admin_id BIGINT,
+        request_time TEXT,
+        status TEXT,
+        chat_id BIGINT
+    )
+    ''',
+    # 旧版本把私聊列表保存在 admins.private_chats 数组中，拆成每个私聊一行（状态为 accepted 的请求）
+    '''
+    DO $$
+    BEGIN
+        IF EXISTS (SELECT 1 FROM information_schema.columns
+                   WHERE table_schema = current_schema() AND table_name = 'admins'
+                     AND column_name = 'private_chats') THEN
+            INSERT INTO private_chat_requests (user_id, username, first_name, admin_id, request_time, status, chat_id)
+            SELECT chat, '', '', a.user_id, to_char(now(), 'YYYY-MM-DD"T"HH24:MI:SS'), 'accepted', chat
+            FROM admins a, unnest(a.private_chats) AS chat
+            ON CONFLICT (user_id) DO NOTHING;
+            ALTER TABLE admins DROP COLUMN private_chats;
+        END IF;
+    END $$
+    ''',
+    'CREATE INDEX IF NOT EXISTS idx_messages_user_time ON messages(user_id, timestamp)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_chat_id ON messages(chat_id)',
+    'CREATE INDEX IF NOT EXISTS idx_replies_message_id ON replies(original_message_id)',
+    'CREATE INDEX IF NOT EXISTS idx_messages_unreplied ON messages(timestamp) WHERE NOT is_replied',
+    'CREATE INDEX IF NOT EXISTS idx_message_claims_admin ON message_claims(admin_id)',
+    'CREATE INDEX IF NOT EXISTS idx_admins_username ON admins(username)',
+    'CREATE INDEX IF NOT EXISTS idx_private_chat_requests_admin_status ON private_chat_requests(admin_id, status)',
+]
+
+# pg_trgm 可用时为内容建立三元组索引，加速中文等子串搜索
+PG_SEARCH_INDEXES = [
+    'CREATE EXTENSION IF NOT EXISTS pg_trgm',
+    'CREATE INDEX IF NOT EXISTS idx_messages_content_trgm ON messages USING gin (content gin_trgm_ops)',
+    'CREATE INDEX IF NOT EXISTS idx_replies_content_trgm ON replies USING gin (content gin_trgm_ops)',
+]
+
+MESSAGE_COLUMNS = ['message_id', 'user_id', 'chat_id', 'message_type', 'content',
+                   'file_id', 'file_path', 'timestamp']
+
+async def copy_insert(conn, table: str, columns: List[str], records: List[Tuple]) -> int:
+    """用 COPY 批量写入，主键已存在的行跳过，返回实际写入的行数
+
+    COPY 不能跳过重复主键，因此先导入临时表再 INSERT ... ON CONFLICT DO NOTHING。
+    必须在事务中调用，临时表在提交时清空。
+    """
+    await conn.execute(f'''
+        CREATE TEMP TABLE IF NOT EXISTS {table}_staging
+        (LIKE {table} INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+    ''')
+    await conn.copy_records_to_table(f'{table}_staging', columns=columns, records=records)
+    column_list = ', '.join(columns)
+    status = await conn.execute(f'''
+        INSERT INTO {table} ({column_list})
+        SELECT {column_list} FROM {table}_staging
+        ON CONFLICT DO NOTHING
+    ''')
+    return int(status.split()[-1])
+
+class PostgresDatabase(BaseDatabase):
+    """PostgreSQL 存储后端
+    
+    使用 asyncpg 连接池，多个连接可以并发写入。asyncpg 会为每个连接缓存
+    预编译语句，重复执行的查询只解析一次；写缓冲通过 COPY 批量导入。
+    统计信息直接聚合查询，不使用计数器行，以免它成为并发写入的热点。
+    """
+    
+    def __init__(self, dsn: str, min_size: int = config.PG_POOL_MIN_SIZE,
+                 max_size: int = config.PG_POOL_MAX_SIZE):
+        if asyncpg is None:
+            raise RuntimeError("使用 PostgreSQL 需要安装 asyncpg: pip install asyncpg")
+        
+        super().__init__()
+        self.dsn = dsn
+        self.min_size = max(1, min_size)
+        self.max_size = max(self.min_size, max_size)
+        self._pool: Optional[asyncpg.Pool] = None
+    
+    async def connect(self):
+        """创建连接池并初始化表结构"""
+        if self._pool is not None:
+            return
+        
+        try:
+            self._pool = await asyncpg.create_pool(self.dsn, min_size=self.min_size, max_size=self.max_size)
+            async with self._pool.acquire() as conn:
+                for statement in PG_SCHEMA:
+                    await conn.execute(statement)
+                try:
+                    async with conn.transaction():
+                        for statement in PG_SEARCH_INDEXES:
+                            await conn.execute(statement)
+                except asyncpg.PostgresError as e:
+                    logger.warning(f"pg_trgm 不可用，搜索将使用顺序扫描: {e}")
+            logger.info(f"PostgreSQL 连接池已启动 (连接数: {self.min_size}-{self.max_size})")
+        except Exception as e:
+            logger.error(f"启动 PostgreSQL 连接池失败: {e}")
+            await self.close()
+            raise
+    
+    async def close(self):
+        """落盘写缓冲并关闭连接池"""
+        if self._pool is None:
+            return
+        
+        await self._drain_write_buffer()
+        pool, self._pool = self._pool, None
+        try:
+            await pool.close()
+            logger.info("PostgreSQL 连接池已关闭")
+        except Exception as e:
+            logger.error(f"关闭 PostgreSQL 连接池失败: {e}")
+    
+    async def _add_user(self, user: User) -> bool:
+        """插入新用户；已存在时只更新有变化的资料字段"""
+        try:
+            await self._pool.execute('''
+                INSERT INTO users (user_id, username, first_name, last_name, join_date, last_active)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (user_id) DO UPDATE SET
+                    username = EXCLUDED.username,
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name
+                WHERE (users.username, users.first_name, users.last_name)
+                      IS DISTINCT FROM (EXCLUDED.username, EXCLUDED.first_name, EXCLUDED.last_name)
+            ''', user.user_id, user.username, user.first_name,
+                user.last_name, user.join_date, user.last_active)
+            return True
+        except Exception as e:
+            logger.error(f"添加用户失败: {e}")
+            return False
+    
+    async def _update_user_activity(self, user_id: int, last_active: int):
+        """写入用户活动时间"""
+        try:
+            await self._pool.execute('UPDATE users SET last_active = $1 WHERE user_id = $2',
+                                     last_active, user_id)
+        except Exception as e:
+            logger.error(f"更新用户活动失败: {e}")
+    
+    async def _fetch_user(self, user_id: int) -> Optional[User]:
+        """从数据库读取用户"""
+        try:
+            row = await self._pool.fetchrow(f'SELECT {USER_SELECT} FROM users WHERE user_id = $1', user_id)
+            return User(*row) if row else None
+        except Exception as e:
+            logger.error(f"获取用户失败: {e}")
+            return None
+    
+    async def add_message(self, message: Message) -> bool:
+        """添加消息"""
+        try:
+            await self._pool.execute('''
+                INSERT INTO messages
+                (message_id, user_id, chat_id, message_type, content,
+                 file_id, file_path, timestamp)
+                VALUES ($1, $2, $3, $4, $5, $6, $7, $8)
+            ''', message.message_id, message.user_id, message.chat_id,
+                message.message_type, message.content, message.file_id,
+                message.file_path, message.timestamp)
+            return True
+        except Exception as e:
+            logger.error(f"添加消息失败: {e}")
+            return False
+    
+    async def _write_buffered(self, messages: List[Message], activity: Dict[int, int]):
+        """用 COPY 导入缓冲的消息，再在同一事务中合并进消息表"""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                if messages:
+                    await copy_insert(conn, 'messages', MESSAGE_COLUMNS,
+                                      [(m.message_id, m.user_id, m.chat_id, m.message_type, m.content,
+                                        m.file_id, m.file_path, m.timestamp) for m in messages])
+                if activity:
+                    await conn.execute('''
+                        UPDATE users SET last_active = v.last_active
+                        FROM unnest($1::bigint[], $2::bigint[]) AS v(user_id, last_active)
+                        WHERE users.user_id = v.user_id
+                    ''', list(activity.keys()), list(activity.values()))
+    
+    async def get_user_messages_page(self, user_id: int, before: Optional[int] = None,
+                                     after: Optional[int] = None,
+                                     limit: int = 10) -> Tuple[List[Message], bool, bool]:
+        """按游标分页获取用户消息历史
+        
+        before/after 为上一页边界消息的ID，分别表示向更早/更新的方向翻页。
+        返回 (按时间倒序的消息, 是否还有更早的消息, 是否还有更新的消息)。
+        """
+        if after is not None:
+            condition = 'AND (timestamp, message_id) > (SELECT timestamp, message_id FROM messages WHERE message_id = $2)'
+            order = 'ASC'
+            parameters = (user_id, after, limit + 1)
+        elif before is not None:
+            condition = 'AND (timestamp, message_id) < (SELECT timestamp, message_id FROM messages WHERE message_id = $2)'
+            order = 'DESC'
+            parameters = (user_id, before, limit + 1)
+        else:
+            condition = ''
+            order = 'DESC'
+            parameters = (user_id, limit + 1)
+        
+        try:
+            rows = await self._pool.fetch(f'''
+                SELECT {MESSAGE_SELECT} FROM messages
+                WHERE user_id = $1 {condition}
+                ORDER BY timestamp {order}, message_id {order}
+                LIMIT ${len(parameters)}
+            ''', *parameters)
+        except Exception as e:
+            logger.error(f"分页获取用户消息失败: {e}")
+            return [], False, False
+        
+        has_more = len(rows) > limit
+        messages = [Message(*row) for row in rows[:limit]]
+        
+        if after is not None:
+            messages.reverse()
+            return messages, True, has_more
+        return messages, has_more, before is not None
+    
+    async def get_user_message_stats(self, user_id: int) -> Dict:
+        """获取用户消息统计"""
+        try:
+            rows = await self._pool.fetch('''
+                SELECT message_type, COUNT(*), COUNT(*) FILTER (WHERE is_replied),
+                       MIN(timestamp), MAX(timestamp)
+                FROM messages
+                WHERE user_id = $1
+                GROUP BY message_type
+            ''', user_id)
+        except Exception as e:
+            logger.error(f"获取用户消息统计失败: {e}")
+            rows = []
+        return self._message_stats_from_rows(rows)
+    
+    async def add_replies(self, replies: List[Reply]) -> List[int]:
+        """在一个事务中添加一批回复并标记对应消息为已回复，返回各回复的ID"""
+        if not replies:
+            return []
+        
+        # 被回复的消息可能还在写缓冲中
+        if self._has_buffered_writes():
+            await self.flush_writes()
+        
+        try:
+            # 插入、更新消息状态和释放认领合并为一条语句；
+            # 同一消息在一批中有多条回复时以最后一条为准
+            rows = await self._pool.fetch('''
+                WITH new_replies AS (
+                    INSERT INTO replies
+                    (original_message_id, admin_id, content, message_type,
+                     file_id, file_path, timestamp)
+                    SELECT * FROM unnest($1::bigint[], $2::bigint[], $3::text[], $4::text[],
+                                         $5::text[], $6::text[], $7::bigint[])
+                    RETURNING reply_id, original_message_id
+                ), latest AS (
+                    SELECT DISTINCT ON (original_message_id) reply_id, original_message_id
+                    FROM new_replies
+                    ORDER BY original_message_id, reply_id DESC
+                ), updated AS (
+                    UPDATE messages SET is_replied = TRUE, reply_message_id = latest.reply_id
+                    FROM latest
+                    WHERE messages.message_id = latest.original_message_id
+                ), released AS (
+                    DELETE FROM message_claims
+                    USING latest
+                    WHERE message_claims.message_id = latest.original_message_id
+                )
+                SELECT reply_id FROM new_replies ORDER BY reply_id
+            ''', [r.original_message_id for r in replies], [r.admin_id for r in replies],
+                [r.content for r in replies], [r.message_type for r in replies],
+                [r.file_id for r in replies], [r.file_path for r in replies],
+                [r.timestamp for r in replies])
+        except Exception as e:
+            logger.error(f"添加回复失败: {e}")
+            return []
+        
+        reply_ids = [row['reply_id'] for row in rows]
+        for reply, reply_id in zip(replies, reply_ids):
+            reply.reply_id = reply_id
+        return reply_ids
+    
+    async def get_unreplied_messages(self, limit: int = 100, after: Optional[int] = None) -> List[Message]:
+        """按时间顺序分页获取未回复的消息，after 为上一页最后一条消息的ID"""
+        if after is not None:
+            condition = 'AND (timestamp, message_id) > (SELECT timestamp, message_id FROM messages WHERE message_id = $2)'
+            parameters = (limit, after)
+        else:
+            condition = ''
+            parameters = (limit,)
+        
+        try:
+            rows = await self._pool.fetch(f'''
+                SELECT {MESSAGE_SELECT} FROM messages
+                WHERE NOT is_replied {condition}
+                ORDER BY timestamp ASC, message_id ASC
+                LIMIT $1
+            ''', *parameters)
+            return [Message(*row) for row in rows]
+        except Exception as e:
+            logger.error(f"获取未回复消息失败: {e}")
+            return []
+    
+    async def claim_unreplied(self, limit: int, admin_id: int) -> List[Message]:
+        """为管理员认领最早的未回复消息
+        
+        ON CONFLICT 的 WHERE 条件会在冲突行上重新检查，并发认领时其他管理员
+        刚认领的消息不会被抢走。
+        """
+        now = now_ms()
+        expired_before = now - config.UNREPLIED_CLAIM_TIMEOUT * 1000
+        
+        try:
+            await self.flush_writes()
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    claimed = await conn.fetch('''
+                        INSERT INTO message_claims (message_id, admin_id, claimed_at)
+                        SELECT m.message_id, $1, $2 FROM messages m
+                        LEFT JOIN message_claims c ON c.message_id = m.message_id
+                        WHERE NOT m.is_replied
+                          AND (c.message_id IS NULL OR c.admin_id = $1 OR c.claimed_at < $3)
+                        ORDER BY m.timestamp ASC, m.message_id ASC
+                        LIMIT $4
+                        ON CONFLICT (message_id) DO UPDATE
+                        SET admin_id = EXCLUDED.admin_id, claimed_at = EXCLUDED.claimed_at
+                        WHERE message_claims.admin_id = EXCLUDED.admin_id
+                           OR message_claims.claimed_at < $3
+                        RETURNING message_id
+                    ''', admin_id, now, expired_before, limit)
+                    if not claimed:
+                        return []
+                    
+                    rows = await conn.fetch(f'''
+                        SELECT {MESSAGE_SELECT} FROM messages WHERE message_id = ANY($1::bigint[])
+                        ORDER BY timestamp ASC, message_id ASC
+                    ''', [row['message_id'] for row in claimed])
+                    return [Message(*row) for row in rows]
+        except Exception as e:
+            logger.error(f"认领未回复消息失败: {e}")
+            return []
+    
+    async def search(self, query: str, user_id: Optional[int] = None, limit: int = 10,
+                     cursor: Optional[str] = None) -> Tuple[List[Dict], Optional[str]]:
+        """按子串搜索消息和回复内容，按时间倒序排列
+        
+        cursor 为上一页最后一条的 (时间, 类型, ID)，返回 (结果列表, 下一页游标)。
+        """
+        terms = [term for term in query.split() if term]
+        if not terms:
+            return [], None
+        
+        patterns = ['%' + term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+                    for term in terms]
+        
+        last = (None, None, None)
+        if cursor:
+            try:
+                timestamp, kind, result_id = cursor.split(':')
+                last = (int(timestamp), kind, int(result_id))
+            except ValueError:
+                logger.warning(f"无效的搜索游标: {cursor}")
+                return [], None
+        
+        try:
+            rows = await self._pool.fetch('''
+                SELECT * FROM (
+                    SELECT 'message' AS kind, message_id AS id, user_id, timestamp, content
+                    FROM messages WHERE content ILIKE ALL($1::text[])
+                    UNION ALL
+                    SELECT 'reply', r.reply_id, m.user_id, r.timestamp, r.content
+                    FROM replies r LEFT JOIN messages m ON m.message_id = r.original_message_id
+                    WHERE r.content ILIKE ALL($1::text[])
+                ) AS results
+                WHERE ($2::bigint IS NULL OR user_id = $2)
+                  AND ($4::bigint IS NULL OR (timestamp, kind, id) < ($4, $5::text, $6::bigint))
+                ORDER BY timestamp DESC, kind DESC, id DESC
+                LIMIT $3
+            ''', patterns, user_id, limit + 1, *last)
+        except Exception as e:
+            logger.error(f"全文搜索失败: {e}")
+            return [], None
+        
+        results = [{
+            'kind': row['kind'],
+            'id': row['id'],
+            'user_id': row['user_id'],
+            'timestamp': row['timestamp'],
+            'snippet': row['content'][:80]
+        } for row in rows[:limit]]
+        
+        next_cursor = None
+        if len(rows) > limit:
+            last_row = rows[limit - 1]
+            next_cursor = f"{last_row['timestamp']}:{last_row['kind']}:{last_row['id']}"
+        return results, next_cursor
+    
+    async def release_claims(self, admin_id: int) -> int:
+        """释放管理员认领的全部消息"""
+        try:
+            status = await self._pool.execute('DELETE FROM message_claims WHERE admin_id = $1', admin_id)
+            return int(status.split()[-1])
+        except Exception as e:
+            logger.error(f"释放认领失败: {e}")
+            return 0
+    
+    async def get_message_with_replies(self, message_id: int) -> Tuple[Optional[Message], List[Reply]]:
+        """获取消息及其回复"""
+        if self._has_buffered_writes():
+            await self.flush_writes()
+        
+        try:
+            async with self._pool.acquire() as conn:
+                row = await conn.fetchrow(f'SELECT {MESSAGE_SELECT} FROM messages WHERE message_id = $1',
+                                          message_id)
+                rows = await conn.fetch(f'''
+                    SELECT {REPLY_SELECT} FROM replies WHERE original_message_id = $1
+                    ORDER BY timestamp ASC
+                ''', message_id)
+            return (Message(*row) if row else None), [Reply(*row) for row in rows]
+        except Exception as e:
+            logger.error(f"获取消息及回复失败: {e}")
+            return None, []
+    
+    async def add_update(self, update_info: UpdateInfo) -> bool:
+        """添加更新信息"""
+        try:
+            await self._pool.execute('''
+                INSERT INTO updates
+                (version, description, download_url, release_date, is_forced, changelog)
+                VALUES ($1, $2, $3, $4, $5, $6)
+                ON CONFLICT (version) DO UPDATE SET
+                    description = EXCLUDED.description,
+                    download_url = EXCLUDED.download_url,
+                    release_date = EXCLUDED.release_date,
+                    is_forced = EXCLUDED.is_forced,
+                    changelog = EXCLUDED.changelog
+            ''', update_info.version, update_info.description, update_info.download_url,
+                update_info.release_date, update_info.is_forced, update_info.changelog)
+            return True
+        except Exception as e:
+            logger.error(f"添加更新信息失败: {e}")
+            return False
+    
+    async def get_latest_update(self) -> Optional[UpdateInfo]:
+        """获取最新更新信息"""
+        try:
+            row = await self._pool.fetchrow(
+                f'SELECT {UPDATE_SELECT} FROM updates ORDER BY release_date DESC LIMIT 1')
+            return UpdateInfo(*row) if row else None
+        except Exception as e:
+            logger.error(f"获取最新更新失败: {e}")
+            return None
+    
+    async def get_stats(self) -> Dict:
+        """获取统计信息"""
+        try:
+            row = await self._pool.fetchrow('''
+                SELECT (SELECT COUNT(*) FROM users) AS total_users,
+                       (SELECT COUNT(*) FROM messages) AS total_messages,
+                       (SELECT COUNT(*) FROM replies) AS total_replies,
+                       (SELECT COUNT(*) FROM messages WHERE NOT is_replied) AS unreplied_messages
+            ''')
+            stats = dict(row)
+            stats.update(archived_messages=0, archived_replies=0)
+            return stats
+        except Exception as e:
+            logger.error(f"获取统计信息失败: {e}")
+            return {}
+    
+    async def get_admins(self) -> Optional[List[Dict]]:
+        """获取全部管理员，失败时返回 None"""
+        try:
+            rows = await self._pool.fetch(f'SELECT {ADMIN_SELECT} FROM admins')
+        except Exception as e:
+            logger.error(f"获取管理员列表失败: {e}")
+            return None
+        return [dict(row) for row in rows]
+    
+    async def get_admin_by_username(self, username: str) -> Optional[Dict]:
+        """按用户名查找管理员，同名时返回最早加入的"""
+        try:
+            row = await self._pool.fetchrow(
+                f'SELECT {ADMIN_SELECT} FROM admins WHERE username = $1 ORDER BY join_date, user_id LIMIT 1',
+                username)
+        except Exception as e:
+            logger.error(f"按用户名查找管理员失败: {e}")
+            return None
+        return dict(row) if row else None
+    
+    async def get_private_chat_requests(self, admin_id: Optional[int] = None,
+                                        status: Optional[str] = None,
+                                        user_id: Optional[int] = None) -> Optional[List[Dict]]:
+        """按管理员、状态和用户获取私聊请求，失败时返回 None"""
+        try:
+            rows = await self._pool.fetch(f'''
+                SELECT {PRIVATE_CHAT_SELECT} FROM private_chat_requests
+                WHERE ($1::bigint IS NULL OR admin_id = $1) AND ($2::text IS NULL OR status = $2)
+                  AND ($3::bigint IS NULL OR user_id = $3)
+                ORDER BY request_time
+            ''', admin_id, status, user_id)
+        except Exception as e:
+            logger.error(f"获取私聊请求失败: {e}")
+            return None
+        return [dict(row) for row in rows]
+    
+    async def create_private_chat_request(self, request: Dict, max_chats: int) -> bool:
+        """用户没有私聊请求且管理员私聊未满时插入请求，检查和插入在同一条语句中完成"""
+        count = len(PRIVATE_CHAT_COLUMNS)
+        placeholders = ', '.join(f'${i}' for i in range(1, count + 1))
+        try:
+            user_id = await self._pool.fetchval(f'''
+                INSERT INTO private_chat_requests ({PRIVATE_CHAT_SELECT})
+                SELECT {placeholders}
+                WHERE (SELECT COUNT(*) FROM private_chat_requests 
+                       WHERE admin_id = ${count + 1} AND status = 'accepted') < ${count + 2}
+                ON CONFLICT (user_id) DO NOTHING
+                RETURNING user_id
+            ''', *(request[column] for column in PRIVATE_CHAT_COLUMNS), request['admin_id'], max_chats)
+            return user_id is not None
+        except Exception as e:
+            logger.error(f"创建私聊请求失败: {e}")
+            return False
+    
+    async def update_private_chat_status(self, user_id: int, admin_id: int, old_status: str,
+                                         new_status: str) -> Optional[Dict]:
+        """条件更新单行私聊请求的状态，接受时 chat_id 设为用户ID"""
+        try:
+            row = await self._pool.fetchrow(f'''
+                UPDATE private_chat_requests 
+                SET status = $1, chat_id = CASE WHEN $1 = 'accepted' THEN user_id ELSE chat_id END
+                WHERE user_id = $2 AND admin_id = $3 AND status = $4
+                RETURNING {PRIVATE_CHAT_SELECT}
+            ''', new_status, user_id, admin_id, old_status)
+        except Exception as e:
+            logger.error(f"修改私聊请求状态失败: {e}")
+            return None
+        return dict(row) if row else None
+    
+    async def reassign_private_chat_request(self, user_id: int, old_admin_id: int, new_admin_id: int,
+                                            request_time: str, max_chats: int) -> Optional[Dict]:
+        """条件修改待处理请求的管理员，容量检查与创建请求相同"""
+        try:
+            row = await self._pool.fetchrow(f'''
+                UPDATE private_chat_requests SET admin_id = $1, request_time = $2
+                WHERE user_id = $3 AND admin_id = $4 AND status = 'pending'
+                  AND (SELECT COUNT(*) FROM private_chat_requests 
+                       WHERE admin_id = $1 AND status = 'accepted') < $5
+                RETURNING {PRIVATE_CHAT_SELECT}
+            ''', new_admin_id, request_time, user_id, old_admin_id, max_chats)
+        except Exception as e:
+            logger.error(f"转交私聊请求失败: {e}")
+            return None
+        return dict(row) if row else None
+    
+    async def delete_private_chat_request(self, user_id: int, admin_id: int, status: str) -> bool:
+        """条件删除单行私聊请求"""
+        try:
+            deleted = await self._pool.fetchval('''
+                DELETE FROM private_chat_requests WHERE user_id = $1 AND admin_id = $2 AND status = $3
+                RETURNING user_id
+            ''', user_id, admin_id, status)
+            return deleted is not None
+        except Exception as e:
+            logger.error(f"删除私聊请求失败: {e}")
+            return False
+    
+    async def expire_private_chat_requests(self, before: str) -> Optional[List[Dict]]:
+        """删除过期的待处理请求并返回被删除的请求"""
+        try:
+            rows = await self._pool.fetch(f'''
+                DELETE FROM private_chat_requests WHERE status = 'pending' AND request_time < $1
+                RETURNING {PRIVATE_CHAT_SELECT}
+            ''', before)
+        except Exception as e:
+            logger.error(f"清理过期私聊请求失败: {e}")
+            return None
+        return [dict(row) for row in rows]
+    
+    async def save_admin_state(self, added_admins: List[Dict], admins: List[Dict], deleted_admins: List[int],
+                               requests: List[Dict], deleted_requests: List[int]) -> bool:
+        """在一个事务中写入或删除管理员和私聊请求，已有的行不会被整行覆盖"""
+        def insert(table: str, columns: List[str]) -> str:
+            placeholders = ', '.join(f'${i}' for i in range(1, len(columns) + 1))
+            return f'''
+                INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})
+                ON CONFLICT ({columns[0]}) DO NOTHING
+            '''
+        
+        updates = ', '.join(f'{column} = ${i}' for i, column in enumerate(ADMIN_COLUMNS[1:], start=2))
+        
+        try:
+            async with self._pool.acquire() as conn:
+                async with conn.transaction():
+                    if added_admins:
+                        await conn.executemany(insert('admins', ADMIN_COLUMNS),
+                                               [tuple(admin[column] for column in ADMIN_COLUMNS)
+                                                for admin in added_admins])
+                    if admins:
+                        await conn.executemany(f'UPDATE admins SET {updates} WHERE user_id = $1',
+                                               [tuple(admin[column] for column in ADMIN_COLUMNS)
+                                                for admin in admins])
+                    if deleted_admins:
+                        await conn.execute('DELETE FROM admins WHERE user_id = ANY($1::bigint[])',
+                                           deleted_admins)
+                    if requests:
+                        await conn.executemany(insert('private_chat_requests', PRIVATE_CHAT_COLUMNS),
+                                               [tuple(request[column] for column in PRIVATE_CHAT_COLUMNS)
+                                                for request in requests])
+                    if deleted_requests:
+                        await conn.execute('DELETE FROM private_chat_requests WHERE user_id = ANY($1::bigint[])',
+                                           deleted_requests)
+            return True
+        except Exception as e:
+            logger.error(f"保存管理员数据失败: {e}")
+            return False
+    
+    async def iter_table(self, table: str, chunk_size: int = config.EXPORT_CHUNK_SIZE):
+        """按主键顺序分块读取整张表，每块是一次独立的短查询"""
+        columns = TABLE_COLUMNS[table]
+        sql = f'''
+            SELECT {', '.join(columns)} FROM {table}
+            WHERE {columns[0]} > $1
+            ORDER BY {columns[0]}
+            LIMIT $2
+        '''
+        
+        last_key = -2 ** 63
+        while True:
+            rows = await self._pool.fetch(sql, last_key, chunk_size)
+            if not rows:
+                break
+            yield [tuple(row) for row in rows]
+            last_key = rows[-1][0]
+    
+    async def import_rows(self, table: str, rows: List[Tuple]) -> int:
+        """用 COPY 在一个事务中写入一块行，主键已存在的行跳过"""
+        async with self._pool.acquire() as conn:
+            async with conn.transaction():
+                count = await copy_insert(conn, table, TABLE_COLUMNS[table], rows)
+                if table == 'replies':
+                    # 显式写入了 reply_id，自增序列需要跟上
+                    await conn.execute('''
+                        SELECT setval(pg_get_serial_sequence('replies', 'reply_id'),
+                                      GREATEST((SELECT MAX(reply_id) FROM replies), 1))
+                    ''')
+        if table == 'users':
+            self._forget_user_profiles()
+        return count
@@ -66,6 +66,10 @@ try:
         handle_generate_install_script
     )
 except ImportError as e:
+    if __name__ != "__main__":
+        # 被 pytest 收集时跳过整个脚本，不能用 sys.exit 中断测试运行
+        import pytest
+        pytest.skip(f"test_bot.py 是独立运行的脚本，导入模块失败: {e}", allow_module_level=True)
     print(f"❌ 导入模块失败: {e}")
     print("请确保在项目根目录运行此脚本")
     sys.exit(1)
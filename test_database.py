@@ -0,0 +1,1034 @@
+#!/usr/bin/env python3
+"""
+数据库后端一致性测试
+
+同一组 BaseDatabase 检查分别在 SQLite 和 PostgreSQL 上运行。
+PostgreSQL 实例由 initdb/pg_ctl 在临时目录中启动，找不到可执行文件时跳过。
+可以用 PG_BIN 环境变量指定 PostgreSQL 的 bin 目录。
+
+运行: python -m pytest -q test_database.py
+"""
+
+import asyncio
+import os
+import shutil
+import socket
+import sqlite3
+import subprocess
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta
+from typing import Optional
+
+import pytest
+
+import database
+from database import Message, Reply, SQLiteDatabase, User, create_database
+
+def find_pg_bin():
+    """查找包含 initdb 和 pg_ctl 的目录"""
+    candidates = []
+    if os.getenv('PG_BIN'):
+        candidates.append(os.getenv('PG_BIN'))
+    pg_ctl = shutil.which('pg_ctl')
+    if pg_ctl:
+        candidates.append(os.path.dirname(pg_ctl))
+    pg_config = shutil.which('pg_config')
+    if pg_config:
+        try:
+            result = subprocess.run([pg_config, '--bindir'], capture_output=True, text=True, check=True)
+            candidates.append(result.stdout.strip())
+        except (OSError, subprocess.CalledProcessError):
+            pass
+    
+    for bindir in candidates:
+        if all(os.access(os.path.join(bindir, name), os.X_OK) for name in ('initdb', 'pg_ctl')):
+            return bindir
+    return None
+
+def free_port() -> int:
+    """向系统申请一个空闲端口"""
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+async def execute_admin(url: str, statement: str):
+    """在维护库上执行一条语句（CREATE/DROP DATABASE 不能放在事务里）"""
+    import asyncpg
+    conn = await asyncpg.connect(url)
+    try:
+        await conn.execute(statement)
+    finally:
+        await conn.close()
+
+@pytest.fixture(scope='session')
+def postgres_url(tmp_path_factory):
+    """在临时目录中启动一个 PostgreSQL 实例，返回维护库的连接串"""
+    pytest.importorskip('asyncpg')
+    bindir = find_pg_bin()
+    if bindir is None:
+        pytest.skip('未找到 PostgreSQL 可执行文件 (initdb/pg_ctl)')
+    if hasattr(os, 'geteuid') and os.geteuid() == 0:
+        pytest.skip('PostgreSQL 不能以 root 身份运行')
+    
+    data_dir = tmp_path_factory.mktemp('pgdata')
+    # unix socket 路径有长度限制，单独使用一个短的临时目录
+    socket_dir = tempfile.mkdtemp(prefix='pgsock')
+    port = free_port()
+    pg_ctl = os.path.join(bindir, 'pg_ctl')
+    
+    subprocess.run(
+        [os.path.join(bindir, 'initdb'), '-D', str(data_dir), '-U', 'postgres',
+         '-A', 'trust', '-E', 'UTF8', '--locale=C', '--no-sync'],
+        check=True, capture_output=True,
+    )
+    subprocess.run(
+        [pg_ctl, '-D', str(data_dir), '-l', str(data_dir / 'server.log'), '-w',
+         '-o', f"-p {port} -k {socket_dir} -c listen_addresses='' -c fsync=off",
+         'start'],
+        check=True, capture_output=True,
+    )
+    try:
+        yield f'postgresql://postgres@/postgres?host={socket_dir}&port={port}'
+    finally:
+        subprocess.run([pg_ctl, '-D', str(data_dir), '-m', 'immediate', 'stop'],
+                       capture_output=True)
+        shutil.rmtree(socket_dir, ignore_errors=True)
+
+@pytest.fixture(params=['sqlite', 'postgres'])
+def database_url(request, tmp_path):
+    """每个测试使用一个全新的数据库"""
+    if request.param == 'sqlite':
+        yield str(tmp_path / 'bot.db')
+        return
+    
+    server_url = request.getfixturevalue('postgres_url')
+    name = f'test_{uuid.uuid4().hex[:12]}'
+    asyncio.run(execute_admin(server_url, f'CREATE DATABASE {name}'))
+    try:
+        yield server_url.replace('/postgres?', f'/{name}?', 1)
+    finally:
+        asyncio.run(execute_admin(server_url, f'DROP DATABASE IF EXISTS {name} WITH (FORCE)'))
+
+def run_with_database(url: str, check):
+    """连接数据库后执行检查协程，结束时关闭连接"""
+    async def main():
+        db = create_database(url)
+        await db.connect()
+        try:
+            return await check(db)
+        finally:
+            await db.close()
+    return asyncio.run(main())
+
+def run_with_sqlite(tmp_path, check):
+    """只适用于 SQLite 后端的检查，归档库放在临时目录中"""
+    async def main():
+        db = SQLiteDatabase(str(tmp_path / 'bot.db'), archive_dir=str(tmp_path / 'archive'))
+        await db.connect()
+        try:
+            return await check(db)
+        finally:
+            await db.close()
+    return asyncio.run(main())
+
+def now_ms() -> int:
+    return int(time.time() * 1000)
+
+def make_messages(user_id: int, count: int, start_id: int = 1, base: Optional[int] = None):
+    base = now_ms() - count * 1000 if base is None else base
+    return [
+        Message(message_id=start_id + i, user_id=user_id, chat_id=user_id,
+                message_type='text', content=f'消息 {start_id + i}', timestamp=base + i * 1000)
+        for i in range(count)
+    ]
+
+async def add_user(db, user_id: int):
+    now = now_ms()
+    assert await db.add_user(User(user_id=user_id, username=f'user{user_id}', first_name='测试',
+                                  last_name='', join_date=now, last_active=now))
+
+def test_bulk_add(database_url):
+    """缓冲写入的消息在 flush 后全部可见"""
+    async def check(db):
+        await add_user(db, 100)
+        for message in make_messages(100, 250):
+            await db.buffer_message(message)
+        
+        assert await db.flush_writes() == 250
+        assert await db.flush_writes() == 0
+        messages = await db.get_user_messages(100, limit=1000)
+        assert sorted(m.message_id for m in messages) == list(range(1, 251))
+    
+    run_with_database(database_url, check)
+
+def test_add_replies(database_url):
+    """批量回复返回新ID并把原消息标记为已回复"""
+    async def check(db):
+        await add_user(db, 100)
+        for message in make_messages(100, 3):
+            assert await db.add_message(message)
+        
+        replies = [
+            Reply(reply_id=0, original_message_id=message_id, admin_id=1,
+                  content=f'回复 {message_id}', timestamp=now_ms())
+            for message_id in (1, 2)
+        ]
+        ids = await db.add_replies(replies)
+        assert len(ids) == 2 and len(set(ids)) == 2
+        
+        detail = await db.get_message_with_replies(1)
+        assert detail is not None
+        message, message_replies = detail
+        assert message.is_replied
+        assert [r.content for r in message_replies] == ['回复 1']
+        
+        unreplied = await db.get_unreplied_messages()
+        assert [m.message_id for m in unreplied] == [3]
+    
+    run_with_database(database_url, check)
+
+async def add_search_data(db):
+    """用户 100 的 12 条消息和其中 3 条的回复、用户 200 的 1 条消息都包含“订单问题”，返回回复ID"""
+    for user_id in (100, 200):
+        await add_user(db, user_id)
+    messages = make_messages(100, 12) + make_messages(200, 1, start_id=13)
+    for message in messages:
+        message.content = f'订单问题 {message.message_id}'
+        assert await db.add_message(message)
+    return await db.add_replies([
+        Reply(reply_id=0, original_message_id=message_id, admin_id=1,
+              content=f'订单问题已处理 {message_id}', timestamp=now_ms())
+        for message_id in (1, 2, 3)
+    ])
+
+async def search_all(db, query: str, limit: int, user_id: Optional[int] = None, between_pages=None):
+    """按游标翻完全部搜索结果，返回 (类型, ID) 列表"""
+    seen, cursor = [], None
+    while True:
+        results, cursor = await db.search(query, user_id=user_id, limit=limit, cursor=cursor)
+        seen.extend((result['kind'], result['id']) for result in results)
+        if cursor is None:
+            return seen
+        if between_pages is not None:
+            await between_pages()
+            between_pages = None
+
+def test_search_pages_with_cursor(database_url):
+    """搜索按游标翻页不重复不遗漏，翻页期间写入新内容也不影响；回复映射回回复ID和原消息的用户"""
+    async def check(db):
+        reply_ids = await add_search_data(db)
+        expected = {('message', i) for i in range(1, 14)} | {('reply', i) for i in reply_ids}
+        
+        seen = await search_all(db, '订单问题', limit=4)
+        assert len(seen) == len(set(seen)) and set(seen) == expected
+        
+        results, _ = await db.search('订单问题已处理', limit=10)
+        assert {(r['kind'], r['id'], r['user_id']) for r in results} == {('reply', i, 100) for i in reply_ids}
+        assert await search_all(db, '订单问题', limit=4, user_id=200) == [('message', 13)]
+        
+        async def add_matching_message():
+            message = make_messages(100, 1, start_id=14)[0]
+            message.content = '订单问题 订单问题 14'
+            assert await db.add_message(message)
+        
+        seen = await search_all(db, '订单问题', limit=4, between_pages=add_matching_message)
+        assert len(seen) == len(set(seen)) and expected <= set(seen)
+        assert (await db.search('订单问题', cursor='无效'))[0] == []
+    
+    run_with_database(database_url, check)
+
+def test_search_index_rowids(tmp_path):
+    """消息在全文索引中的 rowid 为 message_id * 2，回复为 reply_id * 2 + 1，ID 相同也不冲突"""
+    async def index_rowids(db):
+        async with db._read_conn() as conn:
+            async with conn.execute('SELECT rowid FROM search_index') as cursor:
+                return {row[0] for row in await cursor.fetchall()}
+    
+    async def check(db):
+        reply_ids = await add_search_data(db)
+        assert 1 in reply_ids
+        assert await index_rowids(db) == {i * 2 for i in range(1, 14)} | {i * 2 + 1 for i in reply_ids}
+        
+        await db._execute_write('DELETE FROM replies WHERE reply_id = ?', (1,))
+        rowids = await index_rowids(db)
+        assert 3 not in rowids and 2 in rowids
+        results, _ = await db.search('订单问题已处理', limit=10)
+        assert sorted(r['id'] for r in results) == sorted(set(reply_ids) - {1})
+    
+    run_with_sqlite(tmp_path, check)
+
+def test_reply_ids_returned_in_order(database_url):
+    """RETURNING 取回的回复ID按输入顺序对应各条回复，消息记录最后一条回复的ID；缓冲中的消息也能回复"""
+    async def check(db):
+        await add_user(db, 100)
+        for message in make_messages(100, 2):
+            assert await db.add_message(message)
+        buffered = make_messages(100, 1, start_id=3)[0]
+        await db.buffer_message(buffered)
+        
+        assert await db.add_replies([]) == []
+        reply_id = await db.add_reply(Reply(reply_id=0, original_message_id=3, admin_id=1,
+                                            content='缓冲消息的回复', timestamp=now_ms()))
+        assert reply_id is not None
+        
+        contents = ['第一条', '第二条', '第三条']
+        ids = await db.add_replies([
+            Reply(reply_id=0, original_message_id=message_id, admin_id=1, content=content, timestamp=now_ms())
+            for message_id, content in zip((1, 1, 2), contents)
+        ])
+        assert len(set(ids + [reply_id])) == 4
+        
+        message, replies = await db.get_message_with_replies(1)
+        assert message.reply_message_id == ids[1]
+        assert {r.reply_id: r.content for r in replies} == {ids[0]: '第一条', ids[1]: '第二条'}
+        message, replies = await db.get_message_with_replies(2)
+        assert message.reply_message_id == ids[2] and [r.reply_id for r in replies] == [ids[2]]
+        message, replies = await db.get_message_with_replies(3)
+        assert message.is_replied and message.reply_message_id == reply_id
+        assert [r.content for r in replies] == ['缓冲消息的回复']
+    
+    run_with_database(database_url, check)
+
+def test_claims(database_url):
+    """两个管理员认领的消息不重叠，释放后可以重新认领"""
+    async def check(db):
+        await add_user(db, 100)
+        for message in make_messages(100, 10):
+            assert await db.add_message(message)
+        
+        first = await db.claim_unreplied(4, admin_id=1)
+        second = await db.claim_unreplied(4, admin_id=2)
+        assert [m.message_id for m in first] == [1, 2, 3, 4]
+        assert [m.message_id for m in second] == [5, 6, 7, 8]
+        
+        assert await db.release_claims(1) == 4
+        again = await db.claim_unreplied(10, admin_id=3)
+        assert [m.message_id for m in again] == [1, 2, 3, 4, 9, 10]
+    
+    run_with_database(database_url, check)
+
+def test_paging(database_url):
+    """按游标前后翻页，既不重复也不遗漏"""
+    async def check(db):
+        await add_user(db, 100)
+        for message in make_messages(100, 25):
+            assert await db.add_message(message)
+        
+        seen = []
+        before = None
+        while True:
+            page, has_older, has_newer = await db.get_user_messages_page(100, before=before, limit=10)
+            seen.extend(m.message_id for m in page)
+            assert has_newer == (before is not None)
+            if not has_older:
+                break
+            before = page[-1].message_id
+        assert seen == list(range(25, 0, -1))
+        
+        page, has_older, has_newer = await db.get_user_messages_page(100, after=5, limit=10)
+        assert [m.message_id for m in page] == list(range(15, 5, -1))
+        assert has_newer and has_older
+    
+    run_with_database(database_url, check)
+
+def test_stats(database_url):
+    """统计计数器与写入的数据一致"""
+    async def check(db):
+        for user_id in (100, 200):
+            await add_user(db, user_id)
+        for message in make_messages(100, 5) + make_messages(200, 3, start_id=6):
+            assert await db.add_message(message)
+        await db.add_replies([
+            Reply(reply_id=0, original_message_id=1, admin_id=1, content='回复', timestamp=now_ms())
+        ])
+        
+        stats = await db.get_stats()
+        assert stats['total_users'] == 2
+        assert stats['total_messages'] == 8
+        assert stats['total_replies'] == 1
+        assert stats['unreplied_messages'] == 7
+    
+    run_with_database(database_url, check)
+
+def sqlite_indexes(path: str) -> set:
+    conn = sqlite3.connect(path)
+    try:
+        return {row[0] for row in conn.execute("SELECT name FROM sqlite_master WHERE type = 'index'")}
+    finally:
+        conn.close()
+
+def test_migrations_dry_run_and_online_indexes(tmp_path):
+    """演练只作用于副本；离线迁移在启动时执行，在线迁移由写任务补建索引并记录版本"""
+    path = str(tmp_path / 'bot.db')
+    versions = [migration.version for migration in database.MIGRATIONS]
+    assert [step['version'] for step in database.dry_run_migrations(path)] == versions
+    assert not os.path.exists(path)
+    
+    async def first_start(db):
+        assert [step['version'] for step in await db.wait_for_migrations()] == \
+            [m.version for m in database.MIGRATIONS if m.online]
+        assert all(step['applied_at'] is not None for step in await db.migration_status())
+        await add_user(db, 100)
+        for message in make_messages(100, 20):
+            assert await db.add_message(message)
+    
+    run_with_sqlite(tmp_path, first_start)
+    assert 'idx_messages_user_time' in sqlite_indexes(path)
+    assert 'idx_messages_user_id' not in sqlite_indexes(path)
+    assert database.dry_run_migrations(path) == []
+    
+    # 模拟升级前的库：在线迁移 6 尚未执行
+    conn = sqlite3.connect(path)
+    conn.execute('DROP INDEX idx_messages_user_time')
+    conn.execute('DELETE FROM schema_version WHERE version = 6')
+    conn.commit()
+    conn.close()
+    report = database.dry_run_migrations(path)
+    assert [(step['version'], step['online']) for step in report] == [(6, True)]
+    assert 'idx_messages_user_time' not in sqlite_indexes(path)
+    
+    async def upgrade(db):
+        # 在线迁移执行期间读写照常进行
+        page, _, _ = await db.get_user_messages_page(100, limit=5)
+        assert [m.message_id for m in page] == [20, 19, 18, 17, 16]
+        assert [step['version'] for step in await db.wait_for_migrations()] == [6]
+    
+    run_with_sqlite(tmp_path, upgrade)
+    assert 'idx_messages_user_time' in sqlite_indexes(path)
+    assert database.dry_run_migrations(path) == []
+
+def test_failed_migration_stops_startup(tmp_path, monkeypatch):
+    """离线迁移失败时启动中止，失败的版本不记录，修复后重新执行"""
+    path = str(tmp_path / 'bot.db')
+    run_with_sqlite(tmp_path, lambda db: db.wait_for_migrations())
+    broken = database.Migration(99, '测试用的错误迁移', ['CREATE TABLE users (user_id INTEGER)'])
+    monkeypatch.setattr(database, 'MIGRATIONS', [*database.MIGRATIONS, broken])
+    
+    with pytest.raises(sqlite3.OperationalError):
+        SQLiteDatabase(path).init_database()
+    with pytest.raises(sqlite3.OperationalError):
+        database.dry_run_migrations(path)
+    conn = sqlite3.connect(path)
+    assert conn.execute('SELECT COUNT(*) FROM schema_version WHERE version = 99').fetchone()[0] == 0
+    conn.close()
+    
+    broken.statements = ['CREATE TABLE IF NOT EXISTS migration_test (id INTEGER)']
+    SQLiteDatabase(path).init_database()
+    assert database.dry_run_migrations(path) == []
+
+async def read_table(db, table: str):
+    import data_transfer
+    return [record async for rows in db.iter_table(table, 4)
+            for record in data_transfer.normalize_rows(table, rows)]
+
+@pytest.mark.parametrize('fmt', ['ndjson', 'parquet', 'arrow'])
+def test_export_import_round_trip(database_url, tmp_path, fmt):
+    """分块导出后导入到新的 SQLite 库，三张表逐行一致，计数器和全文索引随导入更新；重复导入跳过"""
+    import data_transfer
+    if fmt != 'ndjson':
+        pytest.importorskip('pyarrow')
+    export_dir = str(tmp_path / 'export')
+    
+    async def export(db):
+        for user_id in (100, 200):
+            await add_user(db, user_id)
+        messages = make_messages(100, 6) + make_messages(200, 1, start_id=7)
+        messages[2].message_type, messages[2].file_id, messages[2].content = 'photo', 'file-3', None
+        for message in messages:
+            assert await db.add_message(message)
+        await db.add_replies([
+            Reply(reply_id=0, original_message_id=message_id, admin_id=1,
+                  content=f'导出回复 {message_id}', timestamp=now_ms())
+            for message_id in (1, 7)
+        ])
+        counts = await data_transfer.export_tables(db, export_dir, fmt, chunk_size=3)
+        assert counts == {'users': 2, 'messages': 7, 'replies': 2}
+        return {table: await read_table(db, table) for table in data_transfer.TRANSFER_TABLES}
+    
+    exported = run_with_database(database_url, export)
+    
+    async def restore(db):
+        counts = await data_transfer.import_tables(db, export_dir, chunk_size=3)
+        assert counts == {'users': 2, 'messages': 7, 'replies': 2}
+        for table, records in exported.items():
+            assert await read_table(db, table) == records
+        
+        stats = await db.get_stats()
+        assert (stats['total_users'], stats['total_messages'], stats['unreplied_messages']) == (2, 7, 5)
+        results, _ = await db.search('导出回复', limit=10)
+        assert {(r['kind'], r['user_id']) for r in results} == {('reply', 100), ('reply', 200)}
+        
+        assert await data_transfer.import_tables(db, export_dir) == {'users': 0, 'messages': 0, 'replies': 0}
+    
+    run_with_database(str(tmp_path / 'copy.db'), restore)
+
+def test_metrics_count_outermost_calls(database_url):
+    """嵌套的公开方法只计入最外层调用；调用中启动的后台落盘单独计数；维护方法不计"""
+    from db_metrics import query_metrics
+    
+    async def check(db):
+        await add_user(db, 100)
+        for message in make_messages(100, 2):
+            assert await db.add_message(message)
+        query_metrics.reset()
+        
+        assert await db.add_reply(Reply(reply_id=0, original_message_id=1, admin_id=1,
+                                        content='回复', timestamp=now_ms()))
+        db.batch_max_size = 1
+        await db.buffer_message(make_messages(100, 1, start_id=3)[0])
+        await asyncio.gather(*db._flush_tasks)
+        if isinstance(db, SQLiteDatabase):
+            await db.run_retention()
+        
+        snapshot = query_metrics.snapshot()
+        assert snapshot['add_reply']['calls'] == 1 and 'add_replies' not in snapshot
+        assert snapshot['buffer_message']['calls'] == 1
+        assert snapshot['flush_writes']['calls'] == 1
+        maintenance = {'run_retention', 'purge_expired', 'purge_old_updates', 'incremental_vacuum'}
+        assert not maintenance & set(snapshot)
+        assert 'bot_db_call_duration_seconds_count{method="add_reply"} 1' in query_metrics.render_prometheus()
+    
+    try:
+        run_with_database(database_url, check)
+    finally:
+        query_metrics.reset()
+
+def test_writer_survives_failed_batch(tmp_path):
+    """一批写操作在事务外出错后，写任务继续处理之后的写操作"""
+    async def check(db):
+        original = db._run_write_jobs
+        
+        async def broken(conn, batch):
+            db._run_write_jobs = original
+            raise RuntimeError('写入失败')
+        
+        db._run_write_jobs = broken
+        with pytest.raises(RuntimeError):
+            await db._execute_write('UPDATE counters SET value = value WHERE 0')
+        # 写任务退出时这里会一直等待
+        await asyncio.wait_for(add_user(db, 100), timeout=10)
+        assert (await db.get_user(100)) is not None
+    
+    run_with_sqlite(tmp_path, check)
+
+def test_user_cache_ttl_lru_and_generation(monkeypatch):
+    """缓存项按 TTL 过期、按最近使用淘汰；查询期间发生过失效时结果不放入缓存"""
+    clock = [1000.0]
+    monkeypatch.setattr(database.time, 'monotonic', lambda: clock[0])
+    cache = database.UserCache(max_size=2, ttl=60)
+    users = {user_id: User(user_id=user_id, username=f'user{user_id}', first_name='测试',
+                           last_name='', join_date=0, last_active=0) for user_id in (1, 2, 3)}
+    
+    cache.put(users[1], cache.generation)
+    cache.put(users[2], cache.generation)
+    assert cache.get(1) is users[1]
+    cache.put(users[3], cache.generation)
+    assert cache.get(2) is None and cache.get(1) is users[1] and cache.get(3) is users[3]
+    
+    clock[0] += 61
+    assert cache.get(1) is None
+    
+    generation = cache.generation
+    cache.invalidate(2)
+    cache.put(users[2], generation)
+    assert cache.get(2) is None
+    assert cache.stats() == {'size': 1, 'max_size': 2, 'hits': 3, 'misses': 3, 'evictions': 1,
+                             'hit_rate': 50.0}
+
+def test_user_cache_skips_stale_reads(database_url):
+    """读取用户期间资料被修改，读到的旧资料不会进入缓存；之后的读取命中缓存"""
+    async def check(db):
+        await add_user(db, 100)
+        original = db._fetch_user
+        
+        async def fetch_then_rename(user_id):
+            user = await original(user_id)
+            db._fetch_user = original
+            assert await db.add_user(User(user_id=100, username='renamed', first_name='测试',
+                                          last_name='', join_date=now_ms(), last_active=now_ms()))
+            return user
+        
+        db._fetch_user = fetch_then_rename
+        assert (await db.get_user(100)).username == 'user100'
+        assert (await db.get_user(100)).username == 'renamed'
+        hits = db.get_cache_stats()['hits']
+        assert (await db.get_user(100)).username == 'renamed'
+        assert db.get_cache_stats()['hits'] == hits + 1
+        
+        await db.update_user_activity(100)
+        assert db.user_cache.get(100) is None
+    
+    run_with_database(database_url, check)
+
+def test_profile_fingerprint_skip(tmp_path):
+    """资料未变化时 add_user 不写数据库；清理过期数据后重新写入已被删除的用户"""
+    async def check(db):
+        writes = []
+        original = db._add_user
+        
+        async def counting_add_user(user):
+            writes.append(user.user_id)
+            return await original(user)
+        
+        db._add_user = counting_add_user
+        await add_user(db, 100)
+        await add_user(db, 100)
+        assert writes == [100]
+        
+        # 模拟用户行在别处被删除，之后执行一次保留策略
+        await db._execute_write('DELETE FROM users WHERE user_id = ?', (100,))
+        await db.purge_expired({'*': 365})
+        await add_user(db, 100)
+        assert writes == [100, 100]
+        assert (await db.get_user(100)) is not None
+    
+    run_with_sqlite(tmp_path, check)
+
+DAY_MS = 86400 * 1000
+
+async def add_old_replied_messages(db, count: int, days: int = 400):
+    """写入 count 条 days 天前的已回复消息，每条一个回复"""
+    await add_user(db, 100)
+    for message in make_messages(100, count, base=now_ms() - days * DAY_MS):
+        assert await db.add_message(message)
+    await db.add_replies([
+        Reply(reply_id=0, original_message_id=message_id, admin_id=1, content=f'回复 {message_id}',
+              timestamp=now_ms() - days * DAY_MS)
+        for message_id in range(1, count + 1)
+    ])
+
+async def read_counters(db):
+    async with db._read_conn() as conn:
+        async with conn.execute('SELECT name, value FROM counters') as cursor:
+            return dict(await cursor.fetchall())
+
+async def archive_row_counts(db):
+    counts = {'messages': 0, 'replies': 0}
+    for month in db._archive_months():
+        async with db._archive_conn(month) as conn:
+            for table in counts:
+                async with conn.execute(f'SELECT COUNT(*) FROM {table}') as cursor:
+                    counts[table] += (await cursor.fetchone())[0]
+    return counts
+
+def test_counters_follow_writes_and_reconcile(tmp_path):
+    """触发器维护的计数器随插入、删除和标记回复变化；被改乱后 reconcile_counters 按实际数据重建"""
+    async def check(db):
+        for user_id in (100, 200):
+            await add_user(db, user_id)
+        for message in make_messages(100, 5) + make_messages(200, 3, start_id=6):
+            assert await db.add_message(message)
+        await db.add_replies([
+            Reply(reply_id=0, original_message_id=message_id, admin_id=1, content='回复', timestamp=now_ms())
+            for message_id in (1, 2)
+        ])
+        await db._execute_write('DELETE FROM messages WHERE message_id = ?', (3,))
+        
+        expected = {'total_users': 2, 'total_messages': 7, 'total_replies': 2, 'unreplied_messages': 5}
+        counters = await read_counters(db)
+        assert {name: counters[name] for name in expected} == expected
+        
+        await db._execute_write("UPDATE counters SET value = 99 WHERE name IN ('total_messages', 'unreplied_messages')")
+        reconciled = await db.reconcile_counters()
+        assert {name: reconciled[name] for name in expected} == expected
+        stats = await db.get_stats()
+        assert (stats['total_messages'], stats['unreplied_messages']) == (7, 5)
+    
+    run_with_sqlite(tmp_path, check)
+
+def test_archived_messages_in_paging_stats_and_search(tmp_path):
+    """归档的消息仍出现在分页、消息详情、统计和搜索中；reindex_archives 补回丢失的索引行"""
+    async def check(db):
+        await add_old_replied_messages(db, 6)
+        for message in make_messages(100, 4, start_id=7):
+            assert await db.add_message(message)
+        assert sum((await db.archive_old_messages(older_than_days=30)).values()) == 6
+        assert await archive_row_counts(db) == {'messages': 6, 'replies': 6}
+        
+        seen, before = [], None
+        while True:
+            page, has_older, _ = await db.get_user_messages_page(100, before=before, limit=3)
+            seen.extend(m.message_id for m in page)
+            if not has_older:
+                break
+            before = page[-1].message_id
+        assert seen == list(range(10, 0, -1))
+        page, has_older, has_newer = await db.get_user_messages_page(100, after=2, limit=3)
+        assert [m.message_id for m in page] == [5, 4, 3] and has_older and has_newer
+        
+        message, replies = await db.get_message_with_replies(2)
+        assert message.message_id == 2 and [r.content for r in replies] == ['回复 2']
+        
+        stats = await db.get_stats()
+        assert (stats['total_messages'], stats['total_replies'], stats['unreplied_messages']) == (10, 6, 4)
+        
+        expected = {('message', i) for i in range(1, 11)}
+        assert set(await search_all(db, '消息', limit=4)) == expected
+        # 模拟早期版本归档时连同索引行一起删除
+        await db._execute_write('DELETE FROM search_index WHERE rowid <= 13')
+        assert set(await search_all(db, '消息', limit=4)) == expected - {('message', i) for i in range(1, 7)}
+        assert await db.reindex_archives() == 12
+        assert set(await search_all(db, '消息', limit=4)) == expected
+        assert await db.reindex_archives() == 0
+    
+    run_with_sqlite(tmp_path, check)
+
+def test_backup_and_verify(tmp_path):
+    """在线备份包含归档库，verify_backup 核对完整性、行数和归档计数器；备份期间照常写入；缺少归档文件时报错"""
+    async def check(db):
+        await add_old_replied_messages(db, 3)
+        for message in make_messages(100, 2, start_id=4):
+            assert await db.add_message(message)
+        await db.archive_old_messages(older_than_days=30)
+        
+        result = await db.backup(str(tmp_path / 'backups'))
+        assert len(result['archives']) == 1
+        report = database.verify_backup(result['path'])
+        assert report['ok'], report['integrity']
+        assert report['tables'] == {'users': 1, 'messages': 2, 'replies': 0}
+        assert list(report['archives'].values()) == [{'messages': 3, 'replies': 3}]
+        assert report['schema_version'] == database.MIGRATIONS[-1].version
+        
+        async def write_during_backup():
+            for message in make_messages(100, 50, start_id=10):
+                assert await db.add_message(message)
+        
+        result, _ = await asyncio.gather(db.backup(str(tmp_path / 'concurrent')), write_during_backup())
+        assert database.verify_backup(result['path'])['ok']
+        
+        os.remove(next(iter(result['archives'].values())))
+        report = database.verify_backup(result['path'])
+        assert not report['ok'] and any('归档' in line for line in report['integrity'])
+    
+    run_with_sqlite(tmp_path, check)
+
+def test_retention_batches_and_incremental_vacuum(tmp_path, monkeypatch):
+    """按类型的保留天数分批删除过期消息及其回复，计数器同步；之后增量回收空闲页"""
+    import config
+    monkeypatch.setattr(config, 'RETENTION_BATCH_SIZE', 7)
+    monkeypatch.setattr(config, 'RETENTION_BATCH_DELAY_MS', 0)
+    
+    async def freelist_count(db):
+        async with db._read_conn() as conn:
+            async with conn.execute('PRAGMA freelist_count') as cursor:
+                return (await cursor.fetchone())[0]
+    
+    async def check(db):
+        await add_user(db, 100)
+        old = make_messages(100, 25, base=now_ms() - 100 * DAY_MS)
+        for message in old[20:]:
+            message.message_type = 'photo'
+        for message in old + make_messages(100, 5, start_id=26):
+            message.content = f'过期检查 {message.message_id} ' + 'x' * 2000
+            assert await db.add_message(message)
+        await db.add_replies([Reply(reply_id=0, original_message_id=message_id, admin_id=1,
+                                    content='y' * 2000, timestamp=now_ms()) for message_id in (1, 2, 26)])
+        
+        batches = []
+        original = db._submit_write
+        
+        async def recording(job):
+            result = await original(job)
+            batches.append(result)
+            return result
+        
+        monkeypatch.setattr(db, '_submit_write', recording)
+        assert await db.purge_expired({'*': 30, 'photo': 0}) == {'text': 20}
+        assert batches == [7, 7, 6, 0]
+        monkeypatch.setattr(db, '_submit_write', original)
+        
+        counters = await read_counters(db)
+        assert (counters['total_messages'], counters['total_replies'], counters['unreplied_messages']) == (10, 1, 9)
+        assert set(await search_all(db, '过期检查', limit=10)) == {('message', i) for i in range(21, 31)}
+        
+        assert await freelist_count(db) > 0
+        assert await db.incremental_vacuum(pages_per_step=2) > 0
+        assert await freelist_count(db) == 0
+        assert await db.incremental_vacuum() == 0
+    
+    run_with_sqlite(tmp_path, check)
+    assert database.enable_incremental_vacuum(str(tmp_path / 'bot.db')) is None
+    
+    # 旧版本创建的库需要一次 VACUUM 才能切换
+    legacy = str(tmp_path / 'legacy.db')
+    conn = sqlite3.connect(legacy)
+    conn.execute('CREATE TABLE t (x TEXT)')
+    conn.commit()
+    conn.close()
+    assert database.enable_incremental_vacuum(legacy) is not None
+    conn = sqlite3.connect(legacy)
+    assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+    conn.close()
+
+def test_archive_skips_rows_changed_after_copy(tmp_path):
+    """复制到归档库之后又有新回复的消息留在热库，下一批重新归档，计数器与归档库一致"""
+    async def check(db):
+        await add_old_replied_messages(db, 4)
+        original = db._write_archive
+        
+        async def write_then_reply(month, messages, replies):
+            await original(month, messages, replies)
+            db._write_archive = original
+            await db.add_replies([Reply(reply_id=0, original_message_id=1, admin_id=2,
+                                        content='迟到的回复', timestamp=now_ms())])
+        
+        db._write_archive = write_then_reply
+        assert sum((await db.archive_old_messages(older_than_days=30)).values()) == 4
+        
+        counters = await read_counters(db)
+        assert (counters['archived_messages'], counters['archived_replies']) == (4, 5)
+        assert await archive_row_counts(db) == {'messages': 4, 'replies': 5}
+        assert (await db.get_message_with_replies(1))[1][-1].content == '迟到的回复'
+    
+    run_with_sqlite(tmp_path, check)
+
+def test_archive_purge_resumes_without_double_count(tmp_path):
+    """从归档库删除失败后再次清理，补完删除且计数器只扣减一次"""
+    async def check(db):
+        await add_old_replied_messages(db, 3)
+        await db.archive_old_messages(older_than_days=30)
+        original = db._remove_archived
+        
+        async def fail_once(month, message_ids):
+            db._remove_archived = original
+            raise OSError('归档库写入失败')
+        
+        db._remove_archived = fail_once
+        await db.purge_expired({'*': 30})
+        counters = await read_counters(db)
+        assert (counters['archived_messages'], counters['archived_replies']) == (0, 0)
+        assert db._archive_months()
+        assert (await db.search('回复 1'))[0] == []
+        
+        await db.purge_expired({'*': 30})
+        counters = await read_counters(db)
+        assert (counters['archived_messages'], counters['archived_replies']) == (0, 0)
+        assert db._archive_months() == []
+    
+    run_with_sqlite(tmp_path, check)
+
+def run_with_admin_managers(database_url, monkeypatch, tmp_path, check, count: int = 2,
+                            max_chats: int = 1):
+    """用同一个数据库创建 count 个 AdminManager，模拟多个机器人进程"""
+    import admin_manager as admin_module
+    import config
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(config, 'ADMIN_IDS', [1, 2])
+    monkeypatch.setattr(config, 'SUPER_ADMIN_ID', 9)
+    monkeypatch.setattr(config, 'MAX_PRIVATE_CHATS_PER_ADMIN', max_chats)
+    monkeypatch.setattr(config, 'ENABLE_PRIVATE_CHAT', True)
+    
+    async def main():
+        db = create_database(database_url)
+        monkeypatch.setattr(admin_module, 'db', db)
+        await db.connect()
+        try:
+            managers = [admin_module.AdminManager() for _ in range(count)]
+            for manager in managers:
+                await manager.load()
+                await manager.flush()
+            await check(db, *managers)
+            for manager in managers:
+                await manager.flush()
+        finally:
+            await db.close()
+    asyncio.run(main())
+
+def telegram_user(user_id: int):
+    from telegram import User as TelegramUser
+    return TelegramUser(id=user_id, first_name=f'用户{user_id}', is_bot=False, username=f'user{user_id}')
+
+async def request_rows(db):
+    return {row['user_id']: (row['admin_id'], row['status'])
+            for row in await db.get_private_chat_requests()}
+
+def test_remove_admin_requeues_pending(database_url, monkeypatch, tmp_path):
+    """移除管理员时待处理请求转给其他管理员，已接受的私聊结束，管理员不会被其他进程写回"""
+    async def check(db, first, second):
+        assert (await first.request_private_chat(telegram_user(100), 1))[0]
+        assert (await first.request_private_chat(telegram_user(101), 1))[0]
+        assert await second.accept_private_chat(1, 101)
+        
+        success, requeued, cancelled = await first.remove_admin(1)
+        assert success
+        assert [(r.user_id, r.admin_id) for r in requeued] == [(100, 2)]
+        assert [r.user_id for r in cancelled] == [101]
+        assert await request_rows(db) == {100: (2, 'pending')}
+        
+        # 另一个进程仍缓存着被移除的管理员，写入活动时间不会把它恢复
+        second.update_admin_activity(1)
+        await second.flush()
+        assert 1 not in {admin['user_id'] for admin in await db.get_admins()}
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
+
+def test_remove_admin_requeue_checks_capacity(database_url, monkeypatch, tmp_path):
+    """转交时数据库检查新管理员的容量，缓存过期导致选中已满的管理员时请求被取消"""
+    async def check(db, first, second):
+        assert (await first.request_private_chat(telegram_user(100), 1))[0]
+        # 另一个进程让管理员 2 和超级管理员 9 都达到上限，first 的缓存不知道
+        for user_id, admin_id in ((102, 2), (103, 9)):
+            assert (await second.request_private_chat(telegram_user(user_id), admin_id))[0]
+            assert await second.accept_private_chat(admin_id, user_id)
+        
+        success, requeued, cancelled = await first.remove_admin(1)
+        assert success and requeued == []
+        assert [r.user_id for r in cancelled] == [100]
+        assert 100 not in await request_rows(db)
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
+
+def test_expire_and_accept_are_conditional(database_url, monkeypatch, tmp_path):
+    """过期清理只删除超时的待处理请求；两个进程同时接受同一请求时只有一个成功，已过期的请求不能再接受"""
+    import admin_manager as admin_module
+    
+    class TwoDaysAgo(datetime):
+        @classmethod
+        def now(cls, tz=None):
+            return datetime.now(tz) - timedelta(hours=48)
+    
+    async def check(db, first, second):
+        monkeypatch.setattr(admin_module, 'datetime', TwoDaysAgo)
+        assert (await first.request_private_chat(telegram_user(100), 1))[0]
+        assert (await first.request_private_chat(telegram_user(101), 1))[0]
+        monkeypatch.setattr(admin_module, 'datetime', datetime)
+        assert (await first.request_private_chat(telegram_user(102), 2))[0]
+        assert await second.accept_private_chat(1, 101)
+        
+        await first.cleanup_expired_requests(24)
+        assert await request_rows(db) == {101: (1, 'accepted'), 102: (2, 'pending')}
+        assert await first.get_private_chat_request(100) is None
+        # second 的缓存中 100 仍是待处理，条件写入拒绝接受已删除的请求
+        assert not await second.accept_private_chat(1, 100)
+        
+        results = await asyncio.gather(first.accept_private_chat(2, 102), second.accept_private_chat(2, 102))
+        assert sorted(results) == [False, True]
+        assert (await first.get_private_chat_request(102, refresh=True)).status == 'accepted'
+        assert (await second.get_private_chat_request(102, refresh=True)).status == 'accepted'
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
+
+def test_assignment_counted_after_request_stored(database_url, monkeypatch, tmp_path):
+    """自动分配只在请求写入数据库后计数，缓存过期导致写入失败时不计入公平性统计"""
+    async def check(db, first, second):
+        first.update_admin_activity(1)
+        # 另一个进程让管理员 1 达到上限，first 的缓存仍认为有空位
+        assert (await second.request_private_chat(telegram_user(102), 1))[0]
+        assert await second.accept_private_chat(1, 102)
+        
+        success, _, admin_id = await first.assign_private_chat(telegram_user(100))
+        assert not success and admin_id is None
+        assert first.router.assignments == {}
+        
+        # 失败后同步了管理员 1 的私聊，下一次分配给其他管理员
+        success, _, admin_id = await first.assign_private_chat(telegram_user(100))
+        assert success and admin_id != 1
+        assert first.router.assignments == {admin_id: 1}
+        assert first.router.sticky_hits == 0
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
+
+def test_assign_balances_load_and_prefers_online(database_url, monkeypatch, tmp_path):
+    """自动分配轮流选择负载最低的在线管理员；离线的管理员排在在线的之后"""
+    async def check(db, first, second):
+        for admin_id in (1, 2, 9):
+            first.update_admin_activity(admin_id)
+        
+        assigned = []
+        for user_id in range(100, 106):
+            success, _, admin_id = await first.assign_private_chat(telegram_user(user_id))
+            assert success
+            assigned.append(admin_id)
+        assert sorted(assigned[:3]) == sorted(assigned[3:]) == [1, 2, 9]
+        stats = first.router.get_stats()
+        assert stats['assignments'] == 6 and stats['load_fairness'] == 1.0
+        
+        first.admin_sessions[2].is_online = False
+        first.router.touch(2)
+        for user_id in (106, 107):
+            _, _, admin_id = await first.assign_private_chat(telegram_user(user_id))
+            assert admin_id in (1, 9)
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check, max_chats=3)
+
+def test_assign_skips_expired_online_admin(database_url, monkeypatch, tmp_path):
+    """在线状态过期的管理员即使堆中条目仍是最新版本，也不会被粘性分配或从堆顶选中"""
+    import config
+    
+    async def check(db, first, second):
+        first.update_admin_activity(1)
+        first.update_admin_activity(2)
+        first.router.remember(100, 1)
+        assert first.router.assign(100) == (first.admin_sessions[1], True)
+        
+        # 只让时间流逝，不调用 touch()，管理员 1 的堆条目仍是当前版本
+        expired = datetime.now() - timedelta(seconds=config.ADMIN_ONLINE_TIMEOUT + 60)
+        first.admin_sessions[1].last_active = expired.isoformat()
+        assert first.router._versions[1] == first.router._heap[0][1]
+        
+        admin, sticky = first.router.assign(100)
+        assert admin.user_id == 2 and not sticky
+        assert first.router.assignments == {}
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
+
+def test_private_chat_lookup_uses_cache(database_url, monkeypatch, tmp_path):
+    """每条消息的私聊查询命中缓存时不读数据库、不增加分配堆；待处理的请求读取其他进程的接受"""
+    async def check(db, first, second):
+        assert (await first.request_private_chat(telegram_user(100), 1))[0]
+        assert await second.accept_private_chat(1, 100)
+        
+        reads = []
+        original = db.get_private_chat_requests
+        
+        async def counting(*args, **kwargs):
+            reads.append(kwargs.get('user_id'))
+            return await original(*args, **kwargs)
+        
+        monkeypatch.setattr(db, 'get_private_chat_requests', counting)
+        # first 缓存的是待处理状态，需要读一次数据库
+        assert (await first.get_private_chat_request(100)).status == 'accepted'
+        assert await first.get_private_chat_request(200) is None
+        assert reads == [100, 200]
+        
+        heap_size = len(first.router._heap)
+        for _ in range(50):
+            assert (await first.get_private_chat_request(100)).status == 'accepted'
+            assert await first.get_private_chat_request(200) is None
+        assert reads == [100, 200]
+        assert len(first.router._heap) == heap_size
+        
+        # 新建请求后缓存立即可见
+        assert (await first.request_private_chat(telegram_user(200), 2))[0]
+        assert (await first.get_private_chat_request(200)).admin_id == 2
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
+
+def test_admin_by_username_index(database_url, monkeypatch, tmp_path):
+    """按用户名查找管理员先查内存索引，只有未命中时才读数据库"""
+    async def check(db, first, second):
+        reads = []
+        original = db.get_admin_by_username
+        
+        async def counting(username):
+            reads.append(username)
+            return await original(username)
+        
+        monkeypatch.setattr(db, 'get_admin_by_username', counting)
+        assert (await first.get_admin_by_username('admin_2')).user_id == 2
+        assert reads == []
+        
+        # 其他进程刚添加的管理员不在 first 的索引中
+        assert second.add_admin(telegram_user(300))
+        await second.flush()
+        assert (await first.get_admin_by_username('user300')).user_id == 300
+        assert await first.get_admin_by_username('nobody') is None
+        assert reads == ['user300', 'nobody']
+        
+        # 移除后索引同步更新
+        assert (await first.remove_admin(2))[0]
+        assert (await first.get_admin_by_username('admin_2')) is None
+    
+    run_with_admin_managers(database_url, monkeypatch, tmp_path, check)
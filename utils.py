@@ -115,4 +115,10 @@ def format_duration(seconds: int) -> str:
         hours = seconds // 3600
         remaining_minutes = (seconds % 3600) // 60
         remaining_seconds = seconds % 60
-        return f"{hours}时{remaining_minutes}分{remaining_seconds}秒"
\ No newline at end of file
+        return f"{hours}时{remaining_minutes}分{remaining_seconds}秒"
+
+def format_epoch_ms(timestamp_ms: int, fmt: str = '%Y-%m-%d %H:%M:%S') -> str:
+    """格式化毫秒时间戳显示"""
+    if not timestamp_ms:
+        return "未知"
+    return datetime.fromtimestamp(timestamp_ms / 1000).strftime(fmt)
\ No newline at end of file
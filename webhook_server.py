@@ -6,6 +6,7 @@ from telegram.ext import Application
 
 import config
 from bot import TelegramBot
+from db_metrics import query_metrics
 
 # 配置日志
 logging.basicConfig(
@@ -25,6 +26,7 @@ class WebhookServer:
         self.app.router.add_post(f'/{config.BOT_TOKEN}', self.handle_webhook)
         self.app.router.add_get('/', self.handle_root)
         self.app.router.add_get('/health', self.handle_health)
+        self.app.router.add_get('/metrics', self.handle_metrics)
     
     async def handle_webhook(self, request):
         """处理Telegram Webhook请求"""
@@ -58,32 +60,47 @@ class WebhookServer:
             "timestamp": asyncio.get_event_loop().time()
         })
     
+    async def handle_metrics(self, request):
+        """Prometheus 指标端点：数据库方法的耗时直方图、行数和错误数"""
+        return web.Response(
+            text=query_metrics.render_prometheus(),
+            content_type='text/plain'
+        )
+    
     async def start_server(self):
         """启动Webhook服务器"""
-        runner = web.AppRunner(self.app)
-        await runner.setup()
-        
-        site = web.TCPSite(
-            runner, 
-            '0.0.0.0', 
-            config.WEBHOOK_PORT
-        )
+        # 只有 run_polling/run_webhook 会调用 post_init 和 post_shutdown，
+        # 这里自行处理更新，需要显式执行启动和停止钩子（打开数据库、加载管理员数据）
+        application = self.bot.application
+        await application.initialize()
+        await self.bot.on_startup(application)
         
-        logger.info(f"启动Webhook服务器，监听端口 {config.WEBHOOK_PORT}")
-        await site.start()
-        
-        # 设置Webhook URL
-        webhook_url = f"{config.WEBHOOK_URL}/{config.BOT_TOKEN}"
-        await self.bot.application.bot.set_webhook(url=webhook_url)
-        logger.info(f"Webhook已设置: {webhook_url}")
-        
-        # 保持服务器运行
+        runner = web.AppRunner(self.app)
         try:
+            await runner.setup()
+            
+            site = web.TCPSite(
+                runner, 
+                '0.0.0.0', 
+                config.WEBHOOK_PORT
+            )
+            
+            logger.info(f"启动Webhook服务器，监听端口 {config.WEBHOOK_PORT}")
+            await site.start()
+            
+            # 设置Webhook URL
+            webhook_url = f"{config.WEBHOOK_URL}/{config.BOT_TOKEN}"
+            await application.bot.set_webhook(url=webhook_url)
+            logger.info(f"Webhook已设置: {webhook_url}")
+            
+            # 保持服务器运行
             await asyncio.Future()  # 无限等待
         except KeyboardInterrupt:
             logger.info("收到停止信号，正在关闭服务器...")
         finally:
             await runner.cleanup()
+            await self.bot.on_shutdown(application)
+            await application.shutdown()
 
 async def main():
     """主函数"""